@@ -8,23 +8,294 @@ Phân tích và so sánh file CT và CBCT - Đã thêm phát hiện outliers
 import os
 import sys
 import argparse
-import pydicom
+from array import array
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 import traceback
 from tqdm import tqdm
-import seaborn as sns
 from pathlib import Path
 import warnings
 from scipy import stats
+from dicom_header_cache import get_header_cache, versioned_namespace
+from dicom_header_reader import read_header
+from dicom_plot_renderer import DEFAULT_DPI, PLOT_FORMATS, box_stats, histogram_data, render_figures
+from dicom_stream_stats import StreamingAggregates
+from report_writer import StreamingReportWriter
+
+# Namespace của script này trong bộ đệm header dùng chung
+# (tăng phiên bản khi extract_file_info trả về các trường khác)
+HEADER_CACHE_NAMESPACE = versioned_namespace('analyzer', 1)
+
+# Các tag header mà extract_file_info sử dụng (chỉ đọc các tag này)
+HEADER_TAGS = [
+    'PatientID',
+    'Modality',
+    'StudyDate',
+    'AcquisitionDate',
+    'Manufacturer',
+    'ManufacturerModelName',
+    'Rows',
+    'Columns',
+    'BitsAllocated',
+    'BitsStored'
+]
+
+def extract_file_info(file_path):
+    """Đọc header một file DICOM và trả về dictionary thông tin dùng cho phân tích"""
+    # Chỉ đọc các tag cần thiết ở phần đầu file (không đọc pixel data)
+    dcm = read_header(file_path, HEADER_TAGS)
+
+    # Lấy thông tin cơ bản
+    patient_id = getattr(dcm, 'PatientID', 'Unknown')
+
+    # Xác định loại ảnh (CT/CBCT)
+    modality = getattr(dcm, 'Modality', 'Unknown')
+    filename = os.path.basename(file_path)
+
+    # Xác định loại ảnh dựa trên tên file nếu modality không có
+    if modality == 'Unknown' or modality not in ['CT', 'RTIMAGE']:
+        if filename.startswith('CT.'):
+            modality = 'CT'
+        elif filename.startswith('RI.'):
+            modality = 'RTIMAGE'  # CBCT thường được lưu dưới dạng RTIMAGE
+
+    # Lấy thông tin thời gian chụp
+    study_date = None
+    if hasattr(dcm, 'StudyDate') and dcm.StudyDate:
+        # Format DICOM date thành YYYY-MM-DD
+        date_str = dcm.StudyDate
+        if len(date_str) == 8:
+            study_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
+
+    # Nếu không có StudyDate, thử đọc AcquisitionDate
+    if not study_date and hasattr(dcm, 'AcquisitionDate') and dcm.AcquisitionDate:
+        date_str = dcm.AcquisitionDate
+        if len(date_str) == 8:
+            study_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
+
+    # Nếu vẫn không có, thử lấy từ đường dẫn
+    if not study_date:
+        # Tìm các thành phần giống định dạng ngày trong đường dẫn
+        path_parts = file_path.split(os.sep)
+        for part in path_parts:
+            if part.count('-') == 2:  # Có thể là định dạng YYYY-MM-DD
+                try:
+                    datetime.strptime(part, '%Y-%m-%d')
+                    study_date = part
+                    break
+                except ValueError:
+                    pass
+
+    # Nếu vẫn không tìm được ngày, đánh dấu là "Unknown"
+    if not study_date:
+        study_date = "Unknown"
+
+    # Lấy kích thước file (MB)
+    file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
+
+    # Lấy độ phân giải
+    rows = getattr(dcm, 'Rows', 0)
+    cols = getattr(dcm, 'Columns', 0)
+    resolution = f"{rows}x{cols}"
+    pixel_count = rows * cols if rows > 0 and cols > 0 else 0
+
+    # Thu thập thêm thông tin chi tiết
+    file_info = {
+        'file_path': file_path,
+        'file_name': filename,
+        'patient_id': patient_id,
+        'study_date': study_date,
+        'modality': modality,
+        'file_size': file_size,
+        'resolution': resolution,
+        'rows': rows,
+        'cols': cols,
+        'pixel_count': pixel_count,
+        'manufacturer': getattr(dcm, 'Manufacturer', 'Unknown'),
+        'manufacturer_model': getattr(dcm, 'ManufacturerModelName', 'Unknown'),
+        'pixel_data_exists': hasattr(dcm, 'PixelData'),
+        'bits_allocated': getattr(dcm, 'BitsAllocated', 0) if hasattr(dcm, 'BitsAllocated') else 0,
+        'bits_stored': getattr(dcm, 'BitsStored', 0) if hasattr(dcm, 'BitsStored') else 0
+    }
+
+    return file_info
+
+# Số file mỗi lô gửi cho một tiến trình con khi phân tích song song
+CHUNK_SIZE = 256
+
+# Số file mỗi lô trong chế độ phân tích theo luồng (--stream)
+STREAM_CHUNK_FILES = 10000
+
+# Thứ tự các trường trong bản ghi gọn (tuple) mà tiến trình con trả về;
+# file_path, file_name, resolution và pixel_count được tạo lại ở tiến trình chính
+RECORD_FIELDS = [
+    'patient_id',
+    'study_date',
+    'modality',
+    'file_size',
+    'rows',
+    'cols',
+    'manufacturer',
+    'manufacturer_model',
+    'pixel_data_exists',
+    'bits_allocated',
+    'bits_stored'
+]
+
+def file_info_to_record(file_info):
+    """Chuyển dictionary file_info thành bản ghi gọn theo RECORD_FIELDS"""
+    return tuple(file_info[field] for field in RECORD_FIELDS)
+
+def record_to_file_info(file_path, record):
+    """Tạo lại dictionary file_info từ bản ghi gọn"""
+    values = dict(zip(RECORD_FIELDS, record))
+    rows, cols = values['rows'], values['cols']
+    # Giữ đúng thứ tự khóa như extract_file_info
+    return {
+        'file_path': file_path,
+        'file_name': os.path.basename(file_path),
+        'patient_id': values['patient_id'],
+        'study_date': values['study_date'],
+        'modality': values['modality'],
+        'file_size': values['file_size'],
+        'resolution': f"{rows}x{cols}",
+        'rows': rows,
+        'cols': cols,
+        'pixel_count': rows * cols if rows > 0 and cols > 0 else 0,
+        'manufacturer': values['manufacturer'],
+        'manufacturer_model': values['manufacturer_model'],
+        'pixel_data_exists': values['pixel_data_exists'],
+        'bits_allocated': values['bits_allocated'],
+        'bits_stored': values['bits_stored']
+    }
+
+def _extract_records_chunk(file_paths):
+    """Đọc header một lô file trong tiến trình con, trả về list (bản ghi, lỗi)"""
+    results = []
+    for file_path in file_paths:
+        try:
+            results.append((file_info_to_record(extract_file_info(file_path)), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+class FileRecordStore:
+    """
+    Lưu thông tin từng file theo cột thay vì list các dictionary
+    
+    Các cột chuỗi lặp lại nhiều (bệnh nhân, ngày, modality, hãng máy...) được
+    lưu dưới dạng mã số nguyên kèm bảng giá trị, các cột số được lưu trong
+    array.array có kiểu. to_dataframe() chuyển một lần sang DataFrame với
+    dtype category cho các cột chuỗi, nên mỗi file chỉ tốn vài chục byte.
+    """
+    
+    # Các cột chuỗi lưu dưới dạng mã (category)
+    CATEGORICAL_COLUMNS = ['patient_id', 'study_date', 'modality', 'manufacturer', 'manufacturer_model']
+    
+    # Các cột số và typecode của array.array tương ứng
+    NUMERIC_COLUMNS = {
+        'file_size': 'd',
+        'rows': 'l',
+        'cols': 'l',
+        'pixel_data_exists': 'b',
+        'bits_allocated': 'l',
+        'bits_stored': 'l'
+    }
+    
+    def __init__(self):
+        self.file_paths = []
+        self._codes = {col: array('i') for col in self.CATEGORICAL_COLUMNS}
+        self._categories = {col: {} for col in self.CATEGORICAL_COLUMNS}
+        self._numeric = {col: array(typecode) for col, typecode in self.NUMERIC_COLUMNS.items()}
+    
+    def __len__(self):
+        return len(self.file_paths)
+    
+    def append(self, file_info):
+        """Thêm một file (dictionary file_info) vào bảng"""
+        self.file_paths.append(file_info['file_path'])
+        for col in self.CATEGORICAL_COLUMNS:
+            categories = self._categories[col]
+            value = str(file_info[col])
+            code = categories.get(value)
+            if code is None:
+                code = categories[value] = len(categories)
+            self._codes[col].append(code)
+        for col in self.NUMERIC_COLUMNS:
+            self._numeric[col].append(file_info[col] or 0)
+    
+    def _categorical(self, col):
+        categories = list(self._categories[col])
+        codes = np.array(self._codes[col], dtype=np.int32)
+        return pd.Categorical.from_codes(codes, categories=categories)
+    
+    def to_dataframe(self):
+        """Tạo DataFrame chi tiết (cùng các cột như trước đây) từ các cột đã lưu"""
+        numeric = {col: np.array(values) for col, values in self._numeric.items()}
+        rows, cols = numeric['rows'], numeric['cols']
+        
+        # Độ phân giải dạng "RowsxColumns", tạo chuỗi một lần cho mỗi cặp khác nhau
+        pairs, inverse = np.unique(np.stack([rows, cols], axis=1), axis=0, return_inverse=True) \
+            if len(self) else (np.empty((0, 2), dtype=np.int64), np.array([], dtype=np.int64))
+        resolution = pd.Categorical.from_codes(
+            np.asarray(inverse).reshape(-1).astype(np.int32),
+            categories=pd.Index([f"{r}x{c}" for r, c in pairs]).unique()
+        )
+        
+        return pd.DataFrame({
+            'file_path': self.file_paths,
+            'file_name': [os.path.basename(path) for path in self.file_paths],
+            'patient_id': self._categorical('patient_id'),
+            'study_date': self._categorical('study_date'),
+            'modality': self._categorical('modality'),
+            'file_size': numeric['file_size'],
+            'resolution': resolution,
+            'rows': rows,
+            'cols': cols,
+            'pixel_count': np.where((rows > 0) & (cols > 0), rows * cols, 0),
+            'manufacturer': self._categorical('manufacturer'),
+            'manufacturer_model': self._categorical('manufacturer_model'),
+            'pixel_data_exists': numeric['pixel_data_exists'].astype(bool),
+            'bits_allocated': numeric['bits_allocated'],
+            'bits_stored': numeric['bits_stored']
+        })
+
+# Các định dạng bảng (bảng chi tiết và bảng tổng hợp) và đuôi file tương ứng
+TABLE_FORMATS = {
+    'parquet': '.parquet',
+    'feather': '.feather'
+}
+
+# Các cột bắt buộc của bảng chi tiết khi nạp lại bằng --from-table
+FILE_TABLE_COLUMNS = [
+    'file_path', 'file_name', 'patient_id', 'study_date', 'modality', 'file_size',
+    'resolution', 'rows', 'cols', 'pixel_count', 'manufacturer', 'manufacturer_model',
+    'pixel_data_exists', 'bits_allocated', 'bits_stored'
+]
+
+def write_table(df, path, table_format):
+    """Ghi DataFrame ra file Parquet hoặc Feather (cần pyarrow)"""
+    if table_format == 'parquet':
+        df.to_parquet(path, index=False)
+    elif table_format == 'feather':
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        raise ValueError(f"Định dạng bảng không hợp lệ: {table_format}")
+    return path
+
+def read_table(path):
+    """Đọc lại bảng Parquet/Feather (định dạng theo đuôi file)"""
+    if path.endswith(TABLE_FORMATS['feather']):
+        return pd.read_feather(path)
+    return pd.read_parquet(path)
 
 class DicomAnalyzer:
     """Phân tích và so sánh file CT và CBCT với khả năng phát hiện outliers"""
     
-    def __init__(self, root_dir, output_dir=None, quiet=False):
+    def __init__(self, root_dir, output_dir=None, quiet=False, jobs=1, table_format=None,
+                 plot_format='png', plot_dpi=DEFAULT_DPI):
         """
         Khởi tạo với thư mục gốc và tùy chọn
         
@@ -32,20 +303,33 @@ class DicomAnalyzer:
         root_dir (str): Thư mục chứa dữ liệu DICOM
         output_dir (str, optional): Thư mục lưu kết quả, mặc định là root_dir
         quiet (bool): Tắt thông báo tiến trình nếu True
+        jobs (int): Số tiến trình đọc header và vẽ biểu đồ song song (1 = tuần tự)
+        table_format (str, optional): 'parquet' hoặc 'feather' để xuất bảng chi
+            tiết và bảng tổng hợp dạng bảng thay vì file Excel chi tiết
+        plot_format (str): Định dạng biểu đồ 'png', 'svg' hoặc 'html'
+        plot_dpi (int): Độ phân giải biểu đồ PNG
         """
         self.root_dir = root_dir
         self.output_dir = output_dir if output_dir else root_dir
         self.quiet = quiet
-        # Dictionary chứa kết quả phân tích
-        self.results = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        self.jobs = max(1, jobs)
+        self.table_format = table_format
+        self.plot_format = plot_format
+        self.plot_dpi = plot_dpi
+        # Bảng chi tiết đã nạp (--from-table), None nếu đọc từ file DICOM
+        self.source_table = None
+        # Bảng thông tin từng file, lưu theo cột
+        self.records = FileRecordStore()
         # DataFrame kết quả sau khi phân tích
         self.summary_df = None
         # DataFrame chi tiết tất cả các file
         self.all_files_df = None
+        # Thống kê gộp theo (bệnh nhân, ngày, modality) trong chế độ luồng
+        self.aggregates = None
         # Outliers đã phát hiện
         self.outliers = {
-            'file_size': defaultdict(list),
-            'resolution': defaultdict(list)
+            'file_size': pd.DataFrame(),
+            'resolution': pd.DataFrame()
         }
         # Giá trị tham chiếu mong đợi cho CT và CBCT
         self.reference_values = {
@@ -76,20 +360,34 @@ class DicomAnalyzer:
         if not self.quiet:
             print(message)
     
+    def iter_dicom_files(self):
+        """Duyệt thư mục và trả về lần lượt đường dẫn các file .dcm"""
+        for root, dirs, files in os.walk(self.root_dir):
+            for file in files:
+                if file.endswith('.dcm'):
+                    yield os.path.join(root, file)
+    
     def scan_directory(self):
         """Quét thư mục tìm tất cả file DICOM"""
         self.log(f"Đang quét thư mục: {self.root_dir}")
         
         # Tìm tất cả file .dcm
-        dicom_files = []
-        for root, dirs, files in os.walk(self.root_dir):
-            for file in files:
-                if file.endswith('.dcm'):
-                    dicom_files.append(os.path.join(root, file))
+        dicom_files = list(self.iter_dicom_files())
         
         self.log(f"Tìm thấy {len(dicom_files)} file DICOM")
         return dicom_files
     
+    def iter_file_chunks(self, chunk_files=STREAM_CHUNK_FILES):
+        """Duyệt thư mục và trả về các lô tối đa chunk_files đường dẫn (không giữ toàn bộ danh sách)"""
+        chunk = []
+        for file_path in self.iter_dicom_files():
+            chunk.append(file_path)
+            if len(chunk) >= chunk_files:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    
     def analyze_dicom_files(self):
         """Phân tích thông tin từ các file DICOM"""
         dicom_files = self.scan_directory()
@@ -98,138 +396,187 @@ class DicomAnalyzer:
             self.log("Không tìm thấy file DICOM nào!")
             return
         
-        # Thu thập dữ liệu chi tiết về từng file
-        all_files_data = []
-            
-        # Sử dụng tqdm để hiển thị thanh tiến trình
-        for file_path in tqdm(dicom_files, desc="Phân tích file DICOM", disable=self.quiet):
-            try:
-                # Đọc metadata (không đọc pixel data)
-                dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
-                
-                # Lấy thông tin cơ bản
-                patient_id = getattr(dcm, 'PatientID', 'Unknown')
-                
-                # Xác định loại ảnh (CT/CBCT)
-                modality = getattr(dcm, 'Modality', 'Unknown')
-                filename = os.path.basename(file_path)
-                
-                # Xác định loại ảnh dựa trên tên file nếu modality không có
-                if modality == 'Unknown' or modality not in ['CT', 'RTIMAGE']:
-                    if filename.startswith('CT.'):
-                        modality = 'CT'
-                    elif filename.startswith('RI.'):
-                        modality = 'RTIMAGE'  # CBCT thường được lưu dưới dạng RTIMAGE
-                
-                # Lấy thông tin thời gian chụp
-                study_date = None
-                if hasattr(dcm, 'StudyDate') and dcm.StudyDate:
-                    # Format DICOM date thành YYYY-MM-DD
-                    date_str = dcm.StudyDate
-                    if len(date_str) == 8:
-                        study_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-                
-                # Nếu không có StudyDate, thử đọc AcquisitionDate
-                if not study_date and hasattr(dcm, 'AcquisitionDate') and dcm.AcquisitionDate:
-                    date_str = dcm.AcquisitionDate
-                    if len(date_str) == 8:
-                        study_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-                
-                # Nếu vẫn không có, thử lấy từ đường dẫn
-                if not study_date:
-                    # Tìm các thành phần giống định dạng ngày trong đường dẫn
-                    path_parts = file_path.split(os.sep)
-                    for part in path_parts:
-                        if part.count('-') == 2:  # Có thể là định dạng YYYY-MM-DD
-                            try:
-                                datetime.strptime(part, '%Y-%m-%d')
-                                study_date = part
-                                break
-                            except ValueError:
-                                pass
-                
-                # Nếu vẫn không tìm được ngày, đánh dấu là "Unknown"
-                if not study_date:
-                    study_date = "Unknown"
-                
-                # Lấy kích thước file (MB)
-                file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-                
-                # Lấy độ phân giải
-                rows = getattr(dcm, 'Rows', 0)
-                cols = getattr(dcm, 'Columns', 0)
-                resolution = f"{rows}x{cols}"
-                pixel_count = rows * cols if rows > 0 and cols > 0 else 0
-                
-                # Thu thập thêm thông tin chi tiết
-                file_info = {
-                    'file_path': file_path,
-                    'file_name': filename,
-                    'patient_id': patient_id,
-                    'study_date': study_date,
-                    'modality': modality,
-                    'file_size': file_size,
-                    'resolution': resolution,
-                    'rows': rows,
-                    'cols': cols,
-                    'pixel_count': pixel_count,
-                    'manufacturer': getattr(dcm, 'Manufacturer', 'Unknown'),
-                    'manufacturer_model': getattr(dcm, 'ManufacturerModelName', 'Unknown'),
-                    'pixel_data_exists': hasattr(dcm, 'PixelData'),
-                    'bits_allocated': getattr(dcm, 'BitsAllocated', 0) if hasattr(dcm, 'BitsAllocated') else 0,
-                    'bits_stored': getattr(dcm, 'BitsStored', 0) if hasattr(dcm, 'BitsStored') else 0
-                }
-                
-                # Thêm vào kết quả theo cấu trúc phân cấp
-                self.results[patient_id][study_date][modality].append(file_info)
-                
-                # Thêm vào danh sách chi tiết
-                all_files_data.append(file_info)
-                
-            except Exception as e:
-                if not self.quiet:
-                    sys.stderr.write(f"\nLỗi khi xử lý file {file_path}: {str(e)}\n")
+        for file_info in self._load_file_infos(dicom_files):
+            self.records.append(file_info)
         
-        # Tạo DataFrame chi tiết của tất cả các file
-        if all_files_data:
-            self.all_files_df = pd.DataFrame(all_files_data)
+        # Tạo DataFrame chi tiết của tất cả các file (một lần, từ các cột đã lưu)
+        if len(self.records):
+            self.all_files_df = self.records.to_dataframe()
     
-    def generate_summary(self):
-        """Tạo báo cáo tổng hợp từ kết quả phân tích"""
-        summary_data = []
-        
-        for patient_id, patient_data in self.results.items():
-            for study_date, date_data in patient_data.items():
-                # Thông tin CT
-                ct_files = date_data.get('CT', [])
-                ct_count = len(ct_files)
-                ct_avg_size = np.mean([f['file_size'] for f in ct_files]) if ct_files else 0
-                ct_resolution = ct_files[0]['resolution'] if ct_files else 'N/A'
-                
-                # Thông tin CBCT/RTIMAGE
-                cbct_files = date_data.get('RTIMAGE', [])
-                cbct_count = len(cbct_files)
-                cbct_avg_size = np.mean([f['file_size'] for f in cbct_files]) if cbct_files else 0
-                cbct_resolution = cbct_files[0]['resolution'] if cbct_files else 'N/A'
-                
-                # Thêm vào dữ liệu tổng hợp
-                summary_data.append({
-                    'PatientID': patient_id,
-                    'StudyDate': study_date,
-                    'CT_Count': ct_count,
-                    'CT_AvgSize_MB': round(ct_avg_size, 2),
-                    'CT_Resolution': ct_resolution,
-                    'CBCT_Count': cbct_count,
-                    'CBCT_AvgSize_MB': round(cbct_avg_size, 2),
-                    'CBCT_Resolution': cbct_resolution,
-                    'SizeRatio': round(cbct_avg_size / ct_avg_size, 2) if ct_avg_size > 0 and cbct_avg_size > 0 else 'N/A',
-                    'CountRatio': round(ct_count / cbct_count, 2) if cbct_count > 0 and ct_count > 0 else 'N/A'
-                })
+    def load_file_table(self, table_path):
+        """Nạp bảng chi tiết đã xuất trước đó (Parquet/Feather) thay vì đọc lại các file DICOM"""
+        self.log(f"Đang nạp bảng chi tiết: {table_path}")
+        df = read_table(table_path)
+        
+        missing = [col for col in FILE_TABLE_COLUMNS if col not in df.columns]
+        if missing:
+            raise ValueError(f"Bảng chi tiết thiếu các cột: {', '.join(missing)}")
+        
+        # Các cột chuỗi dùng dtype category như khi phân tích từ file DICOM
+        for col in FileRecordStore.CATEGORICAL_COLUMNS + ['resolution']:
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                values = df[col].astype(str)
+                df[col] = pd.Categorical(values, categories=pd.unique(values))
+        
+        self.all_files_df = df
+        self.source_table = table_path
+        self.log(f"Đã nạp thông tin {len(df)} file")
+    
+    def _load_file_infos(self, dicom_files, log_cache=True):
+        """
+        Lấy file_info của các file, từ bộ đệm header hoặc đọc mới
+        
+        Trả về list file_info theo đúng thứ tự dicom_files (bỏ qua file lỗi).
+        """
+        # Lấy thông tin đã có trong bộ đệm header (file không thay đổi)
+        header_cache = get_header_cache()
+        cached = header_cache.get_many(dicom_files, HEADER_CACHE_NAMESPACE)
+        if cached and log_cache:
+            self.log(f"Dùng lại thông tin từ bộ đệm cho {len(cached)}/{len(dicom_files)} file")
+        for file_path, file_info in cached.items():
+            file_info['file_path'] = file_path
+        
+        # Đọc header các file còn lại (song song nếu jobs > 1)
+        pending = [file_path for file_path in dicom_files if file_path not in cached]
+        extracted = self._extract_pending(pending)
+        new_entries = [(file_path, extracted[file_path]) for file_path in pending if file_path in extracted]
+        
+        # Lưu thông tin mới đọc vào bộ đệm
+        header_cache.put_many(HEADER_CACHE_NAMESPACE, new_entries)
+        
+        # Gộp kết quả theo đúng thứ tự file để kết quả không phụ thuộc vào số tiến trình
+        file_infos = []
+        for file_path in dicom_files:
+            file_info = cached.get(file_path) or extracted.get(file_path)
+            if file_info is not None:
+                file_infos.append(file_info)
+        return file_infos
+    
+    def _extract_pending(self, file_paths):
+        """
+        Đọc header các file chưa có trong bộ đệm
+        
+        Trả về dictionary {đường dẫn: file_info} cho các file đọc được. Nếu
+        jobs > 1, các file được chia lô và gửi cho ProcessPoolExecutor; tiến
+        trình con chỉ trả về bản ghi gọn (tuple) để giảm chi phí truyền dữ liệu.
+        """
+        extracted = {}
+        
+        def handle(file_path, record, error):
+            if record is not None:
+                extracted[file_path] = record_to_file_info(file_path, record)
+            elif not self.quiet:
+                sys.stderr.write(f"\nLỗi khi xử lý file {file_path}: {error}\n")
+        
+        if self.jobs <= 1 or len(file_paths) <= CHUNK_SIZE:
+            # Sử dụng tqdm để hiển thị thanh tiến trình
+            for file_path in tqdm(file_paths, desc="Phân tích file DICOM", disable=self.quiet):
+                try:
+                    extracted[file_path] = extract_file_info(file_path)
+                except Exception as e:
+                    handle(file_path, None, str(e))
+            return extracted
+        
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {
+                executor.submit(_extract_records_chunk, file_paths[start:start + CHUNK_SIZE]): start
+                for start in range(0, len(file_paths), CHUNK_SIZE)
+            }
+            with tqdm(total=len(file_paths), desc="Phân tích file DICOM", disable=self.quiet) as pbar:
+                for future in as_completed(futures):
+                    start = futures[future]
+                    chunk = file_paths[start:start + CHUNK_SIZE]
+                    try:
+                        chunk_results = future.result()
+                    except Exception as e:
+                        chunk_results = [(None, str(e))] * len(chunk)
+                    for file_path, (record, error) in zip(chunk, chunk_results):
+                        handle(file_path, record, error)
+                    pbar.update(len(chunk))
+        
+        return extracted
+    
+    def _group_stats(self):
+        """
+        Thống kê theo (bệnh nhân, ngày, modality) theo thứ tự xuất hiện: count,
+        avg_size và resolution (của file đầu tiên). Lấy từ bảng chi tiết, hoặc
+        từ thống kê gộp khi chạy ở chế độ luồng.
+        """
+        df = self.all_files_df
+        if df is None or len(df) == 0:
+            if self.aggregates is not None:
+                return self.aggregates.group_table()
+            return None
         
-        # Tạo DataFrame từ dữ liệu
-        self.summary_df = pd.DataFrame(summary_data)
+        keys = ['patient_id', 'study_date', 'modality']
+        grouped = df.groupby(keys, sort=False, observed=True)
+        group_stats = pd.DataFrame({
+            'count': grouped.size(),
+            'avg_size': grouped['file_size'].mean(),
+            'resolution': grouped['resolution'].first().astype(str)
+        }).reset_index()
+        return group_stats.astype({key: str for key in keys})
+    
+    def generate_summary(self):
+        """Tạo báo cáo tổng hợp theo bệnh nhân và ngày từ bảng chi tiết"""
+        group_stats = self._group_stats()
+        if group_stats is None or len(group_stats) == 0:
+            self.summary_df = pd.DataFrame()
+            return self.summary_df
+        
+        keys = ['patient_id', 'study_date']
+        
+        # Các cặp (bệnh nhân, ngày) theo thứ tự xuất hiện, nhóm theo bệnh nhân
+        pairs = group_stats[keys].drop_duplicates()
+        patient_order = pd.unique(pairs['patient_id'])
+        pairs['_patient_rank'] = pairs['patient_id'].map({p: i for i, p in enumerate(patient_order)})
+        pairs = pairs.sort_values('_patient_rank', kind='stable').drop(columns='_patient_rank')
+        pairs = pairs.set_index(keys)
+        
+        # Thống kê theo nhóm cho CT và CBCT/RTIMAGE
+        def modality_stats(modality):
+            stats = group_stats[group_stats['modality'] == modality].set_index(keys)
+            return stats[['count', 'avg_size', 'resolution']].reindex(pairs.index)
+        
+        ct = modality_stats('CT')
+        cbct = modality_stats('RTIMAGE')
+        
+        ct_count = ct['count'].fillna(0).astype(int)
+        ct_avg_size = ct['avg_size'].fillna(0)
+        cbct_count = cbct['count'].fillna(0).astype(int)
+        cbct_avg_size = cbct['avg_size'].fillna(0)
+        
+        both_sizes = (ct_avg_size > 0) & (cbct_avg_size > 0)
+        both_counts = (ct_count > 0) & (cbct_count > 0)
+        size_ratio = (cbct_avg_size / ct_avg_size.where(both_sizes)).round(2)
+        count_ratio = (ct_count / cbct_count.where(both_counts)).round(2)
+        
+        self.summary_df = pd.DataFrame({
+            'PatientID': pairs.index.get_level_values('patient_id'),
+            'StudyDate': pairs.index.get_level_values('study_date'),
+            'CT_Count': ct_count.values,
+            'CT_AvgSize_MB': ct_avg_size.round(2).values,
+            'CT_Resolution': ct['resolution'].fillna('N/A').values,
+            'CBCT_Count': cbct_count.values,
+            'CBCT_AvgSize_MB': cbct_avg_size.round(2).values,
+            'CBCT_Resolution': cbct['resolution'].fillna('N/A').values,
+            'SizeRatio': size_ratio.astype(object).where(both_sizes, 'N/A').values,
+            'CountRatio': count_ratio.astype(object).where(both_counts, 'N/A').values
+        })
         return self.summary_df
     
+    def _modality_groups(self, min_count):
+        """Các dòng thuộc modality có ít nhất min_count file, sắp xếp theo thứ tự xuất hiện của modality"""
+        df = self.all_files_df
+        modality = df['modality'].astype(str)
+        counts = modality.map(modality.value_counts())
+        eligible = df[counts >= min_count]
+        
+        # Giữ thứ tự như khi duyệt từng modality theo thứ tự xuất hiện
+        rank = {m: i for i, m in enumerate(pd.unique(modality))}
+        order = eligible['modality'].astype(str).map(rank)
+        return eligible.iloc[np.argsort(order.values, kind='stable')]
+    
     def detect_file_size_outliers(self, method="iqr", threshold=1.5):
         """
         Phát hiện outlier về kích thước file
@@ -237,166 +584,179 @@ class DicomAnalyzer:
         Parameters:
         method (str): Phương pháp phát hiện, 'iqr' hoặc 'zscore' hoặc 'reference'
         threshold (float): Ngưỡng cho phương pháp IQR hoặc Z-score
+        
+        Trả về DataFrame các file bất thường (mỗi dòng một file).
         """
         if self.all_files_df is None or len(self.all_files_df) == 0:
             self.log("Không có dữ liệu để phát hiện outliers")
-            return []
+            return pd.DataFrame()
         
-        outliers = []
+        # Cần đủ dữ liệu (ít nhất 5 file) cho mỗi modality để phân tích
+        data = self._modality_groups(min_count=5)
         
-        # Phân tích theo từng loại modality
-        for modality in self.all_files_df['modality'].unique():
-            # Lọc dữ liệu theo modality
-            mod_data = self.all_files_df[self.all_files_df['modality'] == modality]
-            
-            if len(mod_data) < 5:  # Cần đủ dữ liệu để phân tích
-                continue
-                
-            file_sizes = mod_data['file_size'].values
-            
-            # Phương pháp IQR
-            if method == "iqr":
-                q1 = np.percentile(file_sizes, 25)
-                q3 = np.percentile(file_sizes, 75)
-                iqr = q3 - q1
-                lower_bound = q1 - threshold * iqr
-                upper_bound = q3 + threshold * iqr
-                
-                for idx, row in mod_data.iterrows():
-                    if row['file_size'] < lower_bound or row['file_size'] > upper_bound:
-                        outliers.append({
-                            'file_path': row['file_path'],
-                            'file_name': row['file_name'],
-                            'patient_id': row['patient_id'],
-                            'study_date': row['study_date'],
-                            'modality': row['modality'],
-                            'file_size': row['file_size'],
-                            'mean': np.mean(file_sizes),
-                            'std': np.std(file_sizes),
-                            'threshold': threshold,
-                            'lower_bound': lower_bound,
-                            'upper_bound': upper_bound,
-                            'issue_type': 'file_size',
-                            'issue_desc': f'{"Nhỏ bất thường" if row["file_size"] < lower_bound else "Lớn bất thường"}'
-                        })
-            
-            # Phương pháp Z-score
-            elif method == "zscore":
-                mean = np.mean(file_sizes)
-                std = np.std(file_sizes)
-                
-                if std == 0:  # Tránh chia cho 0
-                    continue
-                    
-                for idx, row in mod_data.iterrows():
-                    z_score = abs((row['file_size'] - mean) / std)
-                    if z_score > threshold:
-                        outliers.append({
-                            'file_path': row['file_path'],
-                            'file_name': row['file_name'],
-                            'patient_id': row['patient_id'],
-                            'study_date': row['study_date'],
-                            'modality': row['modality'],
-                            'file_size': row['file_size'],
-                            'mean': mean,
-                            'std': std,
-                            'z_score': z_score,
-                            'threshold': threshold,
-                            'issue_type': 'file_size',
-                            'issue_desc': f'Z-score = {z_score:.2f}, vượt ngưỡng {threshold}'
-                        })
-            
-            # Phương pháp so sánh với giá trị tham chiếu
-            elif method == "reference":
-                if modality in self.reference_values:
-                    lower = self.reference_values[modality]['file_size']['range'][0]
-                    upper = self.reference_values[modality]['file_size']['range'][1]
-                    
-                    for idx, row in mod_data.iterrows():
-                        if row['file_size'] < lower or row['file_size'] > upper:
-                            outliers.append({
-                                'file_path': row['file_path'],
-                                'file_name': row['file_name'],
-                                'patient_id': row['patient_id'],
-                                'study_date': row['study_date'],
-                                'modality': row['modality'],
-                                'file_size': row['file_size'],
-                                'expected_min': lower,
-                                'expected_max': upper,
-                                'issue_type': 'file_size',
-                                'issue_desc': f'Kích thước {row["file_size"]:.2f} MB nằm ngoài phạm vi mong đợi [{lower}-{upper}] MB'
-                            })
+        # Thống kê của từng modality
+        grouped = data['file_size'].groupby(data['modality'].astype(str), sort=False)
+        modality_stats = pd.DataFrame({
+            'mean': grouped.mean(),
+            'std': grouped.std(ddof=0),
+            'q1': grouped.quantile(0.25),
+            'q3': grouped.quantile(0.75)
+        })
         
         # Lưu kết quả
+        outliers = self._flag_file_size_outliers(data, method, threshold, modality_stats)
         self.outliers['file_size'] = outliers
         return outliers
     
+    def _flag_file_size_outliers(self, data, method, threshold, modality_stats):
+        """
+        Chọn các file có kích thước bất thường trong data
+        
+        modality_stats là DataFrame theo modality (cột mean, std, q1, q3), tính
+        từ bảng chi tiết hoặc từ thống kê gộp ở chế độ luồng.
+        """
+        base_columns = ['file_path', 'file_name', 'patient_id', 'study_date', 'modality', 'file_size']
+        outliers = data[base_columns].copy()
+        modality = data['modality'].astype(str)
+        sizes = data['file_size']
+        
+        # Thống kê của từng modality, gán lại cho từng dòng
+        mean = modality.map(modality_stats['mean'])
+        std = modality.map(modality_stats['std'])
+        
+        # Phương pháp IQR
+        if method == "iqr":
+            q1 = modality.map(modality_stats['q1'])
+            q3 = modality.map(modality_stats['q3'])
+            iqr = q3 - q1
+            lower_bound = q1 - threshold * iqr
+            upper_bound = q3 + threshold * iqr
+            
+            outliers = outliers.assign(
+                mean=mean, std=std, threshold=threshold,
+                lower_bound=lower_bound, upper_bound=upper_bound,
+                issue_type='file_size',
+                issue_desc=np.where(sizes < lower_bound, 'Nhỏ bất thường', 'Lớn bất thường')
+            )
+            mask = (sizes < lower_bound) | (sizes > upper_bound)
+        
+        # Phương pháp Z-score
+        elif method == "zscore":
+            # Bỏ qua modality có độ lệch chuẩn bằng 0 (tránh chia cho 0)
+            z_score = ((sizes - mean) / std.where(std != 0)).abs()
+            
+            outliers = outliers.assign(
+                mean=mean, std=std, z_score=z_score, threshold=threshold,
+                issue_type='file_size',
+                issue_desc='Z-score = ' + z_score.map('{:.2f}'.format) + f', vượt ngưỡng {threshold}'
+            )
+            mask = z_score > threshold
+        
+        # Phương pháp so sánh với giá trị tham chiếu
+        elif method == "reference":
+            lower = modality.map({m: ref['file_size']['range'][0] for m, ref in self.reference_values.items()})
+            upper = modality.map({m: ref['file_size']['range'][1] for m, ref in self.reference_values.items()})
+            
+            outliers = outliers.assign(
+                expected_min=lower, expected_max=upper,
+                issue_type='file_size',
+                issue_desc=('Kích thước ' + sizes.map('{:.2f}'.format) + ' MB nằm ngoài phạm vi mong đợi ['
+                            + lower.astype(str) + '-' + upper.astype(str) + '] MB')
+            )
+            # Chỉ các modality có giá trị tham chiếu
+            mask = lower.notna() & ((sizes < lower) | (sizes > upper))
+        
+        else:
+            mask = pd.Series(False, index=data.index)
+        
+        return outliers[mask].reset_index(drop=True)
+    
     def detect_resolution_outliers(self, method="reference"):
         """
         Phát hiện outlier về độ phân giải
         
         Parameters:
-        method (str): Phương pháp phát hiện, chủ yếu là 'reference' cho phân giải
+        method (str): Phương pháp phát hiện, 'reference' (giá trị tham chiếu) hoặc
+            'mode' (độ phân giải phổ biến nhất của modality)
+        
+        Trả về DataFrame các file bất thường (mỗi dòng một file).
         """
         if self.all_files_df is None or len(self.all_files_df) == 0:
             self.log("Không có dữ liệu để phát hiện outliers")
-            return []
+            return pd.DataFrame()
         
-        outliers = []
+        # Cần đủ dữ liệu (ít nhất 3 file) cho mỗi modality để phân tích
+        data = self._modality_groups(min_count=3)
         
-        # Phân tích theo từng loại modality
-        for modality in self.all_files_df['modality'].unique():
-            # Lọc dữ liệu theo modality
-            mod_data = self.all_files_df[self.all_files_df['modality'] == modality]
-            
-            if len(mod_data) < 3:  # Cần đủ dữ liệu để phân tích
-                continue
-                
-            # Phương pháp so sánh với giá trị tham chiếu
-            if method == "reference" and modality in self.reference_values:
-                expected = self.reference_values[modality]['resolution']['expected']
-                allowed = self.reference_values[modality]['resolution']['range']
-                
-                for idx, row in mod_data.iterrows():
-                    if row['resolution'] not in allowed and row['resolution'] != expected:
-                        outliers.append({
-                            'file_path': row['file_path'],
-                            'file_name': row['file_name'],
-                            'patient_id': row['patient_id'],
-                            'study_date': row['study_date'],
-                            'modality': row['modality'],
-                            'resolution': row['resolution'],
-                            'expected': expected,
-                            'allowed': allowed,
-                            'issue_type': 'resolution',
-                            'issue_desc': f'Độ phân giải {row["resolution"]} khác với giá trị mong đợi {expected}'
-                        })
-            
-            # Phương pháp so sánh với độ phân giải phổ biến nhất
-            elif method == "mode":
-                # Tìm độ phân giải phổ biến nhất
-                resolution_counts = mod_data['resolution'].value_counts()
-                mode_resolution = resolution_counts.index[0] if not resolution_counts.empty else None
-                
-                if mode_resolution:
-                    for idx, row in mod_data.iterrows():
-                        if row['resolution'] != mode_resolution:
-                            outliers.append({
-                                'file_path': row['file_path'],
-                                'file_name': row['file_name'],
-                                'patient_id': row['patient_id'],
-                                'study_date': row['study_date'],
-                                'modality': row['modality'],
-                                'resolution': row['resolution'],
-                                'mode_resolution': mode_resolution,
-                                'issue_type': 'resolution',
-                                'issue_desc': f'Độ phân giải {row["resolution"]} khác với giá trị phổ biến {mode_resolution}'
-                            })
+        # Độ phân giải phổ biến nhất của từng modality
+        mode_by_modality = None
+        if method == "mode":
+            modality = data['modality'].astype(str)
+            resolution = data['resolution'].astype(str)
+            counts = resolution.groupby([modality, resolution], sort=False).size()
+            mode_by_modality = counts.groupby(level=0, sort=False).idxmax().map(lambda key: key[1])
         
         # Lưu kết quả
+        outliers = self._flag_resolution_outliers(data, method, mode_by_modality)
         self.outliers['resolution'] = outliers
         return outliers
     
+    def _flag_resolution_outliers(self, data, method, mode_by_modality=None):
+        """
+        Chọn các file có độ phân giải bất thường trong data
+        
+        mode_by_modality (Series theo modality) chỉ cần cho phương pháp 'mode'.
+        """
+        base_columns = ['file_path', 'file_name', 'patient_id', 'study_date', 'modality', 'resolution']
+        outliers = data[base_columns].copy()
+        modality = data['modality'].astype(str)
+        resolution = data['resolution'].astype(str)
+        
+        # Phương pháp so sánh với giá trị tham chiếu
+        if method == "reference":
+            expected = modality.map({m: ref['resolution']['expected'] for m, ref in self.reference_values.items()})
+            allowed_by_modality = {m: ref['resolution']['range'] for m, ref in self.reference_values.items()}
+            allowed_pairs = pd.MultiIndex.from_tuples(
+                [(m, res) for m, allowed in allowed_by_modality.items() for res in allowed],
+                names=['modality', 'resolution']
+            )
+            is_allowed = pd.MultiIndex.from_arrays([modality, resolution]).isin(allowed_pairs)
+            
+            outliers = outliers.assign(
+                expected=expected,
+                allowed=modality.map(allowed_by_modality),
+                issue_type='resolution',
+                issue_desc='Độ phân giải ' + resolution + ' khác với giá trị mong đợi ' + expected.astype(str)
+            )
+            mask = expected.notna() & ~is_allowed & (resolution != expected)
+        
+        # Phương pháp so sánh với độ phân giải phổ biến nhất
+        elif method == "mode":
+            mode_resolution = modality.map(mode_by_modality)
+            
+            outliers = outliers.assign(
+                mode_resolution=mode_resolution,
+                issue_type='resolution',
+                issue_desc='Độ phân giải ' + resolution + ' khác với giá trị phổ biến ' + mode_resolution
+            )
+            mask = resolution != mode_resolution
+        
+        else:
+            mask = pd.Series(False, index=data.index)
+        
+        return outliers[mask].reset_index(drop=True)
+    
+    def all_outliers_df(self):
+        """Gộp tất cả outliers đã phát hiện thành một DataFrame có cột outlier_type"""
+        frames = [
+            outliers.assign(outlier_type=outlier_type)
+            for outlier_type, outliers in self.outliers.items()
+            if len(outliers) > 0
+        ]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+    
     def analyze_outliers(self):
         """Phân tích tất cả các loại outliers và tạo báo cáo"""
         # Phát hiện outliers
@@ -406,52 +766,77 @@ class DicomAnalyzer:
         
         # Tổng hợp kết quả
         total_files = len(self.all_files_df) if self.all_files_df is not None else 0
-        
-        self.log("\n=== BÁO CÁO OUTLIERS ===")
-        self.log(f"Tổng số file: {total_files}")
-        self.log(f"Số file có kích thước bất thường (IQR): {len(file_size_outliers_iqr)}")
-        self.log(f"Số file có kích thước bất thường (Tham chiếu): {len(file_size_outliers_ref)}")
-        self.log(f"Số file có độ phân giải bất thường: {len(resolution_outliers)}")
+        modality_counts = {}
+        size_details = {}
+        resolution_details = {}
         
         # Chi tiết về outliers theo loại modality
         if self.all_files_df is not None:
-            for modality in self.all_files_df['modality'].unique():
-                mod_count = len(self.all_files_df[self.all_files_df['modality'] == modality])
-                size_outliers = [o for o in file_size_outliers_iqr if o['modality'] == modality]
-                res_outliers = [o for o in resolution_outliers if o['modality'] == modality]
-                
-                self.log(f"\n{modality} ({mod_count} files):")
-                self.log(f"  - Kích thước bất thường: {len(size_outliers)} files ({len(size_outliers)/mod_count*100:.1f}%)")
-                self.log(f"  - Độ phân giải bất thường: {len(res_outliers)} files ({len(res_outliers)/mod_count*100:.1f}%)")
-                
-                # Chi tiết hơn về kích thước file
-                if len(size_outliers) > 0:
-                    size_df = pd.DataFrame(size_outliers)
-                    self.log("\n  Chi tiết kích thước bất thường:")
-                    for desc, group in size_df.groupby('issue_desc'):
-                        self.log(f"    {desc}: {len(group)} files")
-                        for i, row in enumerate(group.iloc[:5].itertuples()):
-                            self.log(f"      {i+1}. {os.path.basename(row.file_path)}: {row.file_size:.2f} MB")
-                        if len(group) > 5:
-                            self.log(f"      ... và {len(group) - 5} file khác")
-                
-                # Chi tiết về độ phân giải
-                if len(res_outliers) > 0:
-                    res_df = pd.DataFrame(res_outliers)
-                    unique_resolutions = res_df['resolution'].unique()
-                    self.log("\n  Chi tiết độ phân giải bất thường:")
-                    for res in unique_resolutions:
-                        count = len(res_df[res_df['resolution'] == res])
-                        self.log(f"    {res}: {count} files")
+            modality_counts = self.all_files_df['modality'].astype(str).value_counts(sort=False).to_dict()
+            self._collect_outlier_details(file_size_outliers_iqr, resolution_outliers, size_details, resolution_details)
+        
+        self._log_outlier_report(total_files, modality_counts,
+                                 (len(file_size_outliers_iqr), len(file_size_outliers_ref), len(resolution_outliers)),
+                                 size_details, resolution_details)
         
         # Tạo DataFrame outliers để export
-        all_outliers = []
-        for outlier_type, outliers_list in self.outliers.items():
-            for outlier in outliers_list:
-                outlier['outlier_type'] = outlier_type
-                all_outliers.append(outlier)
+        return self.all_outliers_df()
+    
+    def _collect_outlier_details(self, size_outliers, resolution_outliers, size_details, resolution_details):
+        """
+        Cộng dồn chi tiết outliers (theo modality) vào size_details và resolution_details
         
-        return all_outliers
+        size_details: {modality: {mô tả: [số file, [(tên file, kích thước), ...]]}},
+        chỉ giữ tối đa 5 file ví dụ cho mỗi mô tả. resolution_details:
+        {modality: {độ phân giải: số file}}. Gọi được nhiều lần (mỗi lô một lần).
+        """
+        if len(size_outliers) > 0:
+            keys = [size_outliers['modality'].astype(str), size_outliers['issue_desc']]
+            for (modality, desc), group in size_outliers.groupby(keys, sort=False):
+                detail = size_details.setdefault(modality, {}).setdefault(desc, [0, []])
+                detail[0] += len(group)
+                examples = group.iloc[:5 - len(detail[1])]
+                detail[1].extend(zip(examples['file_path'].map(os.path.basename), examples['file_size']))
+        
+        if len(resolution_outliers) > 0:
+            keys = [resolution_outliers['modality'].astype(str), resolution_outliers['resolution'].astype(str)]
+            for (modality, res), count in resolution_outliers.groupby(keys, sort=False).size().items():
+                counts = resolution_details.setdefault(modality, {})
+                counts[res] = counts.get(res, 0) + count
+    
+    def _log_outlier_report(self, total_files, modality_counts, totals, size_details, resolution_details):
+        """In báo cáo outliers (totals là số file bất thường theo IQR, tham chiếu và độ phân giải)"""
+        self.log("\n=== BÁO CÁO OUTLIERS ===")
+        self.log(f"Tổng số file: {total_files}")
+        self.log(f"Số file có kích thước bất thường (IQR): {totals[0]}")
+        self.log(f"Số file có kích thước bất thường (Tham chiếu): {totals[1]}")
+        self.log(f"Số file có độ phân giải bất thường: {totals[2]}")
+        
+        for modality, mod_count in modality_counts.items():
+            mod_size = size_details.get(modality, {})
+            mod_res = resolution_details.get(modality, {})
+            n_size = sum(count for count, _ in mod_size.values())
+            n_res = sum(mod_res.values())
+            
+            self.log(f"\n{modality} ({mod_count} files):")
+            self.log(f"  - Kích thước bất thường: {n_size} files ({n_size/mod_count*100:.1f}%)")
+            self.log(f"  - Độ phân giải bất thường: {n_res} files ({n_res/mod_count*100:.1f}%)")
+            
+            # Chi tiết hơn về kích thước file
+            if n_size > 0:
+                self.log("\n  Chi tiết kích thước bất thường:")
+                for desc, (count, examples) in sorted(mod_size.items()):
+                    self.log(f"    {desc}: {count} files")
+                    for i, (file_name, file_size) in enumerate(examples):
+                        self.log(f"      {i+1}. {file_name}: {file_size:.2f} MB")
+                    if count > 5:
+                        self.log(f"      ... và {count - 5} file khác")
+            
+            # Chi tiết về độ phân giải
+            if n_res > 0:
+                self.log("\n  Chi tiết độ phân giải bất thường:")
+                for res, count in mod_res.items():
+                    self.log(f"    {res}: {count} files")
     
     def visualize_outliers(self):
         """Tạo biểu đồ trực quan cho các outliers - ĐÃ SỬA LỖI"""
@@ -462,80 +847,70 @@ class DicomAnalyzer:
         # Đảm bảo thư mục đầu ra tồn tại
         os.makedirs(self.output_dir, exist_ok=True)
         
-        # 1. Biểu đồ boxplot kích thước file theo modality
-        plt.figure(figsize=(12, 7))
-        sns.boxplot(x='modality', y='file_size', data=self.all_files_df)
-        plt.title('Phân bố kích thước file theo loại')
-        plt.xlabel('Loại ảnh')
-        plt.ylabel('Kích thước file (MB)')
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.tight_layout()
-        plt.savefig(os.path.join(self.output_dir, 'file_size_boxplot.png'), dpi=300, bbox_inches='tight')
+        df = self.all_files_df
+        modality = df['modality'].astype(str)
+        size_groups = df['file_size'].groupby(modality, sort=False)
+        figures = []
+        
+        # 1. Biểu đồ boxplot kích thước file theo modality (thống kê hộp tính trước)
+        figures.append(('boxplot', 'file_size_boxplot', {
+            'stats': [box_stats(sizes.values, name) for name, sizes in size_groups],
+            'title': 'Phân bố kích thước file theo loại',
+            'xlabel': 'Loại ảnh',
+            'ylabel': 'Kích thước file (MB)'
+        }))
         
         # 2. Biểu đồ phân bố kích thước cho từng loại riêng biệt
-        for modality in self.all_files_df['modality'].unique():
-            mod_data = self.all_files_df[self.all_files_df['modality'] == modality]
-            
-            if len(mod_data) < 5:
+        for name, sizes in size_groups:
+            if len(sizes) < 5:
                 continue
-                
-            plt.figure(figsize=(12, 7))
-            
-            # Histogram và KDE
-            sns.histplot(mod_data['file_size'], kde=True, bins=30)
             
             # Vẽ các đường vertical cho outliers
-            if modality in self.reference_values:
-                lower = self.reference_values[modality]['file_size']['range'][0]
-                upper = self.reference_values[modality]['file_size']['range'][1]
-                expected = self.reference_values[modality]['file_size']['expected']
-                
-                plt.axvline(x=lower, color='r', linestyle='--', label=f'Min Expected: {lower} MB')
-                plt.axvline(x=upper, color='r', linestyle='--', label=f'Max Expected: {upper} MB')
-                plt.axvline(x=expected, color='g', linestyle='-', label=f'Expected: {expected} MB')
+            lines = []
+            if name in self.reference_values:
+                lower = self.reference_values[name]['file_size']['range'][0]
+                upper = self.reference_values[name]['file_size']['range'][1]
+                expected = self.reference_values[name]['file_size']['expected']
+                lines = [
+                    (lower, 'r', '--', f'Min Expected: {lower} MB'),
+                    (upper, 'r', '--', f'Max Expected: {upper} MB'),
+                    (expected, 'g', '-', f'Expected: {expected} MB')
+                ]
             
-            plt.title(f'Phân bố kích thước file {modality}')
-            plt.xlabel('Kích thước file (MB)')
-            plt.ylabel('Số lượng')
-            plt.legend()
-            plt.grid(True, alpha=0.3)
-            plt.tight_layout()
-            plt.savefig(os.path.join(self.output_dir, f'file_size_dist_{modality}.png'), dpi=300, bbox_inches='tight')
+            # Histogram (30 bin) và KDE
+            figures.append(('histogram', f'file_size_dist_{name}', {
+                'hist': histogram_data(sizes.values, bins=30),
+                'lines': lines,
+                'title': f'Phân bố kích thước file {name}',
+                'xlabel': 'Kích thước file (MB)',
+                'ylabel': 'Số lượng'
+            }))
         
         # 3. Biểu đồ phân bố độ phân giải
-        plt.figure(figsize=(14, 7))
-        
         # Tạo DataFrame với số lượng của mỗi độ phân giải
-        resolution_counts = self.all_files_df.groupby(['modality', 'resolution']).size().reset_index(name='count')
-        
-        # Vẽ biểu đồ cột
-        ax = sns.barplot(x='resolution', y='count', hue='modality', data=resolution_counts)
-        
-        plt.title('Phân bố độ phân giải theo loại ảnh')
-        plt.xlabel('Độ phân giải')
-        plt.ylabel('Số lượng file')
-        plt.xticks(rotation=45)
-        plt.legend(title='Loại ảnh')
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.tight_layout()
-        plt.savefig(os.path.join(self.output_dir, 'resolution_distribution.png'), dpi=300, bbox_inches='tight')
-        
-        # 4. Heatmap cho outliers theo bệnh nhân và ngày - PHẦN ĐÃ SỬA
+        resolution_counts = df.groupby(['modality', 'resolution'], observed=True).size().reset_index(name='count')
+        resolution_counts = resolution_counts.astype({'modality': str, 'resolution': str})
+        figures.append(('grouped_bars', 'resolution_distribution', {
+            'x_order': list(pd.unique(resolution_counts['resolution'])),
+            'counts': {
+                name: dict(zip(group['resolution'], group['count']))
+                for name, group in resolution_counts.groupby('modality', sort=False)
+            },
+            'title': 'Phân bố độ phân giải theo loại ảnh',
+            'xlabel': 'Độ phân giải',
+            'ylabel': 'Số lượng file',
+            'legend_title': 'Loại ảnh'
+        }))
+        
+        # 4. Heatmap cho outliers theo bệnh nhân và ngày
+        heatmap_index = None
         try:
             # Kiểm tra xem có outlier không
-            all_outliers = []
-            for outlier_type, outlier_list in self.outliers.items():
-                for outlier in outlier_list:
-                    all_outliers.append({
-                        'patient_id': outlier.get('patient_id', ''),
-                        'study_date': outlier.get('study_date', ''),
-                        'modality': outlier.get('modality', ''),
-                        'outlier_type': outlier_type
-                    })
+            outlier_df = self.all_outliers_df()
             
-            if all_outliers:
-                # Tạo DataFrame từ tất cả các outlier
-                outlier_df = pd.DataFrame(all_outliers)
+            if len(outlier_df) > 0:
+                # Chỉ giữ các cột dùng cho heatmap (dạng chuỗi)
+                outlier_df = outlier_df[['patient_id', 'study_date', 'modality', 'outlier_type']].astype(str)
                 
                 # Tạo bảng tổng hợp (crosstab) thay vì dùng pivot
                 pivot_table = pd.crosstab(
@@ -546,12 +921,13 @@ class DicomAnalyzer:
                 
                 # Tạo heatmap nếu có đủ dữ liệu
                 if not pivot_table.empty and len(pivot_table) > 1:
-                    plt.figure(figsize=(10, 8))
-                    sns.heatmap(pivot_table, annot=True, cmap='YlOrRd', fmt='g')
-                    plt.title('Phân bố outliers theo bệnh nhân, ngày và loại ảnh')
-                    plt.tight_layout()
-                    plt.savefig(os.path.join(self.output_dir, 'outliers_heatmap.png'), dpi=300, bbox_inches='tight')
-                    self.log("Đã tạo heatmap outliers thành công")
+                    heatmap_index = len(figures)
+                    figures.append(('heatmap', 'outliers_heatmap', {
+                        'table': pivot_table,
+                        'cmap': 'YlOrRd',
+                        'fmt': 'g',
+                        'title': 'Phân bố outliers theo bệnh nhân, ngày và loại ảnh'
+                    }))
                 else:
                     self.log("Không đủ dữ liệu để tạo heatmap outliers")
             else:
@@ -561,6 +937,12 @@ class DicomAnalyzer:
             self.log(f"Lỗi khi tạo heatmap outliers: {str(e)}")
             traceback.print_exc()
         
+        for i, (name, path, error) in enumerate(self._render(figures)):
+            if error:
+                self.log(f"Lỗi khi tạo biểu đồ {name}: {error}")
+            elif i == heatmap_index:
+                self.log("Đã tạo heatmap outliers thành công")
+        
         self.log(f"Đã tạo các biểu đồ outliers và lưu vào thư mục: {self.output_dir}")
 
     def export_outliers_report(self):
@@ -569,40 +951,18 @@ class DicomAnalyzer:
             self.log("Không có dữ liệu outliers để xuất")
             return None
         
-        # Tạo DataFrame chứa tất cả outliers
-        all_outliers = []
-        for outlier_type, outliers_list in self.outliers.items():
-            for outlier in outliers_list:
-                outlier_info = {
-                    'outlier_type': outlier_type,
-                    'file_name': outlier.get('file_name', ''),
-                    'file_path': outlier.get('file_path', ''),
-                    'patient_id': outlier.get('patient_id', ''),
-                    'study_date': outlier.get('study_date', ''),
-                    'modality': outlier.get('modality', ''),
-                    'issue_desc': outlier.get('issue_desc', '')
-                }
-                
-                # Thêm thông tin chi tiết tùy loại
-                if outlier_type == 'file_size':
-                    outlier_info.update({
-                        'value': outlier.get('file_size', 0),
-                        'unit': 'MB'
-                    })
-                elif outlier_type == 'resolution':
-                    outlier_info.update({
-                        'value': outlier.get('resolution', ''),
-                        'expected': outlier.get('expected', ''),
-                        'unit': 'pixels'
-                    })
-                
-                all_outliers.append(outlier_info)
+        # Tạo DataFrame chứa tất cả outliers, cột value/unit tùy loại
+        frames = [
+            self._outlier_report_frame(outlier_type, outliers)
+            for outlier_type, outliers in self.outliers.items()
+            if len(outliers) > 0
+        ]
         
-        if not all_outliers:
+        if not frames:
             return None
             
         # Tạo DataFrame
-        outliers_df = pd.DataFrame(all_outliers)
+        outliers_df = pd.concat(frames, ignore_index=True)
         
         # Đảm bảo thư mục đầu ra tồn tại
         os.makedirs(self.output_dir, exist_ok=True)
@@ -615,6 +975,29 @@ class DicomAnalyzer:
         self.log(f"\nĐã xuất báo cáo outliers ra file: {excel_path}")
         return excel_path
     
+    def _outlier_report_frame(self, outlier_type, outliers):
+        """Các dòng báo cáo outliers (cột chung, value/unit/expected tùy loại)"""
+        frame = pd.DataFrame({
+            'outlier_type': outlier_type,
+            'file_name': outliers['file_name'],
+            'file_path': outliers['file_path'],
+            'patient_id': outliers['patient_id'],
+            'study_date': outliers['study_date'],
+            'modality': outliers['modality'],
+            'issue_desc': outliers['issue_desc']
+        })
+        
+        # Thêm thông tin chi tiết tùy loại
+        if outlier_type == 'file_size':
+            frame['value'] = outliers['file_size']
+            frame['unit'] = 'MB'
+            frame['expected'] = ''
+        elif outlier_type == 'resolution':
+            frame['value'] = outliers['resolution'].astype(str)
+            frame['unit'] = 'pixels'
+            frame['expected'] = outliers['expected'] if 'expected' in outliers else ''
+        return frame
+    
     def validate_cross_relationships(self):
         """Kiểm tra chéo mối quan hệ giữa CT và CBCT"""
         if self.summary_df is None:
@@ -651,45 +1034,43 @@ class DicomAnalyzer:
             
             if not outlier_ratios.empty:
                 self.log("\nPhát hiện tỷ lệ kích thước bất thường:")
-                for _, row in outlier_ratios.iterrows():
-                    self.log(f"  - Bệnh nhân {row['PatientID']}, ngày {row['StudyDate']}: " + 
-                           f"Tỷ lệ = {float(row['SizeRatio']):.2f} (CT: {row['CT_AvgSize_MB']} MB, CBCT: {row['CBCT_AvgSize_MB']} MB)")
+                lines = ("  - Bệnh nhân " + outlier_ratios['PatientID'].astype(str) +
+                         ", ngày " + outlier_ratios['StudyDate'].astype(str) +
+                         ": Tỷ lệ = " + outlier_ratios['SizeRatio'].astype(float).map('{:.2f}'.format) +
+                         " (CT: " + outlier_ratios['CT_AvgSize_MB'].astype(str) +
+                         " MB, CBCT: " + outlier_ratios['CBCT_AvgSize_MB'].astype(str) + " MB)")
+                self.log("\n".join(lines))
         
         # 2. Kiểm tra độ phân giải
-        resolution_stats = {}
-        for idx, row in self.summary_df.iterrows():
-            if row['CT_Resolution'] != 'N/A' and row['CBCT_Resolution'] != 'N/A':
-                ct_res = row['CT_Resolution'].split('x')
-                cbct_res = row['CBCT_Resolution'].split('x')
-                
-                try:
-                    ct_pixels = int(ct_res[0]) * int(ct_res[1])
-                    cbct_pixels = int(cbct_res[0]) * int(cbct_res[1])
-                    
-                    if row['CT_Resolution'] not in resolution_stats:
-                        resolution_stats[row['CT_Resolution']] = 0
-                    resolution_stats[row['CT_Resolution']] += 1
-                    
-                    if row['CBCT_Resolution'] not in resolution_stats:
-                        resolution_stats[row['CBCT_Resolution']] = 0
-                    resolution_stats[row['CBCT_Resolution']] += 1
-                    
-                    # So sánh số lượng pixel
-                    ratio = cbct_pixels / ct_pixels if ct_pixels > 0 else float('inf')
-                    resolution_stats.setdefault('ratio_sum', 0)
-                    resolution_stats['ratio_sum'] += ratio
-                    resolution_stats.setdefault('ratio_count', 0)
-                    resolution_stats['ratio_count'] += 1
-                except:
-                    pass
+        res_check = self.summary_df[(self.summary_df['CT_Resolution'] != 'N/A') &
+                                    (self.summary_df['CBCT_Resolution'] != 'N/A')]
+        
+        # Tách "RowsxColumns" thành số, bỏ qua các dòng không hợp lệ
+        ct_dims = res_check['CT_Resolution'].astype(str).str.split('x', expand=True)
+        cbct_dims = res_check['CBCT_Resolution'].astype(str).str.split('x', expand=True)
+        if len(res_check) > 0 and ct_dims.shape[1] >= 2 and cbct_dims.shape[1] >= 2:
+            ct_pixels = pd.to_numeric(ct_dims[0], errors='coerce') * pd.to_numeric(ct_dims[1], errors='coerce')
+            cbct_pixels = pd.to_numeric(cbct_dims[0], errors='coerce') * pd.to_numeric(cbct_dims[1], errors='coerce')
+            valid = ct_pixels.notna() & cbct_pixels.notna()
+        else:
+            ct_pixels = cbct_pixels = pd.Series(dtype=float)
+            valid = pd.Series(False, index=res_check.index)
+        res_check = res_check[valid]
+        
+        # Đếm số lần xuất hiện của mỗi độ phân giải (CT và CBCT xen kẽ theo từng dòng)
+        all_resolutions = pd.Series(np.column_stack([res_check['CT_Resolution'].astype(str),
+                                                     res_check['CBCT_Resolution'].astype(str)]).ravel())
+        resolution_counts = all_resolutions.value_counts(sort=False)
+        
+        # So sánh số lượng pixel
+        ratios = (cbct_pixels[valid] / ct_pixels[valid].where(ct_pixels[valid] > 0)).fillna(float('inf'))
         
         self.log("\n=== THỐNG KÊ ĐỘ PHÂN GIẢI ===")
-        for res, count in resolution_stats.items():
-            if res not in ['ratio_sum', 'ratio_count']:
-                self.log(f"{res}: {count} lần")
+        for res, count in resolution_counts.items():
+            self.log(f"{res}: {count} lần")
         
-        if 'ratio_sum' in resolution_stats and resolution_stats['ratio_count'] > 0:
-            avg_res_ratio = resolution_stats['ratio_sum'] / resolution_stats['ratio_count']
+        if len(ratios) > 0:
+            avg_res_ratio = ratios.sum() / len(ratios)
             self.log(f"\nTỷ lệ pixel trung bình (CBCT/CT): {avg_res_ratio:.2f}")
             self.log(f"Kết luận: {'CBCT có độ phân giải cao hơn' if avg_res_ratio > 1 else 'CT có độ phân giải cao hơn'}")
         
@@ -718,9 +1099,12 @@ class DicomAnalyzer:
             
             if not outlier_counts.empty:
                 self.log("\nPhát hiện tỷ lệ số lượng ảnh bất thường:")
-                for _, row in outlier_counts.iterrows():
-                    self.log(f"  - Bệnh nhân {row['PatientID']}, ngày {row['StudyDate']}: " + 
-                          f"Tỷ lệ = {float(row['CountRatio']):.2f} (CT: {row['CT_Count']}, CBCT: {row['CBCT_Count']})")
+                lines = ("  - Bệnh nhân " + outlier_counts['PatientID'].astype(str) +
+                         ", ngày " + outlier_counts['StudyDate'].astype(str) +
+                         ": Tỷ lệ = " + outlier_counts['CountRatio'].astype(float).map('{:.2f}'.format) +
+                         " (CT: " + outlier_counts['CT_Count'].astype(str) +
+                         ", CBCT: " + outlier_counts['CBCT_Count'].astype(str) + ")")
+                self.log("\n".join(lines))
     
     def create_visualizations(self):
         """Tạo các biểu đồ trực quan so sánh CT và CBCT"""
@@ -738,62 +1122,41 @@ class DicomAnalyzer:
         for col in ['SizeRatio', 'CountRatio']:
             self.summary_df[col] = pd.to_numeric(self.summary_df[col], errors='coerce')
         
-        # 1. Biểu đồ so sánh số lượng CT và CBCT theo ngày
-        plt.figure(figsize=(12, 7))
+        figures = []
         
         # Lọc dữ liệu có cả CT và CBCT
         plot_data = self.summary_df[(self.summary_df['CT_Count'] > 0) & (self.summary_df['CBCT_Count'] > 0)]
         
         if len(plot_data) > 0:
-            # Tạo index cho trục x
-            plot_data = plot_data.copy()
-            plot_data['Label'] = plot_data['PatientID'] + ' (' + plot_data['StudyDate'] + ')'
-            
-            # Tạo biểu đồ cột
-            barwidth = 0.35
-            r1 = np.arange(len(plot_data))
-            r2 = [x + barwidth for x in r1]
-            
-            plt.bar(r1, plot_data['CT_Count'], width=barwidth, label='CT Images', color='skyblue')
-            plt.bar(r2, plot_data['CBCT_Count'], width=barwidth, label='CBCT Images', color='salmon')
-            
-            plt.xlabel('Bệnh nhân (Ngày)')
-            plt.ylabel('Số lượng ảnh')
-            plt.title('So sánh số lượng ảnh CT và CBCT theo bệnh nhân và ngày')
-            plt.xticks([r + barwidth/2 for r in range(len(plot_data))], plot_data['Label'], rotation=45, ha='right')
-            plt.legend()
-            plt.tight_layout()
-            plt.grid(axis='y', linestyle='--', alpha=0.7)
-            
-            # Lưu biểu đồ
-            plt.savefig(os.path.join(self.output_dir, 'ct_cbct_count_comparison.png'), dpi=300, bbox_inches='tight')
-        
-        # 2. Biểu đồ so sánh kích thước file trung bình
-        plt.figure(figsize=(12, 7))
-        
-        if len(plot_data) > 0:
-            barwidth = 0.35
-            r1 = np.arange(len(plot_data))
-            r2 = [x + barwidth for x in r1]
-            
-            plt.bar(r1, plot_data['CT_AvgSize_MB'], width=barwidth, label='CT Avg Size (MB)', color='lightblue')
-            plt.bar(r2, plot_data['CBCT_AvgSize_MB'], width=barwidth, label='CBCT Avg Size (MB)', color='lightcoral')
+            # Nhãn trục x
+            labels = list(plot_data['PatientID'] + ' (' + plot_data['StudyDate'] + ')')
             
-            plt.xlabel('Bệnh nhân (Ngày)')
-            plt.ylabel('Dung lượng trung bình (MB)')
-            plt.title('So sánh dung lượng trung bình file CT và CBCT')
-            plt.xticks([r + barwidth/2 for r in range(len(plot_data))], plot_data['Label'], rotation=45, ha='right')
-            plt.legend()
-            plt.tight_layout()
-            plt.grid(axis='y', linestyle='--', alpha=0.7)
+            # 1. Biểu đồ so sánh số lượng CT và CBCT theo ngày
+            figures.append(('paired_bars', 'ct_cbct_count_comparison', {
+                'labels': labels,
+                'series': [
+                    (plot_data['CT_Count'].values, 'CT Images', 'skyblue'),
+                    (plot_data['CBCT_Count'].values, 'CBCT Images', 'salmon')
+                ],
+                'xlabel': 'Bệnh nhân (Ngày)',
+                'ylabel': 'Số lượng ảnh',
+                'title': 'So sánh số lượng ảnh CT và CBCT theo bệnh nhân và ngày'
+            }))
             
-            # Lưu biểu đồ
-            plt.savefig(os.path.join(self.output_dir, 'ct_cbct_size_comparison.png'), dpi=300, bbox_inches='tight')
+            # 2. Biểu đồ so sánh kích thước file trung bình
+            figures.append(('paired_bars', 'ct_cbct_size_comparison', {
+                'labels': labels,
+                'series': [
+                    (plot_data['CT_AvgSize_MB'].values, 'CT Avg Size (MB)', 'lightblue'),
+                    (plot_data['CBCT_AvgSize_MB'].values, 'CBCT Avg Size (MB)', 'lightcoral')
+                ],
+                'xlabel': 'Bệnh nhân (Ngày)',
+                'ylabel': 'Dung lượng trung bình (MB)',
+                'title': 'So sánh dung lượng trung bình file CT và CBCT'
+            }))
             
         # 3. Biểu đồ heatmap về tỷ lệ
         if len(self.summary_df) > 1:  # Cần ít nhất 2 hàng để vẽ heatmap
-            plt.figure(figsize=(10, 8))
-            
             # Chuẩn bị dữ liệu cho heatmap
             heatmap_data = self.summary_df[['PatientID', 'StudyDate', 'SizeRatio', 'CountRatio']].copy()
             heatmap_data = heatmap_data.dropna()
@@ -808,16 +1171,25 @@ class DicomAnalyzer:
                 })
                 pivot_data = pivot_data.set_index('Label').T
                 
-                # Vẽ heatmap
-                sns.heatmap(pivot_data, annot=True, cmap="YlGnBu", fmt='.2f', linewidths=.5)
-                plt.title('Tỷ lệ kích thước và số lượng ảnh giữa CT và CBCT')
-                plt.tight_layout()
-                
-                # Lưu biểu đồ
-                plt.savefig(os.path.join(self.output_dir, 'ct_cbct_ratio_heatmap.png'), dpi=300, bbox_inches='tight')
+                figures.append(('heatmap', 'ct_cbct_ratio_heatmap', {
+                    'table': pivot_data,
+                    'cmap': 'YlGnBu',
+                    'fmt': '.2f',
+                    'linewidths': .5,
+                    'title': 'Tỷ lệ kích thước và số lượng ảnh giữa CT và CBCT'
+                }))
+        
+        for name, path, error in self._render(figures):
+            if error:
+                self.log(f"Lỗi khi tạo biểu đồ {name}: {error}")
         
         self.log(f"\nĐã tạo các biểu đồ và lưu vào thư mục: {self.output_dir}")
     
+    def _render(self, figures):
+        """Vẽ các biểu đồ (song song nếu jobs > 1) theo định dạng và dpi đã chọn"""
+        return render_figures(figures, self.output_dir, plot_format=self.plot_format,
+                              dpi=self.plot_dpi, jobs=self.jobs)
+    
     def export_results(self):
         """Xuất kết quả ra file Excel và CSV"""
         if self.summary_df is None:
@@ -836,21 +1208,19 @@ class DicomAnalyzer:
         csv_path = os.path.join(self.output_dir, f"ct_cbct_analysis_{timestamp}.csv")
         self.summary_df.to_csv(csv_path, index=False)
         
+        # Xuất bảng chi tiết và bảng tổng hợp dạng Parquet/Feather (không giới hạn số dòng như Excel)
+        if self.table_format:
+            self._export_tables(timestamp)
+        
         # Xuất chi tiết tất cả các file
-        if self.all_files_df is not None:
+        elif self.all_files_df is not None:
             detail_path = os.path.join(self.output_dir, f"ct_cbct_details_{timestamp}.xlsx")
             with pd.ExcelWriter(detail_path) as writer:
                 self.all_files_df.to_excel(writer, sheet_name='Files', index=False)
                 
                 # Thêm sheet outliers nếu có
-                all_outliers = []
-                for outlier_type, outliers_list in self.outliers.items():
-                    for outlier in outliers_list:
-                        outlier['outlier_type'] = outlier_type
-                        all_outliers.append(outlier)
-                
-                if all_outliers:
-                    outliers_df = pd.DataFrame(all_outliers)
+                outliers_df = self.all_outliers_df()
+                if len(outliers_df) > 0:
                     outliers_df.to_excel(writer, sheet_name='Outliers', index=False)
                     
                 # Thêm sheet tóm tắt
@@ -864,12 +1234,41 @@ class DicomAnalyzer:
         
         return excel_path, csv_path
     
-    def run_full_analysis(self):
-        """Chạy toàn bộ quá trình phân tích"""
+    def _export_tables(self, timestamp):
+        """Xuất bảng tổng hợp và bảng chi tiết theo table_format"""
+        extension = TABLE_FORMATS[self.table_format]
+        
+        if len(self.summary_df) > 0:
+            # Cột tỷ lệ chứa cả số và 'N/A', chuyển sang số (NaN) để ghi được dạng bảng
+            summary_table = self.summary_df.assign(
+                SizeRatio=pd.to_numeric(self.summary_df['SizeRatio'], errors='coerce'),
+                CountRatio=pd.to_numeric(self.summary_df['CountRatio'], errors='coerce')
+            )
+            summary_path = os.path.join(self.output_dir, f"ct_cbct_summary_{timestamp}{extension}")
+            write_table(summary_table, summary_path, self.table_format)
+            self.log(f"- Bảng tổng hợp: {summary_path}")
+        
+        # Bảng chi tiết đã nạp từ file thì không cần ghi lại
+        if self.all_files_df is not None and self.source_table is None:
+            files_path = os.path.join(self.output_dir, f"ct_cbct_files_{timestamp}{extension}")
+            write_table(self.all_files_df, files_path, self.table_format)
+            self.log(f"- Bảng chi tiết: {files_path}")
+    
+    def run_full_analysis(self, from_table=None):
+        """
+        Chạy toàn bộ quá trình phân tích
+        
+        Parameters:
+        from_table (str, optional): Bảng chi tiết (Parquet/Feather) đã xuất trước
+            đó; nếu có, các bước sau được chạy lại mà không đọc file DICOM
+        """
         self.log("Bắt đầu phân tích CT và CBCT...")
         
-        # Quét và phân tích file DICOM
-        self.analyze_dicom_files()
+        # Quét và phân tích file DICOM (hoặc nạp lại bảng chi tiết)
+        if from_table:
+            self.load_file_table(from_table)
+        else:
+            self.analyze_dicom_files()
         
         # Tạo báo cáo tổng hợp
         summary = self.generate_summary()
@@ -896,6 +1295,104 @@ class DicomAnalyzer:
         self.export_results()
         
         self.log("\nĐã hoàn thành phân tích!")
+    
+    def _chunk_dataframe(self, file_paths):
+        """Đọc thông tin một lô file và trả về DataFrame cùng các cột như all_files_df"""
+        records = FileRecordStore()
+        for file_info in self._load_file_infos(file_paths, log_cache=False):
+            records.append(file_info)
+        return records.to_dataframe()
+    
+    def run_streaming_analysis(self, chunk_files=STREAM_CHUNK_FILES):
+        """
+        Chạy phân tích theo luồng cho các kho dữ liệu lớn hơn bộ nhớ
+        
+        Lượt 1 đọc các file theo từng lô chunk_files file và chỉ cập nhật thống
+        kê gộp theo (bệnh nhân, ngày, modality); mỗi lô được bỏ đi ngay sau đó.
+        Bảng tổng hợp và ngưỡng outlier (trung bình, độ lệch chuẩn, phân vị gần
+        đúng, độ phân giải phổ biến) được tính từ các thống kê này. Lượt 2 đọc
+        lại từng lô (thường từ bộ đệm header) và ghi các file bất thường ra báo
+        cáo CSV theo luồng. Bảng chi tiết tất cả các file không được tạo, nên
+        không có biểu đồ outliers và file chi tiết.
+        """
+        self.log("Bắt đầu phân tích CT và CBCT (chế độ luồng)...")
+        self.log(f"Đang quét thư mục: {self.root_dir}")
+        
+        # Lượt 1: thống kê gộp
+        self.aggregates = StreamingAggregates()
+        for i, chunk in enumerate(self.iter_file_chunks(chunk_files)):
+            self.log(f"Lượt 1 - lô {i + 1}: {len(chunk)} file")
+            self.aggregates.update(self._chunk_dataframe(chunk))
+        
+        total_files = self.aggregates.file_count
+        if total_files == 0:
+            self.log("Không tìm thấy file DICOM nào!")
+            return
+        self.log(f"Đã tổng hợp thông tin {total_files} file")
+        
+        # Tạo báo cáo tổng hợp
+        summary = self.generate_summary()
+        self.log("\n=== BÁO CÁO TỔNG HỢP ===")
+        self.log(summary)
+        
+        # Kiểm tra chéo mối quan hệ
+        self.validate_cross_relationships()
+        
+        # Ngưỡng outlier theo modality từ thống kê gộp
+        modality_stats = self.aggregates.modality_stats()
+        self.log("\n=== NGƯỠNG OUTLIER THEO MODALITY ===")
+        for modality, row in modality_stats.iterrows():
+            self.log(f"{modality}: {row['count']} file, trung bình {row['mean']:.3f} MB, "
+                     f"độ lệch chuẩn {row['std']:.3f} MB, Q1 ≈ {row['q1']:.3f} MB, Q3 ≈ {row['q3']:.3f} MB, "
+                     f"độ phân giải phổ biến {row['mode_resolution']}")
+        
+        # Giống chế độ thường: cần ít nhất 5 file (kích thước) và 3 file (độ phân giải) mỗi modality
+        size_modalities = modality_stats.index[modality_stats['count'] >= 5]
+        resolution_modalities = modality_stats.index[modality_stats['count'] >= 3]
+        
+        # Lượt 2: đánh dấu outliers theo ngưỡng cuối cùng
+        self.log("\nĐang tìm kiếm các trường hợp ngoại lệ (outliers)...")
+        os.makedirs(self.output_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        report_path = os.path.join(self.output_dir, f"dicom_outliers_{timestamp}.csv")
+        totals = [0, 0, 0]
+        size_details = {}
+        resolution_details = {}
+        
+        with StreamingReportWriter(report_path, 'csv') as writer:
+            for i, chunk in enumerate(self.iter_file_chunks(chunk_files)):
+                self.log(f"Lượt 2 - lô {i + 1}: {len(chunk)} file")
+                df = self._chunk_dataframe(chunk)
+                modality = df['modality'].astype(str)
+                
+                size_data = df[modality.isin(size_modalities)]
+                size_iqr = self._flag_file_size_outliers(size_data, "iqr", 1.5, modality_stats)
+                size_ref = self._flag_file_size_outliers(size_data, "reference", 1.5, modality_stats)
+                resolution = self._flag_resolution_outliers(df[modality.isin(resolution_modalities)], "reference")
+                
+                totals[0] += len(size_iqr)
+                totals[1] += len(size_ref)
+                totals[2] += len(resolution)
+                self._collect_outlier_details(size_iqr, resolution, size_details, resolution_details)
+                
+                # Báo cáo gồm các outliers như export_outliers_report (kích thước theo tham chiếu)
+                for outlier_type, outliers in (('file_size', size_ref), ('resolution', resolution)):
+                    if len(outliers) > 0:
+                        for row in self._outlier_report_frame(outlier_type, outliers).to_dict('records'):
+                            writer.write(row)
+        
+        modality_counts = modality_stats['count'].to_dict()
+        self._log_outlier_report(total_files, modality_counts, totals, size_details, resolution_details)
+        if writer.rows_written:
+            self.log(f"\nĐã xuất báo cáo outliers ra file: {report_path}")
+        
+        # Tạo biểu đồ (chỉ các biểu đồ dựa trên bảng tổng hợp)
+        self.create_visualizations()
+        
+        # Xuất kết quả tổng thể
+        self.export_results()
+        
+        self.log("\nĐã hoàn thành phân tích!")
 
 
 def main():
@@ -911,25 +1408,59 @@ def main():
     parser.add_argument('-o', '--output-dir', help='Thư mục lưu kết quả (mặc định là thư mục đầu vào)')
     parser.add_argument('-q', '--quiet', action='store_true', help='Chế độ yên lặng, không hiển thị thông báo tiến trình')
     parser.add_argument('--active', action='store_true', help='Sử dụng môi trường ảo hiện tại (cho uv run)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Số tiến trình đọc header và vẽ biểu đồ song song (1 = xử lý tuần tự)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Phân tích theo luồng từng lô file với bộ nhớ cố định (cho kho dữ liệu rất lớn)')
+    parser.add_argument('--chunk-files', type=int, default=STREAM_CHUNK_FILES,
+                        help='Số file mỗi lô khi dùng --stream')
+    parser.add_argument('--plot-format', choices=PLOT_FORMATS, default='png',
+                        help='Định dạng file biểu đồ (html: SVG nhúng trong trang HTML)')
+    parser.add_argument('--dpi', type=int, default=DEFAULT_DPI, help='Độ phân giải biểu đồ PNG')
+    parser.add_argument('--table-format', choices=list(TABLE_FORMATS),
+                        help='Xuất bảng chi tiết và bảng tổng hợp dạng Parquet/Feather (thay cho file Excel chi tiết)')
+    parser.add_argument('--from-table',
+                        help='Nạp lại bảng chi tiết (Parquet/Feather) đã xuất và chạy lại các bước phân tích, '
+                             'không đọc file DICOM')
     
     args = parser.parse_args()
     
-    # Nếu không có đối số đường dẫn, yêu cầu người dùng nhập
-    input_dir = args.input_dir
-    if not input_dir:
-        input_dir = input("Nhập đường dẫn đến thư mục chứa dữ liệu DICOM: ")
-    
-    # Kiểm tra thư mục có tồn tại không
-    if not os.path.exists(input_dir) or not os.path.isdir(input_dir):
-        print(f"Thư mục không tồn tại: {input_dir}", file=sys.stderr)
-        sys.exit(1)
+    if args.from_table:
+        if args.stream:
+            parser.error("--from-table không dùng được cùng --stream")
+        if not os.path.isfile(args.from_table):
+            print(f"File bảng không tồn tại: {args.from_table}", file=sys.stderr)
+            sys.exit(1)
+        # Mặc định lưu kết quả cạnh file bảng
+        input_dir = args.input_dir or os.path.dirname(os.path.abspath(args.from_table))
+    else:
+        # Nếu không có đối số đường dẫn, yêu cầu người dùng nhập
+        input_dir = args.input_dir
+        if not input_dir:
+            input_dir = input("Nhập đường dẫn đến thư mục chứa dữ liệu DICOM: ")
+        
+        # Kiểm tra thư mục có tồn tại không
+        if not os.path.exists(input_dir) or not os.path.isdir(input_dir):
+            print(f"Thư mục không tồn tại: {input_dir}", file=sys.stderr)
+            sys.exit(1)
     
     # Tạo và chạy bộ phân tích
     analyzer = DicomAnalyzer(
         root_dir=input_dir,
         output_dir=args.output_dir, 
-        quiet=args.quiet
+        quiet=args.quiet,
+        jobs=args.jobs,
+        table_format=args.table_format,
+        plot_format=args.plot_format,
+        plot_dpi=args.dpi
     )
-    analyzer.run_full_analysis()
+    if args.stream:
+        analyzer.run_streaming_analysis(chunk_files=max(1, args.chunk_files))
+    else:
+        try:
+            analyzer.run_full_analysis(from_table=args.from_table)
+        except ValueError as e:
+            print(f"Lỗi: {e}", file=sys.stderr)
+            sys.exit(1)
 if __name__ == "__main__":
     main()
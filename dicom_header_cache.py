@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bộ đệm header DICOM dùng chung cho tất cả các script (lưu bằng SQLite)
+
+Mỗi mục được khóa theo (đường dẫn tuyệt đối, namespace) và lưu kèm kích thước
+và mtime của file. Khi file thay đổi (kích thước hoặc mtime khác) mục đó bị
+bỏ qua và được đọc lại, nên chạy lại script trên kho dữ liệu không đổi gần
+như không phải phân tích header lần nào nữa.
+
+Mỗi script dùng một namespace riêng vì mỗi script trích xuất các trường khác
+nhau. Namespace mang số phiên bản (versioned_namespace): khi hàm trích xuất
+của script trả về dữ liệu khác trước, tăng phiên bản để các mục cũ bị bỏ qua
+thay vì tiếp tục được dùng cho đến khi file thay đổi. Đường dẫn file bộ đệm mặc định là ~/.cache/ct_cbct/dicom_header_cache.sqlite,
+có thể thay đổi bằng biến môi trường DICOM_HEADER_CACHE (đặt là "off" để tắt).
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+# Biến môi trường cho đường dẫn bộ đệm ("off" để tắt bộ đệm)
+CACHE_ENV_VAR = 'DICOM_HEADER_CACHE'
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ct_cbct', 'dicom_header_cache.sqlite')
+
+# Số tham số tối đa trong một câu truy vấn IN (giới hạn của SQLite)
+_QUERY_BATCH = 500
+
+def versioned_namespace(name, version):
+    """Namespace kèm phiên bản dữ liệu trích xuất, vd. ('verifier', 2) -> 'verifier@v2'"""
+    return f"{name}@v{version}"
+
+def file_fingerprint(file_path):
+    """Trả về (kích thước, mtime_ns) của file, hoặc None nếu không stat được"""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+class DicomHeaderCache:
+    """Bộ đệm header DICOM lưu trên đĩa, khóa theo đường dẫn, kích thước và mtime"""
+
+    def __init__(self, cache_path=None):
+        """
+        Mở (hoặc tạo) file bộ đệm
+
+        Parameters:
+        cache_path (str, optional): Đường dẫn file SQLite, mặc định lấy từ
+            biến môi trường DICOM_HEADER_CACHE hoặc DEFAULT_CACHE_PATH
+        """
+        if cache_path is None:
+            cache_path = os.environ.get(CACHE_ENV_VAR) or DEFAULT_CACHE_PATH
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if cache_path.lower() == 'off':
+            return
+
+        try:
+            cache_dir = os.path.dirname(os.path.abspath(cache_path))
+            os.makedirs(cache_dir, exist_ok=True)
+            self._conn = sqlite3.connect(cache_path, timeout=30, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS headers ('
+                ' path TEXT NOT NULL,'
+                ' namespace TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' mtime_ns INTEGER NOT NULL,'
+                ' data TEXT NOT NULL,'
+                ' PRIMARY KEY (path, namespace))'
+            )
+            self._conn.commit()
+        except Exception as e:
+            print(f"Không thể mở bộ đệm header {cache_path}: {e}. Tiếp tục không dùng bộ đệm.")
+            self._conn = None
+
+    @property
+    def enabled(self):
+        """True nếu bộ đệm đang hoạt động"""
+        return self._conn is not None
+
+    def get(self, file_path, namespace):
+        """Lấy dữ liệu đã lưu cho file, None nếu chưa có hoặc file đã thay đổi"""
+        return self.get_many([file_path], namespace).get(file_path)
+
+    def get_many(self, file_paths, namespace):
+        """
+        Lấy dữ liệu đã lưu cho nhiều file cùng lúc
+
+        Trả về dictionary {đường dẫn: dữ liệu} chỉ chứa các file còn hợp lệ
+        (kích thước và mtime khớp với lúc lưu).
+        """
+        if not self.enabled or not file_paths:
+            self.misses += len(file_paths)
+            return {}
+
+        # Stat tất cả file trước để so sánh với giá trị đã lưu
+        wanted = {}
+        for file_path in file_paths:
+            fingerprint = file_fingerprint(file_path)
+            if fingerprint is not None:
+                wanted[os.path.abspath(file_path)] = (file_path, fingerprint)
+
+        found = {}
+        abs_paths = list(wanted.keys())
+        with self._lock:
+            for start in range(0, len(abs_paths), _QUERY_BATCH):
+                batch = abs_paths[start:start + _QUERY_BATCH]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(
+                    f'SELECT path, size, mtime_ns, data FROM headers '
+                    f'WHERE namespace = ? AND path IN ({placeholders})',
+                    [namespace] + batch
+                ).fetchall()
+                for abs_path, size, mtime_ns, data in rows:
+                    file_path, fingerprint = wanted[abs_path]
+                    if (size, mtime_ns) == fingerprint:
+                        found[file_path] = json.loads(data)
+
+        self.hits += len(found)
+        self.misses += len(file_paths) - len(found)
+        return found
+
+    def put(self, file_path, namespace, data):
+        """Lưu dữ liệu đã trích xuất cho một file"""
+        self.put_many(namespace, [(file_path, data)])
+
+    def put_many(self, namespace, items):
+        """Lưu dữ liệu cho nhiều file, items là list (đường dẫn, dữ liệu)"""
+        if not self.enabled:
+            return
+
+        rows = []
+        for file_path, data in items:
+            if data is None:
+                continue
+            fingerprint = file_fingerprint(file_path)
+            if fingerprint is None:
+                continue
+            rows.append((
+                os.path.abspath(file_path), namespace, fingerprint[0], fingerprint[1],
+                json.dumps(data, default=str)
+            ))
+
+        if not rows:
+            return
+
+        with self._lock:
+            try:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO headers (path, namespace, size, mtime_ns, data) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    rows
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                print(f"Không thể ghi bộ đệm header: {e}")
+
+    def get_or_compute(self, file_path, namespace, compute):
+        """Lấy dữ liệu từ bộ đệm, nếu không có thì gọi compute(file_path) và lưu lại"""
+        data = self.get(file_path, namespace)
+        if data is None:
+            data = compute(file_path)
+            if data is not None:
+                self.put(file_path, namespace, data)
+        return data
+
+    def close(self):
+        """Đóng kết nối đến file bộ đệm"""
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
+
+_default_cache = None
+
+def get_header_cache():
+    """Trả về bộ đệm header dùng chung trong tiến trình hiện tại"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DicomHeaderCache()
+    return _default_cache
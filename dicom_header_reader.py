@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Đọc nhanh header DICOM: chỉ các tag cần thiết, chỉ phần đầu của file
+
+Thay vì phân tích toàn bộ header đến tận pixel data, read_header chỉ giữ các
+tag trong danh sách (specific_tags), dừng ngay sau tag lớn nhất cần dùng và
+chỉ đọc HEADER_READ_BYTES byte đầu tiên của file. Chỉ khi header dài hơn phần
+đã đọc mới đọc tiếp từ file, nên với các file RTIMAGE/RTSTRUCT lớn việc trích
+xuất header bị giới hạn bởi I/O thay vì CPU.
+"""
+
+import io
+from pydicom.datadict import tag_for_keyword
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
+
+# Số byte đầu file được đọc cho lần phân tích đầu tiên
+HEADER_READ_BYTES = 64 * 1024
+
+def keywords_to_tags(keywords):
+    """Chuyển danh sách keyword DICOM (hoặc tag) sang danh sách Tag"""
+    tags = []
+    for keyword in keywords:
+        tag = tag_for_keyword(keyword) if isinstance(keyword, str) else keyword
+        if tag is None:
+            raise ValueError(f"Keyword DICOM không hợp lệ: {keyword}")
+        tags.append(Tag(tag))
+    return tags
+
+def read_header(file_path, keywords, max_bytes=HEADER_READ_BYTES):
+    """
+    Đọc nhanh chỉ các tag trong keywords từ file DICOM
+
+    Parameters:
+    file_path (str): Đường dẫn file DICOM
+    keywords (list): Danh sách keyword (vd. 'PatientID') hoặc tag cần đọc
+    max_bytes (int): Số byte đầu file đọc ở lần thử đầu tiên
+
+    Trả về pydicom Dataset chỉ chứa các tag đã yêu cầu (nếu có trong file).
+    """
+    tags = keywords_to_tags(keywords)
+    # SpecificCharacterSet cần để giải mã đúng chuỗi ký tự
+    specific_tags = tags + [Tag(0x0008, 0x0005)]
+    last_tag = max(tags)
+    stopped = [False]
+
+    def stop_after_last_tag(tag, vr, length):
+        # Các tag ở mức gốc được sắp xếp tăng dần, qua tag lớn nhất là đủ
+        if tag > last_tag:
+            stopped[0] = True
+            return True
+        return False
+
+    with open(file_path, 'rb') as f:
+        head = f.read(max_bytes)
+        file_is_larger = len(head) == max_bytes and f.read(1) != b''
+
+        try:
+            dcm = read_partial(io.BytesIO(head), stop_when=stop_after_last_tag,
+                               force=True, specific_tags=specific_tags)
+            if stopped[0] or not file_is_larger:
+                return dcm
+        except Exception:
+            if not file_is_larger:
+                raise
+
+        # Header dài hơn phần đã đọc: đọc lại từ file (vẫn dừng sau tag cuối)
+        f.seek(0)
+        stopped[0] = False
+        return read_partial(f, stop_when=stop_after_last_tag, force=True,
+                            specific_tags=specific_tags)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Giải mã pixel DICOM một lần (pydicom, dự phòng bằng GDCM) kèm các metadata cần hiển thị
+
+decode_dicom đọc file đúng một lần: pixel và metadata (kích thước, modality,
+rescale...) đều lấy từ cùng một lần đọc, không cần đọc lại header bằng
+pydicom. Khi pydicom không giải mã được (vd. cú pháp nén không có plugin),
+GDCM được dùng trực tiếp: buffer (dạng str) của GDCM được chuyển lại thành
+bytes (một lần sao chép, không tránh được qua binding Python của GDCM) rồi
+xem qua np.frombuffer, và metadata được lấy từ chính dataset mà GDCM đã đọc.
+
+Ảnh trả về là float32 đã áp dụng RescaleSlope/RescaleIntercept (tại chỗ, trên
+bản float32 duy nhất). Với ảnh nhiều frame chỉ frame đầu tiên được trả về.
+"""
+
+import math
+import numpy as np
+import pydicom
+
+try:
+    import gdcm
+except ImportError:
+    gdcm = None
+
+def _gdcm_dtypes():
+    # Kiểu numpy tương ứng với PixelFormat của GDCM (12 bit được GDCM trả về dạng 16 bit)
+    if gdcm is None:
+        return {}
+    names = {
+        'INT8': np.int8, 'UINT8': np.uint8,
+        'INT12': np.int16, 'UINT12': np.uint16,
+        'INT16': np.int16, 'UINT16': np.uint16,
+        'INT32': np.int32, 'UINT32': np.uint32,
+        'FLOAT16': np.float16, 'FLOAT32': np.float32, 'FLOAT64': np.float64
+    }
+    return {getattr(gdcm.PixelFormat, name): dtype for name, dtype in names.items()
+            if hasattr(gdcm.PixelFormat, name)}
+
+# {PixelFormat scalar type của GDCM: kiểu numpy}
+GDCM_DTYPES = _gdcm_dtypes()
+
+def _float_or(value, default):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def decode_with_pydicom(file_path):
+    """Giải mã bằng pydicom, trả về (mảng pixel gốc, info)"""
+    dcm = pydicom.dcmread(file_path, force=True)
+    if 'PixelData' not in dcm:
+        raise ValueError("Không có pixel data")
+    pixels = dcm.pixel_array
+    info = {
+        'Rows': int(getattr(dcm, 'Rows', pixels.shape[0])),
+        'Columns': int(getattr(dcm, 'Columns', pixels.shape[1])),
+        'NumberOfFrames': int(_float_or(getattr(dcm, 'NumberOfFrames', 1), 1)),
+        'Modality': str(getattr(dcm, 'Modality', 'N/A')),
+        'PhotometricInterpretation': str(getattr(dcm, 'PhotometricInterpretation', '')),
+        'RescaleSlope': _float_or(getattr(dcm, 'RescaleSlope', 1), 1.0),
+        'RescaleIntercept': _float_or(getattr(dcm, 'RescaleIntercept', 0), 0.0),
+        'Decoder': 'pydicom'
+    }
+    return pixels, info
+
+def decode_with_gdcm(file_path):
+    """Giải mã trực tiếp bằng GDCM, trả về (mảng pixel gốc, info)"""
+    if gdcm is None:
+        raise ImportError("Chưa cài đặt GDCM: pip install gdcm")
+
+    reader = gdcm.ImageReader()
+    reader.SetFileName(file_path)
+    if not reader.Read():
+        raise ValueError("GDCM không thể đọc file")
+
+    image = reader.GetImage()
+    pixel_format = image.GetPixelFormat()
+    dtype = GDCM_DTYPES.get(pixel_format.GetScalarType())
+    if dtype is None:
+        raise ValueError(f"Định dạng pixel không hỗ trợ: {pixel_format.GetScalarTypeAsString()}")
+
+    dims = image.GetDimensions()
+    columns, rows = int(dims[0]), int(dims[1])
+    frames = int(dims[2]) if len(dims) > 2 and dims[2] else 1
+    samples = pixel_format.GetSamplesPerPixel()
+    shape = ((frames,) if frames > 1 else ()) + (rows, columns) + ((samples,) if samples > 1 else ())
+
+    # GDCM trả buffer dạng str, đổi lại sang bytes (một bản sao) rồi xem bằng numpy không sao chép thêm
+    buffer = image.GetBuffer().encode('utf-8', 'surrogateescape')
+    pixels = np.frombuffer(buffer, dtype=dtype)
+    if pixels.size < math.prod(shape):
+        raise ValueError(f"Buffer GDCM ({pixels.size} pixel) nhỏ hơn kích thước ảnh {shape}")
+    pixels = pixels[:math.prod(shape)].reshape(shape)
+
+    # Metadata lấy từ dataset GDCM đã đọc, không đọc lại file
+    string_filter = gdcm.StringFilter()
+    string_filter.SetFile(reader.GetFile())
+    modality = string_filter.ToString(gdcm.Tag(0x0008, 0x0060)).strip()
+    info = {
+        'Rows': rows,
+        'Columns': columns,
+        'NumberOfFrames': frames,
+        'Modality': modality or 'N/A',
+        'PhotometricInterpretation': str(image.GetPhotometricInterpretation()).strip(),
+        'RescaleSlope': _float_or(image.GetSlope(), 1.0),
+        'RescaleIntercept': _float_or(image.GetIntercept(), 0.0),
+        'Decoder': 'gdcm'
+    }
+    return pixels, info
+
+def decode_dicom(file_path):
+    """
+    Giải mã file DICOM một lần, trả về (ảnh float32 đã rescale, info)
+
+    info gồm Rows, Columns, NumberOfFrames, Modality, PhotometricInterpretation,
+    RescaleSlope, RescaleIntercept và Decoder ('pydicom' hoặc 'gdcm'). Báo
+    ValueError nếu cả pydicom và GDCM đều không giải mã được.
+    """
+    try:
+        pixels, info = decode_with_pydicom(file_path)
+    except Exception as e1:
+        if gdcm is None:
+            raise ValueError(f"pydicom: {e1} (chưa cài đặt GDCM)")
+        try:
+            pixels, info = decode_with_gdcm(file_path)
+        except Exception as e2:
+            raise ValueError(f"pydicom: {e1}; GDCM: {e2}")
+
+    if info['NumberOfFrames'] > 1:
+        pixels = pixels[0]
+
+    # Bản sao float32 duy nhất, rescale được áp dụng tại chỗ trên bản này
+    image = pixels.astype(np.float32)
+    if info['RescaleSlope'] != 1:
+        image *= info['RescaleSlope']
+    if info['RescaleIntercept'] != 0:
+        image += info['RescaleIntercept']
+    return image, info
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vẽ và lưu biểu đồ cho DicomAnalyzer (không cần màn hình)
+
+Mỗi biểu đồ được mô tả bằng một tuple (loại, tên file, dữ liệu), trong đó dữ
+liệu đã được tổng hợp sẵn ở tiến trình chính (thống kê boxplot, histogram đã
+chia bin, bảng đếm...) nên rất nhỏ so với bảng chi tiết. render_figures vẽ
+các biểu đồ tuần tự hoặc song song bằng ProcessPoolExecutor, luôn dùng
+backend Agg của matplotlib, và lưu ra PNG (theo dpi), SVG hoặc HTML (SVG
+nhúng trong trang HTML).
+
+Khi có quá nhiều nhãn (hàng nghìn cặp bệnh nhân-ngày), chỉ một phần nhãn trục
+x được vẽ và heatmap không ghi số vào từng ô, vì vẽ chữ là phần chậm nhất.
+"""
+
+import os
+import io
+import math
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib import cbook
+import numpy as np
+import seaborn as sns
+from concurrent.futures import ProcessPoolExecutor
+
+# Các định dạng file biểu đồ được hỗ trợ
+PLOT_FORMATS = ['png', 'svg', 'html']
+
+# Độ phân giải mặc định của file PNG
+DEFAULT_DPI = 300
+
+# Số nhãn trục x tối đa được vẽ trên biểu đồ cột
+MAX_TICK_LABELS = 60
+
+# Số ô tối đa của heatmap còn ghi giá trị vào từng ô
+MAX_ANNOTATED_CELLS = 400
+
+# Số giá trị tối đa dùng để ước lượng đường KDE của histogram
+KDE_SAMPLE_SIZE = 10000
+
+# Số điểm outlier (đã làm tròn) tối đa vẽ trên mỗi hộp của boxplot
+MAX_FLIERS = 2000
+
+# ---------------------------------------------------------------------------
+# Tổng hợp dữ liệu trước khi vẽ (chạy ở tiến trình chính)
+# ---------------------------------------------------------------------------
+
+def box_stats(values, label, decimals=3):
+    """
+    Thống kê boxplot (như seaborn/matplotlib, whisker 1.5 IQR) của một nhóm
+
+    Các điểm outlier được làm tròn đến decimals chữ số và bỏ trùng, tối đa
+    MAX_FLIERS điểm, nên không phải vẽ từng file.
+    """
+    stats = cbook.boxplot_stats(np.asarray(values, dtype=float), whis=1.5, labels=[label])[0]
+    fliers = np.unique(np.round(stats['fliers'], decimals))
+    if len(fliers) > MAX_FLIERS:
+        fliers = fliers[np.linspace(0, len(fliers) - 1, MAX_FLIERS).astype(int)]
+    stats['fliers'] = fliers
+    return stats
+
+def histogram_data(values, bins=30, seed=0):
+    """Histogram đã chia bin và đường KDE (ước lượng trên mẫu) của một dãy giá trị"""
+    values = np.asarray(values, dtype=float)
+    counts, edges = np.histogram(values, bins=bins)
+    data = {'counts': counts, 'edges': edges, 'kde_x': None, 'kde_y': None}
+
+    sample = values
+    if len(sample) > KDE_SAMPLE_SIZE:
+        sample = np.random.default_rng(seed).choice(values, KDE_SAMPLE_SIZE, replace=False)
+    if len(sample) > 1 and np.std(sample) > 0:
+        from scipy.stats import gaussian_kde
+        try:
+            kde = gaussian_kde(sample)
+            kde_x = np.linspace(edges[0], edges[-1], 200)
+            # Đổi mật độ sang số lượng file mỗi bin (giống kde=True của seaborn)
+            data['kde_x'] = kde_x
+            data['kde_y'] = kde(kde_x) * len(values) * (edges[1] - edges[0])
+        except np.linalg.LinAlgError:
+            pass
+    return data
+
+# ---------------------------------------------------------------------------
+# Các hàm vẽ (chạy ở tiến trình con hoặc tiến trình chính), trả về Figure
+# ---------------------------------------------------------------------------
+
+def _thin_labels(ax, positions, labels):
+    """Chỉ vẽ tối đa MAX_TICK_LABELS nhãn trục x, cách đều nhau"""
+    step = max(1, math.ceil(len(labels) / MAX_TICK_LABELS))
+    ax.set_xticks(list(positions)[::step])
+    ax.set_xticklabels(list(labels)[::step], rotation=45, ha='right')
+
+def draw_boxplot(data):
+    fig, ax = plt.subplots(figsize=(12, 7))
+    artists = ax.bxp(data['stats'], patch_artist=True)
+    for patch, color in zip(artists['boxes'], sns.color_palette(n_colors=len(data['stats']))):
+        patch.set_facecolor(color)
+    ax.set_title(data['title'])
+    ax.set_xlabel(data['xlabel'])
+    ax.set_ylabel(data['ylabel'])
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+    fig.tight_layout()
+    return fig
+
+def draw_histogram(data):
+    fig, ax = plt.subplots(figsize=(12, 7))
+    hist = data['hist']
+    ax.stairs(hist['counts'], hist['edges'], fill=True, alpha=0.5)
+    if hist['kde_x'] is not None:
+        ax.plot(hist['kde_x'], hist['kde_y'])
+    for x, color, linestyle, label in data.get('lines', []):
+        ax.axvline(x=x, color=color, linestyle=linestyle, label=label)
+    ax.set_title(data['title'])
+    ax.set_xlabel(data['xlabel'])
+    ax.set_ylabel(data['ylabel'])
+    if data.get('lines'):
+        ax.legend()
+    ax.grid(True, alpha=0.3)
+    fig.tight_layout()
+    return fig
+
+def draw_grouped_bars(data):
+    """Biểu đồ cột nhóm: data['counts'] là {nhóm (hue): {x: giá trị}}"""
+    fig, ax = plt.subplots(figsize=(14, 7))
+    x_values = data['x_order']
+    groups = list(data['counts'])
+    width = 0.8 / max(1, len(groups))
+    positions = np.arange(len(x_values))
+    for i, (group, color) in enumerate(zip(groups, sns.color_palette(n_colors=len(groups)))):
+        heights = [data['counts'][group].get(x, 0) for x in x_values]
+        ax.bar(positions - 0.4 + width * (i + 0.5), heights, width=width, label=group, color=color)
+    _thin_labels(ax, positions, x_values)
+    ax.set_title(data['title'])
+    ax.set_xlabel(data['xlabel'])
+    ax.set_ylabel(data['ylabel'])
+    ax.legend(title=data.get('legend_title'))
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+    fig.tight_layout()
+    return fig
+
+def draw_paired_bars(data):
+    """Hai cột cạnh nhau cho mỗi nhãn (vd. CT và CBCT theo bệnh nhân-ngày)"""
+    fig, ax = plt.subplots(figsize=(12, 7))
+    barwidth = 0.35
+    r1 = np.arange(len(data['labels']))
+    for offset, (values, label, color) in zip([0, barwidth], data['series']):
+        ax.bar(r1 + offset, values, width=barwidth, label=label, color=color)
+    _thin_labels(ax, r1 + barwidth / 2, data['labels'])
+    ax.set_xlabel(data['xlabel'])
+    ax.set_ylabel(data['ylabel'])
+    ax.set_title(data['title'])
+    ax.legend()
+    fig.tight_layout()
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+    return fig
+
+def draw_heatmap(data):
+    fig = plt.figure(figsize=(10, 8))
+    table = data['table']
+    annot = table.size <= MAX_ANNOTATED_CELLS
+    sns.heatmap(table, annot=annot, cmap=data['cmap'], fmt=data['fmt'],
+                linewidths=data.get('linewidths', 0), xticklabels='auto', yticklabels='auto')
+    plt.title(data['title'])
+    fig.tight_layout()
+    return fig
+
+RENDERERS = {
+    'boxplot': draw_boxplot,
+    'histogram': draw_histogram,
+    'grouped_bars': draw_grouped_bars,
+    'paired_bars': draw_paired_bars,
+    'heatmap': draw_heatmap
+}
+
+# ---------------------------------------------------------------------------
+# Lưu file
+# ---------------------------------------------------------------------------
+
+def save_figure(fig, output_dir, name, plot_format='png', dpi=DEFAULT_DPI):
+    """Lưu Figure ra output_dir/name.<định dạng>, đóng Figure và trả về đường dẫn"""
+    if plot_format not in PLOT_FORMATS:
+        raise ValueError(f"Định dạng biểu đồ không hợp lệ: {plot_format}")
+    path = os.path.join(output_dir, f"{name}.{plot_format}")
+    try:
+        if plot_format == 'html':
+            buffer = io.StringIO()
+            fig.savefig(buffer, format='svg', bbox_inches='tight')
+            svg = buffer.getvalue()
+            svg = svg[svg.index('<svg'):]
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>'
+                        f'{name}</title></head>\n<body>\n{svg}\n</body>\n</html>\n')
+        else:
+            fig.savefig(path, format=plot_format, dpi=dpi, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+    return path
+
+def _render_one(kind, name, data, output_dir, plot_format, dpi):
+    return save_figure(RENDERERS[kind](data), output_dir, name, plot_format, dpi)
+
+def render_figures(figures, output_dir, plot_format='png', dpi=DEFAULT_DPI, jobs=1):
+    """
+    Vẽ và lưu các biểu đồ
+
+    Parameters:
+    figures (list): Các tuple (loại trong RENDERERS, tên file không đuôi, dữ liệu)
+    output_dir (str): Thư mục lưu biểu đồ
+    plot_format (str): 'png', 'svg' hoặc 'html'
+    dpi (int): Độ phân giải file PNG
+    jobs (int): Số tiến trình vẽ song song (1 = tuần tự)
+
+    Trả về list (tên, đường dẫn hoặc None, lỗi hoặc None) theo thứ tự figures.
+    """
+    results = []
+    if jobs <= 1 or len(figures) <= 1:
+        for kind, name, data in figures:
+            try:
+                results.append((name, _render_one(kind, name, data, output_dir, plot_format, dpi), None))
+            except Exception as e:
+                results.append((name, None, str(e)))
+        return results
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(figures))) as executor:
+        futures = [
+            executor.submit(_render_one, kind, name, data, output_dir, plot_format, dpi)
+            for kind, name, data in figures
+        ]
+        for (kind, name, data), future in zip(figures, futures):
+            try:
+                results.append((name, future.result(), None))
+            except Exception as e:
+                results.append((name, None, str(e)))
+    return results
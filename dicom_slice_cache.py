@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bộ đệm ảnh theo dung lượng (LRU) và luồng tải trước lát cắt cho các trình xem DICOM
+
+LRUByteCache giữ các mảng pixel đã giải mã nhưng giới hạn theo tổng số byte
+(không theo số ảnh), nên series dài hay ảnh CBCT 1280x1280 đều không làm bộ
+nhớ tăng mãi: ảnh lâu không dùng nhất bị bỏ trước. Có thể ghim một tập khóa
+(vd. các ảnh của series đang xem): khóa được ghim chỉ bị bỏ khi mọi khóa khác
+đã bị bỏ mà vẫn vượt dung lượng. Bộ đệm đếm số lần hit/miss của get().
+
+SlicePrefetcher chạy một luồng nền giải mã trước các lát cắt kế tiếp theo
+hướng đang cuộn và đưa vào bộ đệm, nên khi thanh trượt tới lát cắt đó ảnh đã
+sẵn sàng. Mỗi yêu cầu mới thay thế các yêu cầu cũ chưa xử lý (người dùng đã
+cuộn đi chỗ khác thì không cần tải nữa).
+"""
+
+import threading
+from collections import OrderedDict
+
+# Dung lượng bộ đệm mặc định (MB)
+DEFAULT_CACHE_MB = 512
+
+# Số lát cắt tải trước theo hướng cuộn (và một nửa số đó theo hướng ngược lại)
+DEFAULT_PREFETCH_SLICES = 8
+
+def _nbytes(value):
+    # Dung lượng của mảng numpy, hoặc tổng dung lượng các mảng trong tuple (giá trị khác tính là 0)
+    if isinstance(value, tuple):
+        return sum(_nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+class LRUByteCache:
+    """Bộ đệm LRU an toàn luồng, giới hạn theo tổng dung lượng (byte) của các giá trị"""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._pinned = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key, default=None):
+        """Lấy giá trị và đánh dấu là vừa dùng"""
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        """Thêm giá trị, bỏ các giá trị lâu không dùng nhất nếu vượt dung lượng"""
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= _nbytes(self._items.pop(key))
+            # Giá trị lớn hơn cả bộ đệm thì không lưu
+            if size > self.max_bytes:
+                return
+            self._items[key] = value
+            self.nbytes += size
+            if self.nbytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Bỏ các khóa lâu không dùng nhất, khóa được ghim chỉ bị bỏ sau cùng
+        for key in [k for k in self._items if k not in self._pinned]:
+            if self.nbytes <= self.max_bytes:
+                return
+            self.nbytes -= _nbytes(self._items.pop(key))
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+
+    def set_pinned(self, keys):
+        """Thay tập khóa được ghim (các khóa chưa có trong bộ đệm cũng được ghim khi thêm vào)"""
+        with self._lock:
+            self._pinned = set(keys)
+
+    @property
+    def pinned_count(self):
+        """Số khóa được ghim đang có trong bộ đệm"""
+        with self._lock:
+            return sum(1 for key in self._pinned if key in self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+class SlicePrefetcher:
+    """Luồng nền tải trước các lát cắt lân cận vào LRUByteCache"""
+
+    def __init__(self, load_func, cache, count, lookahead=DEFAULT_PREFETCH_SLICES):
+        """
+        Parameters:
+        load_func (callable): Hàm load_func(idx) trả về mảng pixel của lát cắt idx
+        cache (LRUByteCache): Bộ đệm dùng chung với luồng giao diện
+        count (int): Số lát cắt của series
+        lookahead (int): Số lát cắt tải trước theo hướng cuộn
+        """
+        self.load_func = load_func
+        self.cache = cache
+        self.count = count
+        self.lookahead = lookahead
+        self._pending = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, idx, direction=1):
+        """
+        Yêu cầu tải trước quanh lát cắt idx
+
+        direction là +1 hoặc -1 (hướng cuộn); các lát cắt phía trước được tải
+        trước, rồi mới tới vài lát cắt phía sau. Thay thế yêu cầu cũ chưa xử lý.
+        """
+        direction = 1 if direction >= 0 else -1
+        ahead = [idx + direction * i for i in range(1, self.lookahead + 1)]
+        behind = [idx - direction * i for i in range(1, self.lookahead // 2 + 1)]
+        wanted = [i for i in ahead + behind if 0 <= i < self.count and i not in self.cache]
+        with self._condition:
+            self._pending = wanted
+            self._condition.notify()
+
+    def stop(self):
+        """Dừng luồng nền (các lát cắt đang tải dở vẫn được tải xong)"""
+        with self._condition:
+            self._stopped = True
+            self._pending = []
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                idx = self._pending.pop(0)
+            if idx in self.cache:
+                continue
+            try:
+                value = self.load_func(idx)
+            except Exception:
+                continue
+            self.cache.put(idx, value)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Các thống kê gộp được (mergeable) cho phân tích DICOM theo luồng
+
+Khi kho dữ liệu lớn hơn bộ nhớ, DicomAnalyzer đọc file theo từng lô và chỉ
+cập nhật các thống kê dưới đây thay vì giữ bảng chi tiết tất cả các file:
+- RunningStats: số lượng, tổng, trung bình và phương sai (Welford/Chan), min/max
+- QuantileSketch: phân vị gần đúng với sai số tương đối cố định (bin theo log)
+- GroupAggregate: các thống kê trên cộng với histogram độ phân giải
+
+Mỗi thống kê có merge(), nên có thể tính riêng trên từng lô rồi gộp lại, và
+bộ nhớ chỉ phụ thuộc vào số nhóm (bệnh nhân, ngày, modality) chứ không phụ
+thuộc vào số file.
+"""
+
+import math
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+# Sai số tương đối mặc định của phân vị gần đúng (1%)
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+class RunningStats:
+    """Số lượng, tổng, trung bình, phương sai, min và max cập nhật theo lô"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values):
+        """Thêm một lô giá trị (list hoặc numpy array)"""
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        batch_mean = values.mean()
+        self._combine(len(values), values.sum(), batch_mean, ((values - batch_mean) ** 2).sum(),
+                      values.min(), values.max())
+
+    def merge(self, other):
+        """Gộp thống kê của một RunningStats khác vào thống kê này"""
+        if other.count:
+            self._combine(other.count, other.total, other.mean, other.m2, other.min, other.max)
+
+    def _combine(self, count, total, mean, m2, minimum, maximum):
+        # Công thức gộp phương sai của Chan et al.
+        new_count = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / new_count
+        self.m2 += m2 + delta * delta * self.count * count / new_count
+        self.count = new_count
+        self.total += float(total)
+        self.min = min(self.min, float(minimum))
+        self.max = max(self.max, float(maximum))
+
+    def variance(self, ddof=0):
+        """Phương sai (ddof=0 giống std(ddof=0) của pandas)"""
+        if self.count <= ddof:
+            return math.nan
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return math.sqrt(self.variance(ddof))
+
+class QuantileSketch:
+    """
+    Phân vị gần đúng cho các giá trị không âm (kích thước file)
+
+    Mỗi giá trị dương x được đếm vào bin ceil(log(x) / log(gamma)) với
+    gamma = (1 + a) / (1 - a), nên phân vị trả về có sai số tương đối không quá
+    a. Số bin chỉ phụ thuộc vào khoảng giá trị (vài trăm bin cho kích thước
+    từ KB đến GB), và hai sketch cùng a được gộp bằng cách cộng số đếm.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = Counter()
+        self.zero_count = 0
+        self.count = 0
+
+    def update(self, values):
+        """Thêm một lô giá trị"""
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        if len(positive):
+            keys, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(np.int64),
+                                     return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                self.bins[key] += count
+
+    def merge(self, other):
+        """Gộp một sketch khác (cùng relative_accuracy) vào sketch này"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Không thể gộp QuantileSketch có sai số tương đối khác nhau")
+        self.bins.update(other.bins)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def _quantile_key(self, q):
+        # Bin chứa phân vị q (None là bin các giá trị 0)
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return None
+        cumulative = self.zero_count
+        for key in sorted(self.bins):
+            cumulative += self.bins[key]
+            if cumulative > rank:
+                return key
+        return max(self.bins)
+
+    def quantile(self, q):
+        """Giá trị gần đúng tại phân vị q (0..1), NaN nếu chưa có dữ liệu"""
+        if self.count == 0:
+            return math.nan
+        key = self._quantile_key(q)
+        if key is None:
+            return 0.0
+        # Điểm giữa (theo sai số tương đối) của bin (gamma^(key-1), gamma^key]
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile_bounds(self, q):
+        """
+        Khoảng (min, max) chắc chắn chứa phân vị q, tức hai biên của bin chứa nó
+
+        Dùng biên dưới của Q1 và biên trên của Q3 làm ngưỡng IQR thì các file
+        cùng bin với phân vị không bị đánh dấu nhầm là outlier.
+        """
+        if self.count == 0:
+            return math.nan, math.nan
+        key = self._quantile_key(q)
+        if key is None:
+            return 0.0, 0.0
+        return self.gamma ** (key - 1), self.gamma ** key
+
+class GroupAggregate:
+    """Thống kê kích thước file và histogram độ phân giải của một nhóm file"""
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.size = RunningStats()
+        self.size_sketch = QuantileSketch(relative_accuracy)
+        # Counter giữ thứ tự xuất hiện, nên khóa đầu tiên là độ phân giải của file đầu tiên
+        self.resolutions = Counter()
+
+    @property
+    def count(self):
+        return self.size.count
+
+    def update(self, sizes, resolutions):
+        """Thêm một lô file (kích thước MB và độ phân giải "RowsxColumns")"""
+        self.size.update(sizes)
+        self.size_sketch.update(sizes)
+        self.resolutions.update(resolutions)
+
+    def merge(self, other):
+        self.size.merge(other.size)
+        self.size_sketch.merge(other.size_sketch)
+        self.resolutions.update(other.resolutions)
+
+    def first_resolution(self):
+        return next(iter(self.resolutions), None)
+
+    def mode_resolution(self):
+        """Độ phân giải phổ biến nhất (nếu bằng nhau, lấy độ phân giải xuất hiện trước)"""
+        most_common = self.resolutions.most_common(1)
+        return most_common[0][0] if most_common else None
+
+class StreamingAggregates:
+    """Các GroupAggregate theo (bệnh nhân, ngày, modality), cập nhật theo từng lô file"""
+
+    KEYS = ['patient_id', 'study_date', 'modality']
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        # {(bệnh nhân, ngày, modality): GroupAggregate} theo thứ tự xuất hiện
+        self.groups = {}
+
+    @property
+    def file_count(self):
+        return sum(group.count for group in self.groups.values())
+
+    def _group(self, key):
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = GroupAggregate(self.relative_accuracy)
+        return group
+
+    def update(self, df):
+        """Cập nhật từ DataFrame của một lô file (cùng các cột như all_files_df)"""
+        if len(df) == 0:
+            return
+        keys = df[self.KEYS].astype(str)
+        grouped = df.groupby([keys[col] for col in self.KEYS], sort=False)
+        for key, group in grouped:
+            self._group(key).update(group['file_size'].values, group['resolution'].astype(str))
+
+    def merge(self, other):
+        """Gộp các nhóm của một StreamingAggregates khác (vd. tính ở tiến trình khác)"""
+        for key, group in other.groups.items():
+            self._group(key).merge(group)
+
+    def group_table(self):
+        """
+        DataFrame một dòng cho mỗi (bệnh nhân, ngày, modality) theo thứ tự xuất
+        hiện: count, avg_size và resolution (độ phân giải của file đầu tiên)
+        """
+        rows = [
+            {'patient_id': patient_id, 'study_date': study_date, 'modality': modality,
+             'count': group.count, 'avg_size': group.size.mean, 'resolution': group.first_resolution()}
+            for (patient_id, study_date, modality), group in self.groups.items()
+        ]
+        return pd.DataFrame(rows, columns=self.KEYS + ['count', 'avg_size', 'resolution'])
+
+    def by_modality(self):
+        """Gộp các nhóm thành {modality: GroupAggregate} theo thứ tự xuất hiện"""
+        modalities = {}
+        for (_, _, modality), group in self.groups.items():
+            if modality not in modalities:
+                modalities[modality] = GroupAggregate(self.relative_accuracy)
+            modalities[modality].merge(group)
+        return modalities
+
+    def modality_stats(self):
+        """
+        DataFrame thống kê theo modality (index là modality): count, mean, std
+        (ddof=0), q1, q3 và mode_resolution, dùng làm ngưỡng outlier
+
+        q1 và q3 là biên ngoài của bin chứa phân vị (xem quantile_bounds), nên
+        khoảng IQR có thể rộng hơn giá trị chính xác tối đa relative_accuracy.
+        """
+        stats = {
+            modality: {
+                'count': group.count,
+                'mean': group.size.mean,
+                'std': group.size.std(ddof=0),
+                'q1': group.size_sketch.quantile_bounds(0.25)[0],
+                'q3': group.size_sketch.quantile_bounds(0.75)[1],
+                'mode_resolution': group.mode_resolution()
+            }
+            for modality, group in self.by_modality().items()
+        }
+        return pd.DataFrame.from_dict(stats, orient='index',
+                                      columns=['count', 'mean', 'std', 'q1', 'q3', 'mode_resolution'])
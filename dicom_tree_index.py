@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chỉ mục cây thư mục (thư mục con và file .dcm) lưu trên đĩa cho các công cụ xem
+
+Mỗi thư mục đã quét được lưu cùng mtime của nó. Thêm, xóa hoặc đổi tên một
+mục bên trong thư mục đều làm thay đổi mtime của chính thư mục đó, nên khi
+mtime không đổi thì danh sách thư mục con và file vẫn đúng và không cần
+os.listdir lại. Mỗi lần làm mới chỉ cần stat từng thư mục, và chỉ các thư mục
+có mtime thay đổi mới được liệt kê lại. Có thể làm mới riêng từng nhánh (vd.
+một bệnh nhân), kể cả từ luồng nền: mọi thao tác đều được khóa.
+
+Chỉ mục được lưu dạng JSON trong thư mục gốc (.dicom_tree_index.json), đường
+dẫn được lưu tương đối với thư mục gốc. save() chỉ giữ khóa trong lúc chụp
+lại danh sách entry; việc ghi JSON diễn ra ngoài khóa, nên các luồng đang tra
+cứu chỉ mục không phải chờ. Nên gọi save() thưa (vd. sau lần quét đầu và khi
+đóng công cụ) thay vì sau mỗi lần làm mới.
+"""
+
+import os
+import json
+import threading
+
+# Tên file chỉ mục trong thư mục gốc
+INDEX_FILENAME = '.dicom_tree_index.json'
+
+# Tăng khi thay đổi định dạng file chỉ mục (chỉ mục cũ sẽ bị bỏ qua)
+INDEX_VERSION = 1
+
+# Đuôi file được ghi vào chỉ mục
+DICOM_EXTENSION = '.dcm'
+
+class DirectoryTreeIndex:
+    """Chỉ mục thư mục con và file .dcm theo từng thư mục, kiểm tra bằng mtime"""
+
+    def __init__(self, root_dir, index_path=None):
+        """
+        Parameters:
+        root_dir (str): Thư mục gốc (cấu trúc [bệnh nhân]/[CT|CBCT]/[ngày]/*.dcm)
+        index_path (str, optional): File chỉ mục, mặc định root_dir/.dicom_tree_index.json
+        """
+        self.root_dir = root_dir
+        self.index_path = index_path or os.path.join(root_dir, INDEX_FILENAME)
+        # {đường dẫn tương đối: {'mtime_ns', 'dirs', 'files'}}, '' là thư mục gốc
+        self.entries = self._load()
+        self.reused = 0
+        self.rescanned = 0
+        self._dirty = False
+        self._lock = threading.RLock()
+        # Tuần tự hóa các lần ghi file (dùng chung file tạm), tách khỏi khóa tra cứu
+        self._save_lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != INDEX_VERSION or data.get('root') != os.path.abspath(self.root_dir):
+            return {}
+        return data.get('entries', {})
+
+    def save(self):
+        """Ghi chỉ mục ra đĩa nếu có thay đổi (ghi file tạm rồi đổi tên)"""
+        with self._save_lock:
+            # Entry không bao giờ bị sửa tại chỗ (chỉ thay thế hoặc xóa), nên bản sao
+            # nông là ảnh chụp nhất quán để ghi ngoài khóa
+            with self._lock:
+                if not self._dirty:
+                    return
+                entries = dict(self.entries)
+                self._dirty = False
+
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'version': INDEX_VERSION, 'root': os.path.abspath(self.root_dir),
+                               'entries': entries}, f)
+                os.replace(tmp_path, self.index_path)
+            except OSError as e:
+                print(f"Không thể ghi chỉ mục thư mục {self.index_path}: {e}")
+                with self._lock:
+                    self._dirty = True
+
+    def _abs(self, rel_path):
+        return os.path.join(self.root_dir, rel_path) if rel_path else self.root_dir
+
+    def _entry(self, rel_path):
+        # Entry của một thư mục: dùng lại nếu mtime không đổi, nếu không thì liệt kê lại
+        try:
+            mtime_ns = os.stat(self._abs(rel_path)).st_mtime_ns
+        except OSError:
+            return None
+        entry = self.entries.get(rel_path)
+        if entry is not None and entry['mtime_ns'] == mtime_ns:
+            self.reused += 1
+            return entry
+
+        dirs, files = [], []
+        with os.scandir(self._abs(rel_path)) as it:
+            for item in it:
+                # Không đi vào thư mục liên kết tượng trưng (có thể tạo vòng lặp), như os.walk
+                if item.is_dir(follow_symlinks=False):
+                    dirs.append(item.name)
+                elif item.name.endswith(DICOM_EXTENSION) and not item.name.startswith('.'):
+                    files.append(item.name)
+        entry = {'mtime_ns': mtime_ns, 'dirs': dirs, 'files': files}
+        self.entries[rel_path] = entry
+        self.rescanned += 1
+        self._dirty = True
+        return entry
+
+    def refresh(self, rel_path='', recursive=True):
+        """
+        Làm mới chỉ mục của rel_path và (nếu recursive) toàn bộ thư mục con
+
+        Trả về False nếu rel_path không tồn tại hoặc không đọc được.
+        """
+        with self._lock:
+            try:
+                root_entry = self._entry(rel_path)
+            except OSError as e:
+                print(f"Lỗi khi quét thư mục {self._abs(rel_path)}: {e}")
+                return False
+            if root_entry is None:
+                return False
+            if recursive:
+                self._refresh_subdirs(rel_path, root_entry)
+            else:
+                self._drop_removed_children(rel_path, root_entry)
+            return True
+
+    def _drop_removed_children(self, rel_path, entry):
+        # Bỏ các nhánh con không còn trong thư mục (khi chỉ làm mới một cấp)
+        prefix = os.path.join(rel_path, '') if rel_path else ''
+        current = set(entry['dirs'])
+        stale = [key for key in self.entries
+                 if key.startswith(prefix) and key != rel_path
+                 and key[len(prefix):].split(os.sep, 1)[0] not in current]
+        for key in stale:
+            del self.entries[key]
+        if stale:
+            self._dirty = True
+
+    def _refresh_subdirs(self, rel_path, root_entry):
+        # Làm mới mọi thư mục con, bỏ các thư mục đã bị xóa
+        seen = {rel_path}
+        stack = [os.path.join(rel_path, d) for d in root_entry['dirs']]
+        while stack:
+            current = stack.pop()
+            try:
+                entry = self._entry(current)
+            except OSError as e:
+                print(f"Lỗi khi quét thư mục {self._abs(current)}: {e}")
+                continue
+            if entry is None:
+                continue
+            seen.add(current)
+            stack.extend(os.path.join(current, d) for d in entry['dirs'])
+
+        prefix = os.path.join(rel_path, '') if rel_path else ''
+        stale = [key for key in self.entries if key.startswith(prefix) and key not in seen]
+        for key in stale:
+            del self.entries[key]
+        if stale:
+            self._dirty = True
+
+    def subdirs(self, rel_path=''):
+        """Tên các thư mục con của rel_path (theo chỉ mục)"""
+        with self._lock:
+            entry = self.entries.get(rel_path)
+            return list(entry['dirs']) if entry else []
+
+    def files(self, rel_path):
+        """Đường dẫn đầy đủ các file .dcm trực tiếp trong rel_path (theo chỉ mục)"""
+        with self._lock:
+            entry = self.entries.get(rel_path)
+            names = list(entry['files']) if entry else []
+        base = self._abs(rel_path)
+        return [os.path.join(base, name) for name in names]
+
+    def iter_files(self, rel_path=''):
+        """Duyệt đường dẫn đầy đủ mọi file .dcm trong rel_path và các thư mục con"""
+        stack = [rel_path]
+        while stack:
+            current = stack.pop()
+            yield from self.files(current)
+            stack.extend(os.path.join(current, d) for d in self.subdirs(current))
@@ -4,6 +4,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button, RadioButtons
 from datetime import datetime
+from dicom_header_cache import get_header_cache, versioned_namespace
+from dicom_slice_cache import DEFAULT_CACHE_MB, DEFAULT_PREFETCH_SLICES, LRUByteCache, SlicePrefetcher
 
 # Cấu hình để sử dụng GDCM cho giải nén DICOM
 try:
@@ -16,6 +18,14 @@ except ImportError:
     print("CẢNH BÁO: Không tìm thấy GDCM. Một số file DICOM nén có thể không đọc được.")
     print("Để cài đặt: pip install gdcm")
 
+# Namespace của script này trong bộ đệm header dùng chung
+# (tăng phiên bản khi read_metadata trả về các trường khác)
+HEADER_CACHE_NAMESPACE = versioned_namespace('viewer', 1)
+
+# Giá trị mặc định của LRUByteCache.get để phân biệt lát cắt chưa có trong bộ đệm với
+# lát cắt đã lưu là None (đọc lỗi)
+_MISSING = object()
+
 def load_dicom_paths_from_txt(txt_file_path):
     """Đọc danh sách đường dẫn đến các file DICOM từ file txt"""
     with open(txt_file_path, 'r') as f:
@@ -41,7 +51,14 @@ def try_read_dicom(path, stop_before_pixels=False):
             return None, errors
 
 def extract_metadata(path):
-    """Trích xuất chỉ metadata từ file DICOM"""
+    """Trích xuất chỉ metadata từ file DICOM (ưu tiên lấy từ bộ đệm header)"""
+    info = get_header_cache().get_or_compute(path, HEADER_CACHE_NAMESPACE, read_metadata)
+    if info is not None:
+        info['FilePath'] = path
+    return info
+
+def read_metadata(path):
+    """Đọc metadata trực tiếp từ file DICOM"""
     dcm, error = try_read_dicom(path, stop_before_pixels=True)
     if dcm is None:
         print(f"Lỗi khi đọc metadata từ {path}: {error}")
@@ -173,24 +190,22 @@ def try_load_pixel_data(path):
     except Exception as e:
         return None, str(e)
 
-def normalize_pixel_array(pixel_array, window_center=40, window_width=400):
-    """Chuẩn hóa giá trị pixel cho hiển thị"""
-    if pixel_array is None:
-        return np.ones((512, 512))  # Trả về ảnh trắng nếu không có dữ liệu
-    
-    # Thiết lập cửa sổ
-    min_val = window_center - window_width/2
-    max_val = window_center + window_width/2
-    
-    # Clip và chuẩn hóa giá trị pixel
-    pixel_array = np.clip(pixel_array, min_val, max_val)
-    normalized = (pixel_array - min_val) / (max_val - min_val)
-    
-    return normalized
+# Ảnh hiển thị khi không đọc được pixel: giá trị rất lớn luôn nằm trên cửa sổ
+# nên được vẽ màu trắng với mọi window/level (như ảnh trắng trước đây)
+BLANK_IMAGE = np.full((512, 512), np.finfo(np.float32).max, dtype=np.float32)
+
+def window_limits(window_center, window_width):
+    """Giới hạn (vmin, vmax) của cửa sổ hiển thị"""
+    return window_center - window_width/2, window_center + window_width/2
 
 class DicomViewer:
-    def __init__(self, ct_paths, cbct_paths):
-        """Khởi tạo trình xem DICOM với đường dẫn đến ảnh CT và CBCT"""
+    def __init__(self, ct_paths, cbct_paths, cache_mb=DEFAULT_CACHE_MB, prefetch=DEFAULT_PREFETCH_SLICES):
+        """
+        Khởi tạo trình xem DICOM với đường dẫn đến ảnh CT và CBCT
+        
+        cache_mb là tổng dung lượng bộ đệm ảnh (chia đều cho CT và CBCT),
+        prefetch là số lát cắt được tải trước theo hướng cuộn (0 để tắt).
+        """
         self.ct_paths = ct_paths
         self.cbct_paths = cbct_paths
         
@@ -205,34 +220,65 @@ class DicomViewer:
         self.window_center = 40    # Window center (mặc định cho mô mềm)
         self.window_width = 400    # Window width (mặc định cho mô mềm)
         
-        # Khởi tạo bộ đệm ảnh
-        self.ct_cache = {}  # {index: pixel_array}
-        self.cbct_cache = {}
+        # Khởi tạo bộ đệm ảnh {index: pixel_array}, giới hạn theo dung lượng
+        cache_bytes = cache_mb * 1024 * 1024 // 2
+        self.ct_cache = LRUByteCache(cache_bytes)
+        self.cbct_cache = LRUByteCache(cache_bytes)
+        
+        # Luồng nền tải trước các lát cắt lân cận
+        self.ct_prefetcher = None
+        self.cbct_prefetcher = None
+        if prefetch > 0:
+            if ct_paths:
+                self.ct_prefetcher = SlicePrefetcher(lambda i: self.read_dicom_image(True, i),
+                                                     self.ct_cache, len(ct_paths), prefetch)
+            if cbct_paths:
+                self.cbct_prefetcher = SlicePrefetcher(lambda i: self.read_dicom_image(False, i),
+                                                       self.cbct_cache, len(cbct_paths), prefetch)
+        # Lát cắt được tải gần nhất (để biết hướng cuộn)
+        self._last_idx = {True: 0, False: 0}
         
         # Tạo giao diện
         self.create_ui()
     
+    def read_dicom_image(self, is_ct, idx):
+        """Đọc và giải mã một ảnh DICOM từ file (không dùng bộ đệm)"""
+        paths = self.ct_paths if is_ct else self.cbct_paths
+        pixel_array, error = try_load_pixel_data(paths[idx])
+        if error:
+            print(f"Lỗi khi tải {'CT' if is_ct else 'CBCT'} idx={idx}: {error}")
+            return None
+        return pixel_array
+    
     def load_dicom_image(self, is_ct, idx):
-        """Tải một ảnh DICOM từ đường dẫn, có sử dụng bộ đệm"""
+        """Tải một ảnh DICOM từ đường dẫn, có sử dụng bộ đệm và tải trước"""
         cache = self.ct_cache if is_ct else self.cbct_cache
         paths = self.ct_paths if is_ct else self.cbct_paths
         
-        # Nếu đã có trong bộ đệm thì trả về
-        if idx in cache:
-            return cache[idx]
-        
-        # Không thì tải mới
-        if idx < len(paths):
-            pixel_array, error = try_load_pixel_data(paths[idx])
-            if error:
-                print(f"Lỗi khi tải {'CT' if is_ct else 'CBCT'} idx={idx}: {error}")
-                pixel_array = None
-            
-            # Lưu vào bộ đệm
-            cache[idx] = pixel_array
-            return pixel_array
+        if idx >= len(paths):
+            return None
         
-        return None
+        # Nếu đã có trong bộ đệm (hoặc đã được tải trước) thì dùng lại, không thì tải mới.
+        # Chỉ gọi get một lần: luồng tải trước có thể bỏ idx khỏi bộ đệm giữa hai lần truy cập
+        pixel_array = cache.get(idx, _MISSING)
+        if pixel_array is _MISSING:
+            pixel_array = self.read_dicom_image(is_ct, idx)
+            cache.put(idx, pixel_array)
+        
+        # Tải trước các lát cắt tiếp theo theo hướng cuộn
+        prefetcher = self.ct_prefetcher if is_ct else self.cbct_prefetcher
+        if prefetcher is not None:
+            direction = -1 if idx < self._last_idx[is_ct] else 1
+            prefetcher.request(idx, direction)
+        self._last_idx[is_ct] = idx
+        
+        return pixel_array
+    
+    def close(self, event=None):
+        """Dừng các luồng tải trước khi đóng cửa sổ"""
+        for prefetcher in (self.ct_prefetcher, self.cbct_prefetcher):
+            if prefetcher is not None:
+                prefetcher.stop()
     
     def create_ui(self):
         """Tạo giao diện người dùng"""
@@ -241,6 +287,7 @@ class DicomViewer:
         
         # Tiêu đề
         self.fig.suptitle("So sánh ảnh CT lập kế hoạch và CBCT", fontsize=16)
+        self.fig.canvas.mpl_connect('close_event', self.close)
         
         # Thiết lập trục ảnh
         self.axes[0].set_title("CT lập kế hoạch điều trị")
@@ -251,9 +298,11 @@ class DicomViewer:
             ax.set_xticks([])
             ax.set_yticks([])
         
-        # Hiển thị ảnh trắng ban đầu
-        self.ct_img = self.axes[0].imshow(np.ones((512, 512)), cmap='gray', vmin=0, vmax=1)
-        self.cbct_img = self.axes[1].imshow(np.ones((512, 512)), cmap='gray', vmin=0, vmax=1)
+        # Hiển thị ảnh trắng ban đầu; ảnh giữ nguyên giá trị pixel gốc, cửa sổ
+        # hiển thị được áp dụng qua giới hạn màu (clim) của colormap
+        vmin, vmax = window_limits(self.window_center, self.window_width)
+        self.ct_img = self.axes[0].imshow(BLANK_IMAGE, cmap='gray', vmin=vmin, vmax=vmax)
+        self.cbct_img = self.axes[1].imshow(BLANK_IMAGE, cmap='gray', vmin=vmin, vmax=vmax)
         
         # Thêm thanh trượt cho CT
         ax_ct_slider = plt.axes([0.1, 0.1, 0.35, 0.03])
@@ -319,9 +368,8 @@ class DicomViewer:
         # Tải ảnh từ bộ đệm hoặc từ file
         pixel_array = self.load_dicom_image(True, idx)
         
-        # Chuẩn hóa và hiển thị
-        normalized = normalize_pixel_array(pixel_array, self.window_center, self.window_width)
-        self.ct_img.set_data(normalized)
+        # Hiển thị pixel gốc (cửa sổ đã nằm trong clim của ảnh)
+        self.ct_img.set_data(BLANK_IMAGE if pixel_array is None else pixel_array)
         
         # Cập nhật thông tin
         if idx < len(self.ct_paths):
@@ -345,9 +393,8 @@ class DicomViewer:
         # Tải ảnh từ bộ đệm hoặc từ file
         pixel_array = self.load_dicom_image(False, idx)
         
-        # Chuẩn hóa và hiển thị
-        normalized = normalize_pixel_array(pixel_array, self.window_center, self.window_width)
-        self.cbct_img.set_data(normalized)
+        # Hiển thị pixel gốc (cửa sổ đã nằm trong clim của ảnh)
+        self.cbct_img.set_data(BLANK_IMAGE if pixel_array is None else pixel_array)
         
         # Cập nhật thông tin
         if idx < len(self.cbct_paths):
@@ -362,8 +409,10 @@ class DicomViewer:
         self.window_center = self.wc_slider.val
         self.window_width = self.ww_slider.val
         
-        self.update_ct_slice(self.ct_idx or 0)
-        self.update_cbct_slice(self.cbct_idx or 0)
+        # Chỉ đổi giới hạn màu, không tính lại từ pixel gốc
+        vmin, vmax = window_limits(self.window_center, self.window_width)
+        self.ct_img.set_clim(vmin, vmax)
+        self.cbct_img.set_clim(vmin, vmax)
         self.update_window_info()
     
     def update_window_info(self):
@@ -374,21 +423,20 @@ class DicomViewer:
     
     def use_preset(self, label):
         """Sử dụng preset cửa sổ"""
+        window_center, window_width = self.window_center, self.window_width
         if label == 'Mô mềm':
-            self.window_center = 40
-            self.window_width = 400
+            window_center, window_width = 40, 400
         elif label == 'Phổi':
-            self.window_center = -600
-            self.window_width = 1500
+            window_center, window_width = -600, 1500
         elif label == 'Xương':
-            self.window_center = 400
-            self.window_width = 1800
+            window_center, window_width = 400, 1800
         elif label == 'Não':
-            self.window_center = 40
-            self.window_width = 80
+            window_center, window_width = 40, 80
         
-        self.wc_slider.set_val(self.window_center)
-        self.ww_slider.set_val(self.window_width)
+        # Mỗi set_val gọi update_window (đọc cả hai thanh trượt), nên phải giữ
+        # giá trị preset trong biến cục bộ trước khi đặt thanh trượt thứ nhất
+        self.wc_slider.set_val(window_center)
+        self.ww_slider.set_val(window_width)
         self.update_window(None)
     
     def sync_slices(self, event):
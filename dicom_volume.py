@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dựng khối 3D (volume) số nguyên từ một series DICOM, lưu đệm bằng file .npy (memmap)
+
+Series được sắp xếp chỉ bằng header (ImagePositionPatient, rồi InstanceNumber,
+giống load_dicom_series), sau đó từng lát cắt được giải mã thẳng vào một mảng
+liên tục đã áp dụng RescaleSlope/RescaleIntercept (đơn vị HU với CT). Volume
+là int16; nếu một lát cắt có giá trị vượt phạm vi int16 (vd. ảnh 16 bit không
+dấu của MR/CBCT), volume được chuyển sang int32 và giữ các lát cắt đã giải mã.
+Giá trị không bao giờ bị cắt bớt.
+
+Mảng được ghi thành file .volume_<hash>.npy cạnh file đầu tiên của series (tên
+theo thư mục và SeriesInstanceUID, nên khi thêm/bớt lát cắt file đệm được thay
+thế tại chỗ), kèm file .json ghi danh sách file nguồn cùng kích thước và mtime.
+Lần mở sau, nếu các file nguồn không đổi, volume được mở bằng
+np.load(mmap_mode='r'): gần như tức thì và chỉ các lát cắt đang xem mới được hệ
+điều hành nạp vào bộ nhớ.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pydicom
+from dicom_header_cache import file_fingerprint
+from dicom_header_reader import read_header
+
+# Các kiểu dữ liệu của volume theo thứ tự ưu tiên: int16 đủ cho HU của CT (-32768..32767),
+# int32 cho series có giá trị vượt phạm vi int16 sau rescale
+VOLUME_DTYPES = [np.int16, np.int32]
+
+# Tiền tố tên file đệm (bắt đầu bằng dấu chấm để không lẫn với file DICOM)
+VOLUME_CACHE_PREFIX = '.volume_'
+
+# Các tag dùng để sắp xếp lát cắt, đặt tên file đệm và kiểm tra kích thước ảnh
+SORT_KEYWORDS = ['SeriesInstanceUID', 'ImagePositionPatient', 'InstanceNumber', 'Rows', 'Columns']
+
+def read_sorted_headers(dicom_paths, keywords=()):
+    """
+    Đọc header (SORT_KEYWORDS và keywords) của các file và sắp xếp theo vị trí lát cắt
+
+    Trả về list (đường dẫn, header). Dùng ImagePositionPatient[2] nếu mọi file
+    đều có, nếu không thì InstanceNumber, nếu không nữa thì giữ nguyên thứ tự.
+    File không đọc được bị bỏ qua. Thêm keywords để dùng lại chính các header
+    này cho việc khác (vd. hiển thị thông tin) mà không phải đọc lại file.
+    """
+    keywords = SORT_KEYWORDS + [keyword for keyword in keywords if keyword not in SORT_KEYWORDS]
+    headers = []
+    for path in dicom_paths:
+        try:
+            headers.append((path, read_header(path, keywords)))
+        except Exception as e:
+            print(f"Không thể đọc file {path}: {e}")
+
+    try:
+        headers = sorted(headers, key=lambda item: float(item[1].ImagePositionPatient[2]))
+    except Exception:
+        try:
+            headers = sorted(headers, key=lambda item: float(item[1].InstanceNumber))
+        except Exception:
+            print("Không thể sắp xếp lát cắt theo vị trí, giữ nguyên thứ tự")
+
+    return headers
+
+def sort_series(dicom_paths):
+    """Sắp xếp các file của series theo vị trí lát cắt, chỉ đọc header (xem read_sorted_headers)"""
+    return [path for path, _ in read_sorted_headers(dicom_paths)]
+
+def _series_uid(headers):
+    # SeriesInstanceUID của series (ghép các UID nếu danh sách file gồm nhiều series)
+    return '|'.join(sorted({str(getattr(header, 'SeriesInstanceUID', '') or '') for _, header in headers}))
+
+def volume_cache_path(sorted_paths, series_uid=''):
+    """
+    Đường dẫn file .npy đệm của series
+
+    File nằm cạnh file đầu tiên, tên theo hash của thư mục và SeriesInstanceUID
+    (không theo danh sách file), nên dựng lại sau khi thêm/bớt lát cắt sẽ ghi
+    đè file đệm cũ thay vì tạo thêm file mới.
+    """
+    series_dir = os.path.dirname(os.path.abspath(sorted_paths[0]))
+    digest = hashlib.sha1(f"{series_dir}\n{series_uid}".encode('utf-8')).hexdigest()[:16]
+    return os.path.join(series_dir, f"{VOLUME_CACHE_PREFIX}{digest}.npy")
+
+def _fingerprints(sorted_paths):
+    return [list(file_fingerprint(path) or ()) for path in sorted_paths]
+
+def _meta_path(cache_path):
+    return os.path.splitext(cache_path)[0] + '.json'
+
+def _read_meta(cache_path):
+    try:
+        with open(_meta_path(cache_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"Không thể xóa file {path}: {e}")
+
+def _remove_stale_caches(cache_path, series_uid):
+    # Xóa các file đệm khác cùng thư mục của cùng series, hoặc theo định dạng cũ (tên theo
+    # danh sách file, không còn được dùng)
+    series_dir = os.path.dirname(cache_path)
+    try:
+        names = os.listdir(series_dir)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(series_dir, name)
+        if not (name.startswith(VOLUME_CACHE_PREFIX) and name.endswith('.npy')) or path == cache_path:
+            continue
+        meta = _read_meta(path)
+        if meta is None or meta.get('series_uid', series_uid) == series_uid:
+            _remove_files([path, _meta_path(path)])
+
+def _rescale(dcm):
+    return float(getattr(dcm, 'RescaleSlope', 1) or 1), float(getattr(dcm, 'RescaleIntercept', 0) or 0)
+
+def decode_slice(file_path, out):
+    """
+    Giải mã pixel của một file vào out (mảng số nguyên 2D), áp dụng rescale
+
+    Báo ValueError nếu file không phải ảnh 2D cùng kích thước với out, và
+    OverflowError nếu có giá trị vượt phạm vi kiểu dữ liệu của out (giá trị
+    không bao giờ bị cắt bớt).
+    """
+    dcm = pydicom.dcmread(file_path, force=True)
+    pixels = dcm.pixel_array
+    if pixels.shape != out.shape:
+        raise ValueError(f"Kích thước ảnh {pixels.shape} khác với series {out.shape}: {file_path}")
+
+    slope, intercept = _rescale(dcm)
+    if slope == 1 and intercept == 0 and np.can_cast(pixels.dtype, out.dtype):
+        out[...] = pixels
+        return
+
+    values = pixels.astype(np.float64)
+    values *= slope
+    values += intercept
+    np.rint(values, out=values)
+    info = np.iinfo(out.dtype)
+    if values.size and (values.min() < info.min or values.max() > info.max):
+        raise OverflowError(f"Giá trị pixel [{values.min():g}, {values.max():g}] vượt phạm vi {out.dtype}: {file_path}")
+    out[...] = values
+
+class SeriesVolume:
+    """Volume (số lát cắt, rows, columns) của một series và danh sách file đã sắp xếp"""
+
+    def __init__(self, paths, volume, cache_path=None, from_cache=False):
+        self.paths = paths
+        self.volume = volume
+        self.cache_path = cache_path
+        self.from_cache = from_cache
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return self.volume[idx]
+
+def open_cached_volume(headers):
+    """
+    Mở volume đã lưu nếu còn khớp với các file nguồn, nếu không trả về None
+
+    headers là list (đường dẫn, header) đã sắp xếp (xem read_sorted_headers).
+    """
+    if not headers:
+        return None
+    sorted_paths = [path for path, _ in headers]
+    cache_path = volume_cache_path(sorted_paths, _series_uid(headers))
+    meta = _read_meta(cache_path)
+    if meta is None:
+        return None
+    if (meta.get('paths') != [os.path.abspath(path) for path in sorted_paths]
+            or meta.get('fingerprints') != _fingerprints(sorted_paths)):
+        return None
+    try:
+        volume = np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if (volume.dtype not in VOLUME_DTYPES or volume.dtype.name != meta.get('dtype')
+            or volume.ndim != 3 or volume.shape[0] != len(sorted_paths)):
+        return None
+    return SeriesVolume(sorted_paths, volume, cache_path, from_cache=True)
+
+def _allocate_volume(shape, dtype, cache_path):
+    # Volume rỗng: memmap trên file tạm cạnh cache_path (ghi xong mới đổi tên, để không bao
+    # giờ mở phải file ghi dở), hoặc trong bộ nhớ nếu không có/không ghi được file đệm.
+    # Trả về (volume, đường dẫn file tạm hoặc None)
+    if cache_path:
+        tmp_path = f"{cache_path}.{os.getpid()}.{np.dtype(dtype).name}.tmp"
+        try:
+            return np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape), tmp_path
+        except OSError as e:
+            print(f"Không thể ghi file đệm volume ({e}), dựng volume trong bộ nhớ")
+    return np.empty(shape, dtype=dtype), None
+
+def load_series_volume(dicom_paths, cache=True, headers=None):
+    """
+    Sắp xếp series và trả về SeriesVolume, dùng file đệm .npy nếu có thể
+
+    Parameters:
+    dicom_paths (list): Các file của series (mỗi file một lát cắt 2D)
+    cache (bool): Đọc/ghi file đệm cạnh series (nếu không ghi được thư mục,
+        volume được dựng trong bộ nhớ)
+    headers (list, optional): Kết quả read_sorted_headers(dicom_paths) đã có,
+        để không phải đọc lại header
+
+    Báo ValueError nếu series rỗng, các lát cắt không cùng kích thước (vd.
+    RTIMAGE) hoặc giá trị pixel vượt phạm vi mọi kiểu trong VOLUME_DTYPES, khi
+    đó nên hiển thị từng file riêng lẻ.
+    """
+    if headers is None:
+        headers = read_sorted_headers(dicom_paths)
+    if not headers:
+        raise ValueError("Series không có file DICOM đọc được")
+    sorted_paths = [path for path, _ in headers]
+
+    if cache:
+        cached = open_cached_volume(headers)
+        if cached is not None:
+            return cached
+
+    # Kiểm tra kích thước bằng header trước, để không giải mã vô ích series không dựng được volume
+    sizes = {(getattr(header, 'Rows', None), getattr(header, 'Columns', None)) for _, header in headers}
+    if len(sizes) != 1 or None in next(iter(sizes)):
+        raise ValueError(f"Các lát cắt không cùng kích thước ảnh: {sorted(sizes, key=str)[:3]}")
+    rows, columns = next(iter(sizes))
+    shape = (len(sorted_paths), int(rows), int(columns))
+    series_uid = _series_uid(headers)
+    cache_path = volume_cache_path(sorted_paths, series_uid) if cache else None
+    dtype_index = 0
+    volume, tmp_path = _allocate_volume(shape, VOLUME_DTYPES[0], cache_path)
+    if tmp_path is None:
+        cache_path = None
+
+    try:
+        i = 0
+        while i < len(sorted_paths):
+            try:
+                decode_slice(sorted_paths[i], volume[i])
+                i += 1
+            except OverflowError as e:
+                dtype_index += 1
+                if dtype_index == len(VOLUME_DTYPES):
+                    raise ValueError(str(e))
+                # Chuyển sang kiểu rộng hơn, giữ các lát cắt đã giải mã rồi giải mã lại lát cắt lỗi
+                wider, wider_tmp_path = _allocate_volume(shape, VOLUME_DTYPES[dtype_index], cache_path)
+                wider[:i] = volume[:i]
+                del volume
+                _remove_files([tmp_path])
+                volume, tmp_path = wider, wider_tmp_path
+                if tmp_path is None:
+                    cache_path = None
+    except Exception:
+        del volume
+        _remove_files([tmp_path])
+        raise
+
+    if not cache_path:
+        return SeriesVolume(sorted_paths, volume)
+
+    volume.flush()
+    del volume
+
+    # Bỏ metadata cũ trước khi thay file .npy: nếu lỗi giữa chừng, file đệm không có
+    # metadata sẽ không bao giờ được dùng và được dựng lại lần sau
+    meta_path = _meta_path(cache_path)
+    meta_tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+    meta = {'shape': list(shape), 'dtype': np.dtype(VOLUME_DTYPES[dtype_index]).name,
+            'series_uid': series_uid, 'paths': [os.path.abspath(path) for path in sorted_paths],
+            'fingerprints': _fingerprints(sorted_paths)}
+    try:
+        with open(meta_tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        _remove_files([meta_path])
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+        os.replace(meta_tmp_path, meta_path)
+    except OSError as e:
+        print(f"Không thể lưu file đệm volume {cache_path} ({e}), dùng volume trong bộ nhớ")
+        volume = np.load(tmp_path or cache_path)
+        _remove_files([tmp_path, meta_tmp_path])
+        return SeriesVolume(sorted_paths, volume)
+
+    _remove_stale_caches(cache_path, series_uid)
+    return SeriesVolume(sorted_paths, np.load(cache_path, mmap_mode='r'), cache_path)
@@ -5,16 +5,15 @@ Script phát hiện và xử lý file DICOM trùng lặp - Sửa lỗi cho CBCT
 """
 
 import os
-import glob
-import pydicom
-import hashlib
 import argparse
 import pandas as pd
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from tqdm import tqdm
 import shutil
 import re
+from duplicate_hash_engine import find_duplicate_groups, scan_dicom_files
+from report_writer import StreamingReportWriter, REPORT_FORMATS, convert_to_excel
 
 def extract_base_name(filename):
     """
@@ -73,15 +72,44 @@ def should_ignore_cbct(root_dir):
     """
     return True  # Luôn bỏ qua thư mục CBCT để không xem là trùng lặp
 
-def process_duplicates(root_dir, output_dir, action='report', verbose=True):
+def scan_patient_dir(patient_path):
     """
-    Xử lý các file DICOM trùng lặp
+    Quét một thư mục bệnh nhân bằng os.scandir (chạy trong thread pool)
+    
+    Trả về list (folder_type, date_scans) theo thứ tự trong thư mục. date_scans
+    chỉ được quét cho thư mục CT (các thư mục khác là None), gồm list
+    (date_folder, [(file_path, size), ...]).
+    """
+    folders = []
+    with os.scandir(patient_path) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            
+            date_scans = None
+            if entry.name == 'CT':
+                date_scans = []
+                with os.scandir(entry.path) as date_entries:
+                    for date_entry in date_entries:
+                        if date_entry.is_dir():
+                            date_scans.append((date_entry.name, scan_dicom_files(date_entry.path)))
+            folders.append((entry.name, date_scans))
+    return folders
+
+def process_duplicates(root_dir, output_dir, action='report', verbose=True, max_workers=4, scan_workers=8,
+                       report_format='csv', excel=False):
+    """
+    Xử lý các file DICOM trùng lặp (trùng nội dung từng byte)
     
     Tham số:
     - root_dir: Thư mục gốc chứa các file đã phân loại
     - output_dir: Thư mục lưu báo cáo và file trùng lặp
     - action: Hành động xử lý ('report', 'move')
     - verbose: Hiển thị thông tin chi tiết
+    - max_workers: Số luồng đọc file song song khi tính hash
+    - scan_workers: Số luồng quét song song các thư mục bệnh nhân
+    - report_format: Định dạng báo cáo chi tiết ('csv', 'parquet')
+    - excel: Chuyển báo cáo chi tiết sang Excel ở bước cuối
     
     Trả về:
     - Đường dẫn đến báo cáo
@@ -99,129 +127,122 @@ def process_duplicates(root_dir, output_dir, action='report', verbose=True):
     total_kept = 0
     total_processed = 0
     
-    # Biến lưu trữ thông tin báo cáo
-    report_rows = []
-    
     # Duyệt qua tất cả thư mục bệnh nhân
     patient_dirs = [d for d in os.listdir(root_dir) if os.path.isdir(os.path.join(root_dir, d))]
     
     if verbose:
         print(f"Tìm thấy {len(patient_dirs)} thư mục bệnh nhân")
     
-    for patient_dir in tqdm(patient_dirs, desc="Xử lý từng bệnh nhân"):
-        patient_path = os.path.join(root_dir, patient_dir)
+    # Báo cáo được ghi dần ra file (CSV/Parquet) trong quá trình xử lý. Khối with đóng báo
+    # cáo (ghi các dòng còn chờ và footer Parquet) và dừng các pool kể cả khi có lỗi giữa chừng.
+    # executor: pool đọc file dùng chung cho tất cả thư mục ngày; scan_executor: quét song song
+    # các thư mục bệnh nhân (chủ yếu là độ trễ I/O), kết quả được xử lý theo đúng thứ tự bệnh
+    # nhân nên báo cáo giống hệt khi quét tuần tự
+    report_file = os.path.join(output_dir, f'ct_duplicate_report_{timestamp}.{report_format}')
+    with StreamingReportWriter(report_file, report_format) as report_writer, \
+            ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor, \
+            ThreadPoolExecutor(max_workers=max(1, scan_workers)) as scan_executor:
+        patient_scans = scan_executor.map(scan_patient_dir, [os.path.join(root_dir, d) for d in patient_dirs])
         
-        # Kiểm tra từng loại thư mục (CT, CBCT, etc.)
-        for folder_type in os.listdir(patient_path):
-            folder_type_path = os.path.join(patient_path, folder_type)
-            
-            # Chỉ xử lý thư mục
-            if not os.path.isdir(folder_type_path):
-                continue
-            
-            # Bỏ qua thư mục CBCT
-            if folder_type == 'CBCT' and should_ignore_cbct(root_dir):
-                if verbose:
-                    print(f"Bỏ qua thư mục CBCT cho bệnh nhân {patient_dir} (không xem là trùng lặp)")
-                continue
-            
-            # Chỉ xử lý thư mục CT
-            if folder_type != 'CT':
-                if verbose:
-                    print(f"Bỏ qua thư mục {folder_type} cho bệnh nhân {patient_dir} (chỉ xử lý CT)")
-                continue
-            
-            # Duyệt qua các thư mục ngày
-            for date_folder in os.listdir(folder_type_path):
-                date_path = os.path.join(folder_type_path, date_folder)
-                if not os.path.isdir(date_path):
+        for patient_dir, folders in tqdm(zip(patient_dirs, patient_scans), total=len(patient_dirs),
+                                         desc="Xử lý từng bệnh nhân"):
+            # Kiểm tra từng loại thư mục (CT, CBCT, etc.)
+            for folder_type, date_scans in folders:
+                # Bỏ qua thư mục CBCT
+                if folder_type == 'CBCT' and should_ignore_cbct(root_dir):
+                    if verbose:
+                        print(f"Bỏ qua thư mục CBCT cho bệnh nhân {patient_dir} (không xem là trùng lặp)")
                     continue
                 
-                # Lấy tất cả file DICOM trong thư mục ngày
-                dicom_files = glob.glob(os.path.join(date_path, "*.dcm"))
-                total_scanned += len(dicom_files)
-                
-                if not dicom_files:
+                # Chỉ xử lý thư mục CT
+                if folder_type != 'CT':
+                    if verbose:
+                        print(f"Bỏ qua thư mục {folder_type} cho bệnh nhân {patient_dir} (chỉ xử lý CT)")
                     continue
                 
-                # Nhóm file theo image_base_name (không bao gồm hậu tố số)
-                image_groups = defaultdict(list)
-                
-                for file_path in dicom_files:
-                    filename = os.path.basename(file_path)
-                    base_name = extract_base_name(filename)
-                    image_groups[base_name].append(file_path)
-                
-                # Loại bỏ các nhóm chỉ có 1 file (không trùng lặp)
-                duplicate_groups = {k: v for k, v in image_groups.items() if len(v) > 1}
-                
-                # Xử lý từng nhóm trùng lặp
-                for base_name, files in duplicate_groups.items():
-                    # Đếm số lượng trùng lặp
-                    total_duplicates += len(files) - 1
-                    total_kept += 1
+                # Duyệt qua các thư mục ngày
+                for date_folder, dicom_entries in date_scans:
+                    # Tất cả file DICOM trong thư mục ngày (kèm kích thước từ lúc quét)
+                    dicom_files = [file_path for file_path, _ in dicom_entries]
+                    file_sizes = dict(dicom_entries)
+                    total_scanned += len(dicom_files)
                     
-                    # Sắp xếp theo kích thước tăng dần (ưu tiên file nhỏ hơn cho CT)
-                    sorted_files = sorted(files, key=os.path.getsize)
+                    if not dicom_files:
+                        continue
                     
-                    # File đầu tiên là file nhỏ nhất, giữ lại
-                    best_file = sorted_files[0]
+                    # Nhóm các file có nội dung giống hệt nhau (kích thước -> hash đầu/cuối -> hash toàn bộ)
+                    duplicate_groups = find_duplicate_groups(dicom_files, sizes=file_sizes, executor=executor)
                     
-                    # Thêm thông tin file giữ lại vào báo cáo
-                    report_rows.append({
-                        'Patient ID': patient_dir,
-                        'Folder Type': folder_type,
-                        'Date': date_folder,
-                        'Base Name': base_name,
-                        'File Path': best_file,
-                        'File Size (KB)': round(os.path.getsize(best_file) / 1024, 2),
-                        'Action': 'Keep',
-                        'Is Best Match': True
-                    })
-                    
-                    # Xử lý các file còn lại (trùng lặp)
-                    for file_path in sorted_files[1:]:
-                        # Thêm thông tin vào báo cáo
-                        report_rows.append({
+                    # Xử lý từng nhóm trùng lặp
+                    for content_hash, sorted_files in duplicate_groups:
+                        # Đếm số lượng trùng lặp
+                        total_duplicates += len(sorted_files) - 1
+                        total_kept += 1
+                        
+                        # Các file có nội dung giống nhau, giữ lại file đầu tiên theo tên
+                        best_file = sorted_files[0]
+                        base_name = extract_base_name(os.path.basename(best_file))
+                        
+                        # Thêm thông tin file giữ lại vào báo cáo
+                        report_writer.write({
                             'Patient ID': patient_dir,
                             'Folder Type': folder_type,
                             'Date': date_folder,
                             'Base Name': base_name,
-                            'File Path': file_path,
-                            'File Size (KB)': round(os.path.getsize(file_path) / 1024, 2),
-                            'Action': action.capitalize(),
-                            'Is Best Match': False
+                            'Content Hash': content_hash,
+                            'File Path': best_file,
+                            'File Size (KB)': round(file_sizes[best_file] / 1024, 2),
+                            'Action': 'Keep',
+                            'Is Best Match': True
                         })
                         
-                        # Thực hiện di chuyển nếu action là 'move'
-                        if action == 'move':
-                            try:
-                                # Tạo thư mục duplicates
-                                duplicate_dir = os.path.join(output_dir, 'duplicates')
-                                os.makedirs(duplicate_dir, exist_ok=True)
-                                
-                                # Tạo thư mục con tương ứng với cấu trúc ban đầu
-                                rel_path = os.path.relpath(file_path, root_dir)
-                                dest_path = os.path.join(duplicate_dir, rel_path)
-                                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                                
-                                # Di chuyển file
-                                shutil.move(file_path, dest_path)
-                                total_processed += 1
-                            except Exception as e:
-                                if verbose:
-                                    print(f"Lỗi khi di chuyển file {file_path}: {e}")
-    
-    # Tạo DataFrame và lưu báo cáo
-    if report_rows:
-        report_df = pd.DataFrame(report_rows)
-        report_path = os.path.join(output_dir, f'ct_duplicate_report_{timestamp}.xlsx')
-        report_df.to_excel(report_path, index=False)
+                        # Xử lý các file còn lại (trùng lặp)
+                        for file_path in sorted_files[1:]:
+                            # Thêm thông tin vào báo cáo
+                            report_writer.write({
+                                'Patient ID': patient_dir,
+                                'Folder Type': folder_type,
+                                'Date': date_folder,
+                                'Base Name': base_name,
+                                'Content Hash': content_hash,
+                                'File Path': file_path,
+                                'File Size (KB)': round(file_sizes[file_path] / 1024, 2),
+                                'Action': action.capitalize(),
+                                'Is Best Match': False
+                            })
+                            
+                            # Thực hiện di chuyển nếu action là 'move'
+                            if action == 'move':
+                                try:
+                                    # Tạo thư mục duplicates
+                                    duplicate_dir = os.path.join(output_dir, 'duplicates')
+                                    os.makedirs(duplicate_dir, exist_ok=True)
+                                    
+                                    # Tạo thư mục con tương ứng với cấu trúc ban đầu
+                                    rel_path = os.path.relpath(file_path, root_dir)
+                                    dest_path = os.path.join(duplicate_dir, rel_path)
+                                    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                                    
+                                    # Di chuyển file
+                                    shutil.move(file_path, dest_path)
+                                    total_processed += 1
+                                except Exception as e:
+                                    if verbose:
+                                        print(f"Lỗi khi di chuyển file {file_path}: {e}")
         
+        # Ghi nốt các dòng còn lại
+        report_path = report_writer.close()
+    
+    # Chỉ tạo file Excel ở bước cuối nếu được yêu cầu
+    if report_path:
         if verbose:
             print(f"\nĐã tạo báo cáo file trùng lặp: {report_path}")
+        
+        if excel:
+            excel_path = convert_to_excel(report_path)
+            if verbose:
+                print(f"Đã chuyển báo cáo sang Excel: {excel_path}")
     else:
-        report_path = None
         if verbose:
             print("\nKhông tìm thấy file trùng lặp nào.")
     
@@ -256,6 +277,14 @@ def main():
     parser.add_argument('--action', '-a', choices=['report', 'move'], default='report',
                         help='Hành động xử lý (report: chỉ báo cáo, move: di chuyển)')
     parser.add_argument('--quiet', '-q', action='store_true', help='Không hiển thị thông tin chi tiết')
+    parser.add_argument('--workers', '-w', type=int, default=4,
+                        help='Số luồng đọc file song song khi tính hash nội dung')
+    parser.add_argument('--scan-workers', type=int, default=8,
+                        help='Số luồng quét song song các thư mục bệnh nhân')
+    parser.add_argument('--report-format', choices=REPORT_FORMATS, default='csv',
+                        help='Định dạng báo cáo chi tiết, được ghi dần trong quá trình xử lý')
+    parser.add_argument('--excel', action='store_true',
+                        help='Chuyển báo cáo chi tiết sang Excel sau khi xử lý xong')
     
     args = parser.parse_args()
     
@@ -271,7 +300,11 @@ def main():
         args.input_dir, 
         args.output, 
         action=args.action, 
-        verbose=not args.quiet
+        verbose=not args.quiet,
+        max_workers=args.workers,
+        scan_workers=args.scan_workers,
+        report_format=args.report_format,
+        excel=args.excel
     )
     
     end_time = datetime.now()
@@ -5,17 +5,21 @@ Script phát hiện và xử lý file DICOM trùng lặp - Chỉ xử lý thư m
 """
 
 import os
-import glob
 import pydicom
 import hashlib
 import argparse
 import pandas as pd
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from tqdm import tqdm
 import shutil
 import re
+import sqlite3
 import logging
+from duplicate_hash_engine import find_duplicate_groups, scan_dicom_files
+from report_writer import StreamingReportWriter, REPORT_FORMATS, convert_to_excel
+from dicom_header_cache import file_fingerprint
 
 # Thiết lập logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -34,13 +38,6 @@ def extract_base_name(filename):
     pattern = r'(\.+\d+)+$'
     return re.sub(pattern, '', base)
 
-def get_file_size(file_path):
-    """Lấy kích thước file theo KB"""
-    try:
-        return os.path.getsize(file_path) / 1024  # Đổi sang KB
-    except:
-        return 0
-
 def extract_patient_folders(root_dir):
     """Lấy tất cả thư mục bệnh nhân trong thư mục gốc"""
     patient_folders = []
@@ -53,15 +50,75 @@ def extract_patient_folders(root_dir):
     
     return patient_folders
 
-def process_ct_duplicates(root_dir, output_dir, action='report', verbose=True):
+def scan_patient_ct_folder(patient_folder):
+    """
+    Quét thư mục CT của một bệnh nhân bằng os.scandir (chạy trong thread pool)
+    
+    Trả về list (date, [(file_path, size), ...]) theo thứ tự trong thư mục,
+    hoặc None nếu bệnh nhân không có thư mục CT.
+    """
+    ct_folder_path = os.path.join(patient_folder, "CT")
+    if not os.path.isdir(ct_folder_path):
+        return None
+    
+    date_scans = []
+    with os.scandir(ct_folder_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                date_scans.append((entry.name, scan_dicom_files(entry.path)))
+    return date_scans
+
+def scan_patient_folders(patient_folders, scan_workers=8):
+    """Quét song song thư mục CT của các bệnh nhân, trả về iterator theo đúng thứ tự patient_folders"""
+    scan_executor = ThreadPoolExecutor(max_workers=max(1, scan_workers))
+    try:
+        yield from scan_executor.map(scan_patient_ct_folder, patient_folders)
+    finally:
+        scan_executor.shutdown()
+
+def apply_action(file_path, action, root_dir, duplicate_dir, verbose=True):
+    """
+    Di chuyển hoặc xóa một file trùng lặp theo action
+    
+    Trả về True nếu file đã được xử lý ('move' hoặc 'delete' thành công).
     """
-    Xử lý file trùng lặp CHỈ trong thư mục CT
+    if action not in ['move', 'delete']:
+        return False
+    
+    try:
+        if action == 'move':
+            # Tạo thư mục con tương ứng với cấu trúc ban đầu
+            rel_path = os.path.relpath(file_path, root_dir)
+            dest_path = os.path.join(duplicate_dir, rel_path)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            
+            # Di chuyển file
+            shutil.move(file_path, dest_path)
+        else:  # action == 'delete'
+            os.remove(file_path)
+        
+        return True
+    except Exception as e:
+        error_msg = f"Lỗi khi {action} file {file_path}: {e}"
+        if verbose:
+            print(error_msg)
+        logger.error(error_msg)
+        return False
+
+def process_ct_duplicates(root_dir, output_dir, action='report', verbose=True, max_workers=4, scan_workers=8,
+                          report_format='csv', excel=False):
+    """
+    Xử lý file trùng lặp (trùng nội dung từng byte) CHỈ trong thư mục CT
     
     Tham số:
     - root_dir: Thư mục gốc chứa các file đã phân loại
     - output_dir: Thư mục lưu báo cáo và file trùng lặp
     - action: Hành động xử lý ('report', 'move', 'delete')
     - verbose: Hiển thị thông tin chi tiết
+    - max_workers: Số luồng đọc file song song khi tính hash
+    - scan_workers: Số luồng quét song song các thư mục bệnh nhân
+    - report_format: Định dạng báo cáo chi tiết ('csv', 'parquet')
+    - excel: Chuyển báo cáo chi tiết sang Excel ở bước cuối
     """
     # Tạo thư mục output nếu chưa tồn tại
     os.makedirs(output_dir, exist_ok=True)
@@ -70,7 +127,6 @@ def process_ct_duplicates(root_dir, output_dir, action='report', verbose=True):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     # Sẵn sàng các biến thống kê
-    all_report_rows = []
     total_processed = 0
     total_kept = 0
     total_to_process = 0
@@ -88,110 +144,94 @@ def process_ct_duplicates(root_dir, output_dir, action='report', verbose=True):
         print(f"Tìm thấy {len(patient_folders)} thư mục bệnh nhân trong thư mục gốc.")
         print("Chỉ xử lý trùng lặp trong thư mục CT, bỏ qua tất cả các loại thư mục khác.")
     
-    # Xử lý từng thư mục bệnh nhân
-    for patient_folder in tqdm(patient_folders, desc="Đang xử lý từng bệnh nhân"):
-        patient_id = os.path.basename(patient_folder)
-        
-        # Kiểm tra xem có thư mục CT không
-        ct_folder_path = os.path.join(patient_folder, "CT")
-        if not (os.path.exists(ct_folder_path) and os.path.isdir(ct_folder_path)):
-            continue
-        
-        # Nhóm file DICOM theo ngày trong thư mục CT
-        date_folders = {}
-        for date_folder in os.listdir(ct_folder_path):
-            date_path = os.path.join(ct_folder_path, date_folder)
-            if os.path.isdir(date_path):
-                date_folders[date_folder] = date_path
+    # Báo cáo được ghi dần ra file (CSV/Parquet) trong quá trình xử lý. Khối with đóng báo
+    # cáo (ghi các dòng còn chờ và footer Parquet) và dừng pool đọc file dùng chung cho tất cả
+    # thư mục ngày kể cả khi có lỗi giữa chừng.
+    report_file = os.path.join(output_dir, f'ct_duplicate_report_{timestamp}.{report_format}')
+    with StreamingReportWriter(report_file, report_format) as report_writer, \
+            ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Xử lý từng thư mục bệnh nhân
+        # Quét song song các thư mục bệnh nhân (chủ yếu là độ trễ I/O); kết quả được
+        # xử lý theo đúng thứ tự bệnh nhân nên báo cáo giống hệt khi quét tuần tự
+        patient_scans = scan_patient_folders(patient_folders, scan_workers)
         
-        # Xử lý từng thư mục ngày, tìm trùng lặp trong mỗi ngày
-        for date, date_path in date_folders.items():
-            # Lấy tất cả file DICOM trong thư mục ngày
-            dicom_files = glob.glob(os.path.join(date_path, "*.dcm"))
+        for patient_folder, date_scans in tqdm(zip(patient_folders, patient_scans), total=len(patient_folders),
+                                               desc="Đang xử lý từng bệnh nhân"):
+            patient_id = os.path.basename(patient_folder)
             
-            if not dicom_files:
+            # Bỏ qua bệnh nhân không có thư mục CT
+            if date_scans is None:
                 continue
             
-            total_ct_files += len(dicom_files)
-            
-            # Nhóm các file có tên cơ bản giống nhau
-            base_name_groups = defaultdict(list)
-            for file_path in dicom_files:
-                file_name = os.path.basename(file_path)
-                base_name = extract_base_name(file_name)
-                base_name_groups[base_name].append(file_path)
-            
-            # Chỉ giữ lại các nhóm có nhiều hơn 1 file (thực sự trùng lặp)
-            duplicate_groups = {k: v for k, v in base_name_groups.items() if len(v) > 1}
-            
-            if not duplicate_groups:
-                continue
-            
-            # Xử lý từng nhóm trùng lặp
-            for base_name, files in duplicate_groups.items():
-                # CT - ưu tiên file nhỏ (sắp xếp tăng dần theo dung lượng)
-                ranked_files = sorted(files, key=lambda f: get_file_size(f))
+            # Xử lý từng thư mục ngày, tìm trùng lặp trong mỗi ngày
+            for date, dicom_entries in date_scans:
+                # Tất cả file DICOM trong thư mục ngày (kèm kích thước từ lúc quét)
+                dicom_files = [file_path for file_path, _ in dicom_entries]
+                file_sizes = dict(dicom_entries)
                 
-                # File đầu tiên là file tốt nhất, giữ lại
-                best_file = ranked_files[0]
-                files_to_process = ranked_files[1:]
+                if not dicom_files:
+                    continue
                 
-                # Thêm vào báo cáo
-                all_report_rows.append({
-                    'Patient ID': patient_id,
-                    'Date': date,
-                    'Base Name': base_name,
-                    'File Path': best_file,
-                    'File Size (KB)': round(get_file_size(best_file), 2),
-                    'Action': 'Keep',
-                    'Is Best Match': True
-                })
+                total_ct_files += len(dicom_files)
                 
-                total_kept += 1
+                # Nhóm các file có nội dung giống hệt nhau (kích thước -> hash đầu/cuối -> hash toàn bộ)
+                duplicate_groups = find_duplicate_groups(dicom_files, sizes=file_sizes, executor=executor)
                 
-                # Xử lý các file còn lại (trùng lặp)
-                for file_path in files_to_process:
-                    all_report_rows.append({
+                if not duplicate_groups:
+                    continue
+                
+                # Xử lý từng nhóm trùng lặp
+                for content_hash, ranked_files in duplicate_groups:
+                    # Các file có nội dung giống nhau, giữ lại file đầu tiên theo tên
+                    best_file = ranked_files[0]
+                    files_to_process = ranked_files[1:]
+                    base_name = extract_base_name(os.path.basename(best_file))
+                    
+                    # Thêm vào báo cáo
+                    report_writer.write({
                         'Patient ID': patient_id,
                         'Date': date,
                         'Base Name': base_name,
-                        'File Path': file_path,
-                        'File Size (KB)': round(get_file_size(file_path), 2),
-                        'Action': action.capitalize(),
-                        'Is Best Match': False
+                        'Content Hash': content_hash,
+                        'File Path': best_file,
+                        'File Size (KB)': round(file_sizes[best_file] / 1024, 2),
+                        'Action': 'Keep',
+                        'Is Best Match': True
                     })
                     
-                    total_to_process += 1
+                    total_kept += 1
                     
-                    # Thực hiện hành động nếu không phải "report"
-                    if action in ['move', 'delete']:
-                        try:
-                            if action == 'move':
-                                # Tạo thư mục con tương ứng với cấu trúc ban đầu
-                                rel_path = os.path.relpath(file_path, root_dir)
-                                dest_path = os.path.join(duplicate_dir, rel_path)
-                                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                                
-                                # Di chuyển file
-                                shutil.move(file_path, dest_path)
-                            else:  # action == 'delete'
-                                os.remove(file_path)
-                            
+                    # Xử lý các file còn lại (trùng lặp)
+                    for file_path in files_to_process:
+                        report_writer.write({
+                            'Patient ID': patient_id,
+                            'Date': date,
+                            'Base Name': base_name,
+                            'Content Hash': content_hash,
+                            'File Path': file_path,
+                            'File Size (KB)': round(file_sizes[file_path] / 1024, 2),
+                            'Action': action.capitalize(),
+                            'Is Best Match': False
+                        })
+                        
+                        total_to_process += 1
+                        
+                        # Thực hiện hành động nếu không phải "report"
+                        if apply_action(file_path, action, root_dir, duplicate_dir, verbose):
                             total_processed += 1
-                        except Exception as e:
-                            error_msg = f"Lỗi khi {action} file {file_path}: {e}"
-                            if verbose:
-                                print(error_msg)
-                            logger.error(error_msg)
-    
-    # Tạo DataFrame và lưu báo cáo
-    if all_report_rows:
-        report_df = pd.DataFrame(all_report_rows)
-        report_path = os.path.join(output_dir, f'ct_duplicate_report_{timestamp}.xlsx')
-        report_df.to_excel(report_path, index=False)
         
+        # Ghi nốt các dòng còn lại
+        report_path = report_writer.close()
+    
+    # Chỉ tạo file Excel ở bước cuối nếu được yêu cầu
+    if report_path:
         if verbose:
             print(f"\nĐã tạo báo cáo file trùng lặp trong thư mục CT: {report_path}")
+        
+        if excel:
+            excel_path = convert_to_excel(report_path)
+            if verbose:
+                print(f"Đã chuyển báo cáo sang Excel: {excel_path}")
     
     # Tạo báo cáo tổng hợp
     summary = {
@@ -214,6 +254,321 @@ def process_ct_duplicates(root_dir, output_dir, action='report', verbose=True):
     
     return summary
 
+# ---------------------------------------------------------------------------
+# Phát hiện trùng lặp theo ngữ nghĩa: SOPInstanceUID và hash dữ liệu pixel
+# ---------------------------------------------------------------------------
+# Cùng một SOPInstanceUID có thể được xuất lại với transfer syntax khác, hoặc
+# cùng một ảnh được gán header mới; các file này không trùng từng byte nhưng
+# vẫn là một lát cắt CT. Chỉ mục lưu SOPInstanceUID và hash pixel đã giải mã
+# của mọi lát cắt CT, được cập nhật tăng dần theo (kích thước, mtime) của file.
+
+# Tên file chỉ mục mặc định (trong thư mục output)
+SEMANTIC_INDEX_FILENAME = 'ct_semantic_index.sqlite'
+
+# Số file mỗi lô gửi cho một tiến trình con khi giải mã pixel
+SEMANTIC_CHUNK_SIZE = 64
+
+def list_ct_files(root_dir, scan_workers=8):
+    """Liệt kê tất cả file CT dạng (patient_id, date, file_path), sắp xếp theo đường dẫn"""
+    ct_files = []
+    patient_folders = sorted(extract_patient_folders(root_dir))
+    for patient_folder, date_scans in zip(patient_folders, scan_patient_folders(patient_folders, scan_workers)):
+        if date_scans is None:
+            continue
+        
+        patient_id = os.path.basename(patient_folder)
+        for date, dicom_entries in sorted(date_scans):
+            for file_path, _ in dicom_entries:
+                ct_files.append((patient_id, date, os.path.abspath(file_path)))
+    
+    return ct_files
+
+def compute_slice_keys(file_path):
+    """
+    Tính (SOPInstanceUID, hash pixel đã giải mã) của một lát cắt CT
+    
+    Hash pixel bao gồm kích thước và kiểu dữ liệu của mảng, nên không phụ thuộc
+    vào transfer syntax hay các tag header khác. Trả về None nếu không đọc được file.
+    """
+    try:
+        dcm = pydicom.dcmread(file_path, force=True)
+    except Exception as e:
+        logger.error(f"Không thể đọc {file_path}: {e}")
+        return None
+    
+    sop_uid = str(getattr(dcm, 'SOPInstanceUID', '') or '')
+    
+    pixel_hash = ''
+    try:
+        pixels = dcm.pixel_array
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{pixels.shape}|{pixels.dtype.str}".encode())
+        h.update(pixels.tobytes())
+        pixel_hash = h.hexdigest()
+    except Exception as e:
+        logger.error(f"Không thể giải mã pixel {file_path}: {e}")
+    
+    return sop_uid, pixel_hash
+
+def _compute_slice_keys_chunk(file_paths):
+    """Tính khóa cho một lô file (chạy trong tiến trình con)"""
+    return [compute_slice_keys(file_path) for file_path in file_paths]
+
+def _open_semantic_index(index_path):
+    """Mở (hoặc tạo) file chỉ mục ngữ nghĩa"""
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    os.makedirs(index_dir, exist_ok=True)
+    conn = sqlite3.connect(index_path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS slices ('
+        ' path TEXT PRIMARY KEY,'
+        ' size INTEGER NOT NULL,'
+        ' mtime_ns INTEGER NOT NULL,'
+        ' patient_id TEXT NOT NULL,'
+        ' date TEXT NOT NULL,'
+        ' sop_uid TEXT NOT NULL,'
+        ' pixel_hash TEXT NOT NULL)'
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS slices_sop_uid ON slices (sop_uid)')
+    conn.execute('CREATE INDEX IF NOT EXISTS slices_pixel_hash ON slices (pixel_hash)')
+    return conn
+
+def update_semantic_index(root_dir, index_path, max_workers=4, verbose=True, scan_workers=8):
+    """
+    Cập nhật chỉ mục ngữ nghĩa cho tất cả file CT trong root_dir
+    
+    Chỉ các file mới hoặc đã thay đổi (kích thước/mtime khác) mới được giải mã;
+    các file không còn tồn tại bị xóa khỏi chỉ mục. Trả về dictionary thống kê.
+    """
+    ct_files = list_ct_files(root_dir, scan_workers)
+    
+    conn = _open_semantic_index(index_path)
+    try:
+        indexed = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in conn.execute('SELECT path, size, mtime_ns FROM slices')
+        }
+        
+        # Xác định các file cần giải mã lại
+        pending = []
+        current_paths = set()
+        for patient_id, date, file_path in ct_files:
+            current_paths.add(file_path)
+            fingerprint = file_fingerprint(file_path)
+            if fingerprint is None:
+                continue
+            if indexed.get(file_path) != fingerprint:
+                pending.append((patient_id, date, file_path, fingerprint))
+        removed = [path for path in indexed if path not in current_paths]
+        
+        if verbose:
+            print(f"Chỉ mục ngữ nghĩa: {len(ct_files)} file CT, {len(pending)} file mới/thay đổi, "
+                  f"{len(removed)} file đã bị xóa")
+        
+        # Giải mã pixel song song theo lô
+        pending_paths = [item[2] for item in pending]
+        keys = [None] * len(pending_paths)
+        if max_workers > 1 and len(pending_paths) > SEMANTIC_CHUNK_SIZE:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(_compute_slice_keys_chunk, pending_paths[start:start + SEMANTIC_CHUNK_SIZE]): start
+                    for start in range(0, len(pending_paths), SEMANTIC_CHUNK_SIZE)
+                }
+                with tqdm(total=len(pending_paths), desc="Đang giải mã lát cắt CT", disable=not verbose) as pbar:
+                    for future in futures:
+                        start = futures[future]
+                        chunk_size = min(SEMANTIC_CHUNK_SIZE, len(pending_paths) - start)
+                        try:
+                            chunk_keys = future.result()
+                        except Exception as e:
+                            # Bỏ qua lô lỗi: các file này không được ghi vào chỉ mục và sẽ được giải mã lại lần sau
+                            logger.error(f"Lỗi khi giải mã lô {start}-{start + chunk_size}: {e}")
+                            chunk_keys = [None] * chunk_size
+                        keys[start:start + len(chunk_keys)] = chunk_keys
+                        pbar.update(chunk_size)
+        else:
+            for i, file_path in enumerate(tqdm(pending_paths, desc="Đang giải mã lát cắt CT", disable=not verbose)):
+                keys[i] = compute_slice_keys(file_path)
+        
+        rows = []
+        for (patient_id, date, file_path, fingerprint), slice_keys in zip(pending, keys):
+            if slice_keys is None:
+                continue
+            sop_uid, pixel_hash = slice_keys
+            rows.append((file_path, fingerprint[0], fingerprint[1], patient_id, date, sop_uid, pixel_hash))
+        
+        with conn:
+            conn.executemany('DELETE FROM slices WHERE path = ?', [(path,) for path in removed])
+            conn.executemany('INSERT OR REPLACE INTO slices VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    finally:
+        conn.close()
+    
+    return {
+        'Indexed CT Files': len(ct_files),
+        'Newly Indexed': len(rows),
+        'Removed From Index': len(removed),
+    }
+
+def find_semantic_duplicate_groups(index_path):
+    """
+    Nhóm các lát cắt trùng lặp trên toàn bộ chỉ mục (mọi bệnh nhân, mọi ngày)
+    
+    Hai lát cắt thuộc cùng nhóm nếu có cùng SOPInstanceUID, hoặc cùng hash
+    pixel và cùng bệnh nhân (bắc cầu). Hash pixel chỉ được so sánh trong cùng
+    bệnh nhân vì ảnh trống/đồng nhất hoặc phantom của các bệnh nhân khác nhau
+    có thể giống hệt nhau. Trả về list các nhóm, mỗi nhóm là list entry sắp xếp theo
+    kích thước tăng dần (ưu tiên file nhỏ như với CT) rồi theo đường dẫn.
+    """
+    conn = _open_semantic_index(index_path)
+    try:
+        rows = conn.execute(
+            'SELECT path, size, patient_id, date, sop_uid, pixel_hash FROM slices ORDER BY path'
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    columns = ['path', 'size', 'patient_id', 'date', 'sop_uid', 'pixel_hash']
+    entries = [dict(zip(columns, row)) for row in rows]
+    
+    # Union-find trên chỉ số entry
+    parent = list(range(len(entries)))
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    for key in ['sop_uid', 'pixel_hash']:
+        first_with_value = {}
+        for i, entry in enumerate(entries):
+            if not entry[key]:
+                continue
+            value = entry[key] if key == 'sop_uid' else (entry['patient_id'], entry[key])
+            if value in first_with_value:
+                root_a, root_b = find(first_with_value[value]), find(i)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+            else:
+                first_with_value[value] = i
+    
+    groups = defaultdict(list)
+    for i, entry in enumerate(entries):
+        groups[find(i)].append(entry)
+    
+    duplicate_groups = [
+        sorted(members, key=lambda e: (e['size'], e['path']))
+        for root, members in sorted(groups.items()) if len(members) > 1
+    ]
+    return duplicate_groups
+
+def process_ct_semantic_duplicates(root_dir, output_dir, action='report', verbose=True,
+                                   max_workers=4, index_path=None, scan_workers=8,
+                                   report_format='csv', excel=False):
+    """
+    Xử lý file CT trùng lặp theo SOPInstanceUID / hash pixel trên mọi thư mục ngày và bệnh nhân
+    
+    Tham số giống process_ct_duplicates, thêm:
+    - max_workers: Số tiến trình giải mã pixel song song khi cập nhật chỉ mục
+    - index_path: Đường dẫn file chỉ mục (mặc định output_dir/ct_semantic_index.sqlite)
+    - scan_workers: Số luồng quét song song các thư mục bệnh nhân
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    root_dir = os.path.abspath(root_dir)
+    if index_path is None:
+        index_path = os.path.join(output_dir, SEMANTIC_INDEX_FILENAME)
+    
+    duplicate_dir = os.path.join(output_dir, 'duplicates')
+    if action == 'move':
+        os.makedirs(duplicate_dir, exist_ok=True)
+    
+    # Cập nhật chỉ mục tăng dần rồi tìm các nhóm trùng lặp trên toàn bộ chỉ mục
+    index_stats = update_semantic_index(root_dir, index_path, max_workers, verbose, scan_workers)
+    duplicate_groups = find_semantic_duplicate_groups(index_path)
+    
+    total_to_process = 0
+    total_processed = 0
+    processed_paths = []
+    
+    # Báo cáo được ghi dần ra file (CSV/Parquet) trong quá trình xử lý; khối with đóng báo cáo
+    # (ghi các dòng còn chờ và footer Parquet) kể cả khi có lỗi giữa chừng
+    report_file = os.path.join(output_dir, f'ct_semantic_duplicate_report_{timestamp}.{report_format}')
+    with StreamingReportWriter(report_file, report_format) as report_writer:
+        for group_id, members in enumerate(duplicate_groups, 1):
+            best = members[0]
+            for entry in members:
+                is_best = entry is best
+                same_sop_uid = bool(entry['sop_uid']) and entry['sop_uid'] == best['sop_uid']
+                same_pixels = bool(entry['pixel_hash']) and entry['pixel_hash'] == best['pixel_hash']
+                # Chỉ xử lý file trùng trực tiếp với file được giữ lại (không qua bắc cầu), và
+                # chỉ tin hash pixel trong cùng bệnh nhân
+                is_duplicate = not is_best and (
+                    same_sop_uid or (same_pixels and entry['patient_id'] == best['patient_id']))
+                report_writer.write({
+                    'Group': group_id,
+                    'Patient ID': entry['patient_id'],
+                    'Date': entry['date'],
+                    'SOPInstanceUID': entry['sop_uid'],
+                    'Pixel Hash': entry['pixel_hash'],
+                    'Same SOPInstanceUID': same_sop_uid,
+                    'Same Pixels': same_pixels,
+                    'File Path': entry['path'],
+                    'File Size (KB)': round(entry['size'] / 1024, 2),
+                    'Action': action.capitalize() if is_duplicate else 'Keep',
+                    'Is Best Match': is_best
+                })
+                
+                if not is_duplicate:
+                    continue
+                total_to_process += 1
+                if apply_action(entry['path'], action, root_dir, duplicate_dir, verbose):
+                    total_processed += 1
+                    processed_paths.append(entry['path'])
+        
+        # Ghi nốt các dòng còn lại
+        report_path = report_writer.close()
+    
+    # Các file đã di chuyển/xóa không còn trong cây thư mục
+    if processed_paths:
+        conn = _open_semantic_index(index_path)
+        try:
+            with conn:
+                conn.executemany('DELETE FROM slices WHERE path = ?', [(path,) for path in processed_paths])
+        finally:
+            conn.close()
+    
+    # Chỉ tạo file Excel ở bước cuối nếu được yêu cầu
+    if report_path:
+        if verbose:
+            print(f"\nĐã tạo báo cáo trùng lặp theo SOPInstanceUID/pixel: {report_path}")
+        
+        if excel:
+            excel_path = convert_to_excel(report_path)
+            if verbose:
+                print(f"Đã chuyển báo cáo sang Excel: {excel_path}")
+    
+    summary = dict(index_stats)
+    summary.update({
+        'Total Duplicate Groups': len(duplicate_groups),
+        'Files To Keep': sum(len(members) for members in duplicate_groups) - total_to_process,
+        'Files To Process': total_to_process,
+        'Files Processed': total_processed,
+    })
+    
+    summary_df = pd.DataFrame([summary])
+    summary_path = os.path.join(output_dir, f'ct_semantic_duplicate_summary_{timestamp}.csv')
+    summary_df.to_csv(summary_path, index=False)
+    
+    if verbose:
+        print("\nTổng kết:")
+        for key, value in summary.items():
+            print(f"- {key}: {value}")
+        print(f"Đã lưu báo cáo tổng hợp vào: {summary_path}")
+    
+    return summary
+
 def main():
     parser = argparse.ArgumentParser(description='Phát hiện và xử lý file DICOM trùng lặp - Chỉ xử lý thư mục CT')
     parser.add_argument('input_dir', help='Thư mục chứa các file DICOM đã phân loại')
@@ -222,6 +577,19 @@ def main():
                         help='Hành động xử lý (report: chỉ báo cáo, move: di chuyển, delete: xóa)')
     parser.add_argument('--quiet', '-q', action='store_true', help='Không hiển thị thông tin chi tiết')
     parser.add_argument('--log', '-l', default='ct_duplicate_detection.log', help='File lưu log')
+    parser.add_argument('--workers', '-w', type=int, default=4,
+                        help='Số luồng đọc file song song khi tính hash (với --semantic: số tiến trình giải mã pixel)')
+    parser.add_argument('--scan-workers', type=int, default=8,
+                        help='Số luồng quét song song các thư mục bệnh nhân')
+    parser.add_argument('--report-format', choices=REPORT_FORMATS, default='csv',
+                        help='Định dạng báo cáo chi tiết, được ghi dần trong quá trình xử lý')
+    parser.add_argument('--excel', action='store_true',
+                        help='Chuyển báo cáo chi tiết sang Excel sau khi xử lý xong')
+    parser.add_argument('--semantic', '-s', action='store_true',
+                        help='Tìm trùng lặp theo SOPInstanceUID (mọi bệnh nhân) và hash pixel đã giải mã (trong cùng '
+                             'bệnh nhân) trên mọi thư mục ngày (dùng chỉ mục lưu trên đĩa, cập nhật tăng dần)')
+    parser.add_argument('--index', default=None,
+                        help=f'File chỉ mục cho --semantic (mặc định: <output>/{SEMANTIC_INDEX_FILENAME})')
     
     args = parser.parse_args()
     
@@ -240,12 +608,29 @@ def main():
         print(f"QUAN TRỌNG: Chỉ xử lý trùng lặp TRONG THƯ MỤC CT, không ảnh hưởng đến các thư mục khác.")
     
     # Xử lý các file trùng lặp
-    process_ct_duplicates(
-        args.input_dir, 
-        args.output, 
-        action=args.action, 
-        verbose=not args.quiet
-    )
+    if args.semantic:
+        process_ct_semantic_duplicates(
+            args.input_dir,
+            args.output,
+            action=args.action,
+            verbose=not args.quiet,
+            max_workers=args.workers,
+            index_path=args.index,
+            scan_workers=args.scan_workers,
+            report_format=args.report_format,
+            excel=args.excel
+        )
+    else:
+        process_ct_duplicates(
+            args.input_dir, 
+            args.output, 
+            action=args.action, 
+            verbose=not args.quiet,
+            max_workers=args.workers,
+            scan_workers=args.scan_workers,
+            report_format=args.report_format,
+            excel=args.excel
+        )
     
     end_time = datetime.now()
     elapsed_time = end_time - start_time
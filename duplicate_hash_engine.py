@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Phát hiện file trùng lặp theo nội dung (dùng chung cho các script duplicate_detection)
+
+Các file được lọc qua nhiều giai đoạn, mỗi giai đoạn chỉ xét các file còn
+có khả năng trùng ở giai đoạn trước:
+1. Nhóm theo kích thước file (chỉ cần stat, không đọc nội dung)
+2. Nhóm theo hash của vài KB đầu và cuối file
+3. Nhóm theo hash toàn bộ nội dung (đọc theo từng khối, không nạp cả file)
+
+Các bước đọc file được chạy song song bằng ThreadPoolExecutor (hashlib nhả
+GIL khi băm dữ liệu lớn, còn I/O thì không cần GIL), nên số byte phải băm là
+ít nhất có thể và kết quả là các nhóm trùng lặp chính xác từng byte.
+"""
+
+import os
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Số byte đầu và cuối file dùng cho hash sơ bộ
+HEAD_TAIL_BYTES = 4 * 1024
+
+# Kích thước khối khi đọc file để tính hash toàn bộ
+HASH_BLOCK_BYTES = 1024 * 1024
+
+def _new_hash():
+    return hashlib.blake2b(digest_size=20)
+
+def head_tail_hash(file_path, size=None, nbytes=HEAD_TAIL_BYTES):
+    """Hash của nbytes đầu và nbytes cuối file (toàn bộ file nếu file nhỏ)"""
+    if size is None:
+        size = os.path.getsize(file_path)
+    h = _new_hash()
+    with open(file_path, 'rb') as f:
+        if size <= 2 * nbytes:
+            h.update(f.read())
+        else:
+            h.update(f.read(nbytes))
+            f.seek(size - nbytes)
+            h.update(f.read(nbytes))
+    return h.hexdigest()
+
+def full_hash(file_path, block_size=HASH_BLOCK_BYTES):
+    """Hash toàn bộ nội dung file, đọc theo từng khối"""
+    h = _new_hash()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _hash_all(executor, func, file_paths):
+    """Tính func(path) cho từng file, trả về {path: hash}, bỏ qua file lỗi"""
+    results = {}
+    hashes = executor.map(lambda p: _safe_call(func, p), file_paths)
+    for file_path, value in zip(file_paths, hashes):
+        if value is not None:
+            results[file_path] = value
+    return results
+
+def _safe_call(func, file_path):
+    try:
+        return func(file_path)
+    except OSError:
+        return None
+
+def _split_groups(groups, hashes):
+    """Tách mỗi nhóm theo giá trị hash, chỉ giữ các nhóm con có từ 2 file"""
+    new_groups = []
+    for files in groups:
+        by_hash = defaultdict(list)
+        for file_path in files:
+            if file_path in hashes:
+                by_hash[hashes[file_path]].append(file_path)
+        new_groups.extend(sub for sub in by_hash.values() if len(sub) > 1)
+    return new_groups
+
+def find_duplicate_groups(file_paths, max_workers=4, sizes=None, executor=None):
+    """
+    Tìm các nhóm file có nội dung giống hệt nhau
+
+    Parameters:
+    file_paths (list): Danh sách đường dẫn file cần so sánh
+    max_workers (int): Số luồng đọc file song song
+    sizes (dict, optional): {path: kích thước} đã biết trước (tránh stat lại)
+    executor (ThreadPoolExecutor, optional): Dùng lại pool có sẵn thay vì tạo mới
+
+    Trả về list các tuple (hash nội dung, [các file trùng]); thứ tự nhóm và
+    thứ tự file trong nhóm theo thứ tự xuất hiện trong file_paths.
+    """
+    # Giai đoạn 1: nhóm theo kích thước
+    by_size = defaultdict(list)
+    for file_path in file_paths:
+        if sizes is not None and file_path in sizes:
+            size = sizes[file_path]
+        else:
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                continue
+        by_size[size].append(file_path)
+
+    groups = [files for files in by_size.values() if len(files) > 1]
+    if not groups:
+        return []
+    size_of = {file_path: size for size, files in by_size.items() for file_path in files}
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        # Giai đoạn 2: hash phần đầu và cuối file
+        candidates = [file_path for files in groups for file_path in files]
+        partial = _hash_all(executor, lambda p: head_tail_hash(p, size_of[p]), candidates)
+        groups = _split_groups(groups, partial)
+
+        # Giai đoạn 3: hash toàn bộ (file nhỏ đã được băm hết ở giai đoạn 2)
+        candidates = [file_path for files in groups for file_path in files
+                      if size_of[file_path] > 2 * HEAD_TAIL_BYTES]
+        full = _hash_all(executor, full_hash, candidates)
+        for files in groups:
+            for file_path in files:
+                if size_of[file_path] <= 2 * HEAD_TAIL_BYTES:
+                    full[file_path] = partial[file_path]
+        groups = _split_groups(groups, full)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    # Sắp xếp nhóm theo thứ tự xuất hiện để kết quả ổn định
+    order = {file_path: i for i, file_path in enumerate(file_paths)}
+    groups = [sorted(files, key=order.get) for files in groups]
+    groups.sort(key=lambda files: order[files[0]])
+    return [(full[files[0]], files) for files in groups]
+
+def scan_dicom_files(directory, extension='.dcm'):
+    """
+    Liệt kê các file DICOM trực tiếp trong thư mục bằng os.scandir
+
+    Trả về list (đường dẫn, kích thước) sắp xếp theo đường dẫn. Kích thước lấy
+    từ kết quả stat của DirEntry (được lưu lại trong entry), nên không cần gọi
+    thêm os.path.getsize cho từng file.
+    """
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Giống glob("*.dcm"): bỏ qua file ẩn
+            if entry.name.startswith('.') or not entry.name.endswith(extension):
+                continue
+            try:
+                if entry.is_file():
+                    files.append((entry.path, entry.stat().st_size))
+            except OSError:
+                continue
+    files.sort()
+    return files
@@ -1,9 +1,19 @@
 import os
 import datetime
-import pydicom
 import pandas as pd
 import glob
 from collections import defaultdict
+from dicom_header_cache import get_header_cache, versioned_namespace
+from dicom_header_reader import read_header
+
+# Namespace của script này trong bộ đệm header dùng chung
+# (tăng phiên bản khi read_modality trả về các trường khác)
+HEADER_CACHE_NAMESPACE = versioned_namespace('classifier', 1)
+
+def read_modality(file_path):
+    """Đọc Modality từ header file DICOM (chỉ đọc tag Modality)"""
+    dcm = read_header(file_path, ['Modality'])
+    return {'modality': getattr(dcm, 'Modality', 'Unknown')}
 
 def scan_dicom_directory(directory_path, patient_id=None):
     """Quét thư mục để tìm và phân loại các file DICOM theo loại"""
@@ -28,6 +38,8 @@ def scan_dicom_directory(directory_path, patient_id=None):
     all_dcm_files = glob.glob(os.path.join(directory_path, search_pattern), recursive=True)
     print(f"Tìm thấy tổng cộng {len(all_dcm_files)} file DICOM")
     
+    header_cache = get_header_cache()
+    
     # Phân loại theo quy ước đặt tên
     for file_path in all_dcm_files:
         filename = os.path.basename(file_path)
@@ -46,10 +58,9 @@ def scan_dicom_directory(directory_path, patient_id=None):
         elif filename.startswith("RP."):
             rt_plan_files.append(file_path)
         else:
-            # Nếu không dựa được vào tên, thử đọc metadata
+            # Nếu không dựa được vào tên, thử đọc metadata (ưu tiên bộ đệm header)
             try:
-                dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
-                modality = getattr(dcm, 'Modality', 'Unknown')
+                modality = header_cache.get_or_compute(file_path, HEADER_CACHE_NAMESPACE, read_modality)['modality']
                 
                 if modality == 'CT':
                     ct_planning_files.append(file_path)
@@ -1,13 +1,16 @@
 import os
 import glob
+import json
 import shutil
-import pydicom
+import sqlite3
 import argparse
 import pandas as pd
 from datetime import datetime
 from collections import defaultdict
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
+from dicom_header_cache import get_header_cache, file_fingerprint, versioned_namespace
+from dicom_header_reader import read_header
 
 def extract_patient_id_from_filename(filename):
     """Trích xuất ID bệnh nhân từ tên file"""
@@ -16,10 +19,64 @@ def extract_patient_id_from_filename(filename):
         return parts[1]
     return None
 
+# Tiền tố tên file -> loại file
+FILENAME_PREFIXES = {
+    "CT": "CT",  # CT Image
+    "RI": "RI",  # RT Image (CBCT, MV, kV)
+    "RS": "RS",  # RT Structure Set
+    "RE": "RE",  # RT Registration
+    "RT": "RT",  # RT Plan
+    "RD": "RD",  # RT Dose
+}
+
+# Loại file -> Modality tương ứng (dùng khi suy ra từ tên file)
+FILE_TYPE_MODALITIES = {
+    "CT": "CT",
+    "RI": "RTIMAGE",
+    "RS": "RTSTRUCT",
+    "RE": "REG",
+    "RT": "RTPLAN",
+    "RD": "RTDOSE",
+}
+
+def file_type_from_filename(filename):
+    """Xác định loại file từ tiền tố tên file, None nếu không có tiền tố đã biết"""
+    for prefix, type_value in FILENAME_PREFIXES.items():
+        if filename.startswith(prefix + "."):
+            return type_value
+    return None
+
+def is_cbct_filename(filename, file_type):
+    """Kiểm tra tên file có dấu hiệu là ảnh CBCT hay không"""
+    if "CBCT" in filename.upper() or "CONE" in filename.upper():
+        return True
+    return file_type == "RI" and ("MV" in filename or "KV" in filename)
+
+def date_from_path(file_path):
+    """Tìm thư mục ngày dạng YYYY-MM-DD trong đường dẫn, None nếu không có"""
+    for part in file_path.split(os.sep):
+        if len(part) == 10 and part.count('-') == 2:  # Định dạng YYYY-MM-DD
+            return part
+    return None
+
+# Các tag header mà extract_dicom_info sử dụng (chỉ đọc các tag này)
+HEADER_TAGS = [
+    'PatientID',
+    'Modality',
+    'SOPClassUID',
+    'AcquisitionDate',
+    'ContentDate',
+    'SeriesDate',
+    'StudyDate',
+    'InstanceCreationDate',
+    'StructureSetDate',
+    'SeriesDescription'
+]
+
 def extract_dicom_info(file_path):
     """Trích xuất thông tin quan trọng từ file DICOM"""
     try:
-        dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
+        dcm = read_header(file_path, HEADER_TAGS)
         
         # Trích xuất ID bệnh nhân từ metadata hoặc tên file
         filename = os.path.basename(file_path)
@@ -27,24 +84,8 @@ def extract_dicom_info(file_path):
         if not patient_id:
             patient_id = extract_patient_id_from_filename(filename)
         
-        # Xác định loại file từ tên file hoặc metadata
-        file_type = None
-        
-        # Phát hiện loại file từ tiền tố tên file
-        known_prefixes = {
-            "CT": "CT",  # CT Image
-            "RI": "RI",  # RT Image (CBCT, MV, kV)
-            "RS": "RS",  # RT Structure Set
-            "RE": "RE",  # RT Registration
-            "RT": "RT",  # RT Plan
-            "RD": "RD",  # RT Dose
-        }
-        
-        # Kiểm tra tiền tố tên file
-        for prefix, type_value in known_prefixes.items():
-            if filename.startswith(prefix + "."):
-                file_type = type_value
-                break
+        # Xác định loại file từ tiền tố tên file hoặc metadata
+        file_type = file_type_from_filename(filename)
         
         # Nếu không xác định được từ tên file, thử dựa vào modality và SOP Class
         if not file_type:
@@ -69,11 +110,7 @@ def extract_dicom_info(file_path):
                 file_type = "OTHER"
         
         # Kiểm tra xem có phải CBCT không
-        is_cbct = False
-        if "CBCT" in filename.upper() or "CONE" in filename.upper():
-            is_cbct = True
-        if file_type == "RI" and ("MV" in filename or "KV" in filename):
-            is_cbct = True
+        is_cbct = is_cbct_filename(filename, file_type)
             
         # Trích xuất ngày chụp
         acquisition_date = None
@@ -107,10 +144,7 @@ def extract_dicom_info(file_path):
                 pass
         else:
             # Nếu không tìm thấy ngày trong metadata, thử trích xuất từ đường dẫn
-            for part in file_path.split(os.sep):
-                if len(part) == 10 and part.count('-') == 2:  # Định dạng YYYY-MM-DD
-                    acquisition_date = part
-                    break
+            acquisition_date = date_from_path(file_path)
             
             # Nếu vẫn không tìm thấy, đặt là "unknown_date"
             if not acquisition_date:
@@ -136,6 +170,41 @@ def extract_dicom_info(file_path):
         print(f"Lỗi khi đọc file {file_path}: {e}")
         return None
 
+def infer_dicom_info_from_path(file_path):
+    """Suy ra thông tin sắp xếp chỉ từ đường dẫn và tên file, không mở file
+    
+    Dùng khi quy ước đặt tên được tin cậy (--trust-filenames). Trả về None nếu
+    tên file không có tiền tố đã biết, không có ID bệnh nhân hoặc đường dẫn
+    không chứa thư mục ngày; khi đó cần đọc header.
+    
+    is_cbct chỉ dựa vào tên file: file CT.* có SeriesDescription chứa CBCT/CONE
+    nhưng tên file không có dấu hiệu này sẽ được xếp vào CT lập kế hoạch (chế
+    độ đọc header xếp nó vào CBCT).
+    """
+    filename = os.path.basename(file_path)
+    file_type = file_type_from_filename(filename)
+    patient_id = extract_patient_id_from_filename(filename)
+    acquisition_date = date_from_path(file_path)
+    
+    if not file_type or not patient_id or not acquisition_date:
+        return None
+    
+    try:
+        datetime.strptime(acquisition_date, '%Y-%m-%d')
+    except ValueError:
+        return None
+    
+    return {
+        'path': file_path,
+        'patient_id': patient_id,
+        'file_type': file_type,
+        'is_cbct': is_cbct_filename(filename, file_type),
+        'acquisition_date': acquisition_date,
+        'filename': filename,
+        'modality': FILE_TYPE_MODALITIES[file_type],
+        'series_desc': ''
+    }
+
 # Phạm vi lớp này được định nghĩa ở mức top-level để có thể picklable
 class PatientTreatmentInfo:
     def __init__(self):
@@ -146,19 +215,93 @@ class PatientTreatmentInfo:
         self.ct_files = []  # Danh sách file CT
         self.cbct_files = []  # Danh sách file CBCT/RI
 
-def determine_treatment_dates(input_dir):
-    """Xác định ngày bắt đầu điều trị và các ngày điều trị tiếp theo cho mỗi bệnh nhân"""
+# Số file trong mỗi lô gửi đến tiến trình con
+CHUNK_SIZE = 256
+
+# Namespace của script này trong bộ đệm header dùng chung
+# (tăng phiên bản khi extract_dicom_info trả về các trường khác)
+HEADER_CACHE_NAMESPACE = versioned_namespace('organizer', 1)
+
+def _chunked(items, chunk_size):
+    """Chia danh sách thành các lô (vị trí bắt đầu, lô)"""
+    for start in range(0, len(items), chunk_size):
+        yield start, items[start:start + chunk_size]
+
+def _extract_headers_chunk(file_paths):
+    """Đọc header cho một lô file trong tiến trình con, trả về list dict thuần (picklable)"""
+    return [extract_dicom_info(file_path) for file_path in file_paths]
+
+def scan_dicom_headers(dicom_files, max_workers=1, chunk_size=CHUNK_SIZE, trust_filenames=False):
+    """Đọc header của tất cả file DICOM đúng một lần và tạo bảng thông tin trong bộ nhớ
+    
+    Trả về dictionary {đường dẫn file: info} theo thứ tự của dicom_files,
+    info là None nếu không đọc được file. Header của file không thay đổi được
+    lấy từ bộ đệm dùng chung; nếu max_workers > 1, các file còn lại được đọc
+    song song theo lô bằng ProcessPoolExecutor. Nếu trust_filenames=True,
+    thông tin được suy ra từ đường dẫn và tên file khi có thể, chỉ các file
+    không rõ ràng mới phải đọc header.
+    """
+    # Suy ra thông tin từ đường dẫn/tên file nếu quy ước đặt tên được tin cậy
+    inferred = {}
+    if trust_filenames:
+        for file_path in dicom_files:
+            info = infer_dicom_info_from_path(file_path)
+            if info is not None:
+                inferred[file_path] = info
+        print(f"Suy ra thông tin từ tên file cho {len(inferred)}/{len(dicom_files)} file "
+              f"(bỏ qua {len(inferred)} lần đọc header)")
+    
+    # Lấy các header đã có trong bộ đệm (file không thay đổi kể từ lần chạy trước)
+    header_cache = get_header_cache()
+    remaining = [file_path for file_path in dicom_files if file_path not in inferred]
+    cached = header_cache.get_many(remaining, HEADER_CACHE_NAMESPACE)
+    for file_path, info in cached.items():
+        info['path'] = file_path
+    cached.update(inferred)
+    pending = [file_path for file_path in remaining if file_path not in cached]
+    if len(cached) > len(inferred):
+        print(f"Dùng lại header từ bộ đệm cho {len(cached) - len(inferred)}/{len(remaining)} file")
+    
+    if max_workers <= 1 or len(pending) <= chunk_size:
+        infos = [extract_dicom_info(file_path) for file_path in tqdm(pending, desc="Đang đọc header DICOM")]
+    else:
+        # Ghi kết quả theo vị trí để thứ tự không phụ thuộc vào tiến trình nào xong trước
+        infos = [None] * len(pending)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_extract_headers_chunk, chunk): (start, len(chunk))
+                for start, chunk in _chunked(pending, chunk_size)
+            }
+            with tqdm(total=len(pending), desc="Đang đọc header DICOM") as pbar:
+                for future in as_completed(futures):
+                    start, size = futures[future]
+                    try:
+                        infos[start:start + size] = future.result()
+                    except Exception as e:
+                        print(f"Lỗi khi đọc lô header bắt đầu tại file {start}: {e}")
+                    pbar.update(size)
+    
+    # Lưu các header mới đọc vào bộ đệm
+    header_cache.put_many(HEADER_CACHE_NAMESPACE, zip(pending, infos))
+    
+    parsed = dict(zip(pending, infos))
+    return {
+        file_path: cached[file_path] if file_path in cached else parsed[file_path]
+        for file_path in dicom_files
+    }
+
+def determine_treatment_dates(header_index):
+    """Xác định ngày bắt đầu điều trị và các ngày điều trị tiếp theo cho mỗi bệnh nhân
+    
+    header_index là bảng thông tin header do scan_dicom_headers tạo ra
+    """
     print("Xác định ngày điều trị cho mỗi bệnh nhân...")
     
     # Dictionary lưu trữ thông tin điều trị
     patient_treatment_info = {}
     
-    # Tìm tất cả file DICOM
-    dicom_files = glob.glob(os.path.join(input_dir, "**/*.dcm"), recursive=True)
-    
-    # Quét qua tất cả file để xác định ngày điều trị
-    for file_path in tqdm(dicom_files, desc="Đang phân tích ngày điều trị"):
-        info = extract_dicom_info(file_path)
+    # Dùng bảng header đã đọc để xác định ngày điều trị
+    for file_path, info in header_index.items():
         if not info or not info['patient_id'] or info['acquisition_date'] == 'unknown_date':
             continue
             
@@ -201,17 +344,8 @@ def determine_treatment_dates(input_dir):
     print(f"Đã xác định thông tin điều trị cho {len(patient_treatment_info)} bệnh nhân")
     return first_dates
 
-def process_file(file_path, output_dir, copy_files, first_dates):
-    """Xử lý một file DICOM và sắp xếp vào thư mục phù hợp"""
-    info = extract_dicom_info(file_path)
-    if not info:
-        return False
-    
-    # Bỏ qua nếu không có ID bệnh nhân
-    if not info['patient_id']:
-        print(f"Bỏ qua file không có ID bệnh nhân: {file_path}")
-        return False
-    
+def resolve_destination(info, output_dir, first_dates):
+    """Xác định loại file được gán và đường dẫn đích từ thông tin header"""
     patient_id = info['patient_id']
     original_file_type = info['file_type']
     acquisition_date = info['acquisition_date']
@@ -231,16 +365,23 @@ def process_file(file_path, output_dir, copy_files, first_dates):
         if acquisition_date != first_date:
             file_type = 'CBCT'
     
-    # Tạo đường dẫn đến thư mục đích
-    patient_folder = os.path.join(output_dir, patient_id)
-    type_folder = os.path.join(patient_folder, file_type)
-    date_folder = os.path.join(type_folder, acquisition_date)
+    # Đường dẫn đến file đích: patient_id/type/date/filename
+    dest_path = os.path.join(output_dir, patient_id, file_type, acquisition_date, info['filename'])
     
+    return {
+        'success': True,
+        'source_path': info['path'],
+        'patient_id': patient_id,
+        'original_type': original_file_type,
+        'assigned_type': file_type,
+        'date': acquisition_date,
+        'dest_path': dest_path
+    }
+
+def place_file(file_path, dest_path, copy_files):
+    """Sao chép hoặc tạo symbolic link từ file nguồn đến đường dẫn đích"""
     # Tạo thư mục nếu chưa tồn tại
-    os.makedirs(date_folder, exist_ok=True)
-    
-    # Đường dẫn đến file đích
-    dest_path = os.path.join(date_folder, info['filename'])
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
     
     # Sao chép hoặc tạo symbolic link
     if not os.path.exists(dest_path):
@@ -254,24 +395,45 @@ def process_file(file_path, output_dir, copy_files, first_dates):
                 print(f"Không thể tạo symlink cho {file_path}: {e}. Đang sao chép file...")
                 # Nếu không tạo được symlink, sao chép file
                 shutil.copy2(file_path, dest_path)
+
+def process_file(file_path, output_dir, copy_files, first_dates, info=None):
+    """Xử lý một file DICOM và sắp xếp vào thư mục phù hợp
     
-    return {
-        'success': True,
-        'patient_id': patient_id,
-        'original_type': original_file_type,
-        'assigned_type': file_type,
-        'date': acquisition_date
-    }
+    Nếu đã có info từ bảng header thì dùng lại, không đọc lại file
+    """
+    if info is None:
+        info = extract_dicom_info(file_path)
+    if not info:
+        return False
+    
+    # Bỏ qua nếu không có ID bệnh nhân
+    if not info['patient_id']:
+        print(f"Bỏ qua file không có ID bệnh nhân: {file_path}")
+        return False
+    
+    result = resolve_destination(info, output_dir, first_dates)
+    place_file(file_path, result['dest_path'], copy_files)
+    
+    return result
 
-def process_files_sequentially(dicom_files, output_dir, copy_files, first_dates):
+def process_files_sequentially(dicom_files, output_dir, copy_files, first_dates, header_index=None):
     """Xử lý các file theo tuần tự thay vì song song"""
+    if header_index is None:
+        header_index = {}
+    
     processed_count = 0
     failed_files = []
     results = []
     
     for file_path in tqdm(dicom_files, desc="Đang xử lý"):
+        # File đã đọc lỗi ở bước quét header thì không đọc lại
+        if file_path in header_index and header_index[file_path] is None:
+            failed_files.append(file_path)
+            continue
+        
         try:
-            result = process_file(file_path, output_dir, copy_files, first_dates)
+            result = process_file(file_path, output_dir, copy_files, first_dates,
+                                  info=header_index.get(file_path))
             if result and result.get('success', False):
                 processed_count += 1
                 results.append(result)
@@ -283,31 +445,179 @@ def process_files_sequentially(dicom_files, output_dir, copy_files, first_dates)
     
     return processed_count, failed_files, results
 
-def organize_dicom_files(input_dir, output_dir, copy_files=True, max_workers=4):
-    """Tổ chức lại các file DICOM theo bệnh nhân, loại và ngày"""
-    print(f"Đang quét thư mục {input_dir} để tìm tất cả file DICOM...")
+def _place_files_chunk(tasks, copy_files):
+    """Đặt một lô file vào thư mục đích trong tiến trình con
     
-    # Xác định ngày điều trị cho mỗi bệnh nhân
-    first_dates = determine_treatment_dates(input_dir)
+    Trả về list thông báo lỗi (None nếu thành công) theo đúng thứ tự của tasks
+    """
+    errors = []
+    for file_path, dest_path in tasks:
+        try:
+            place_file(file_path, dest_path, copy_files)
+            errors.append(None)
+        except Exception as e:
+            errors.append(str(e))
+    return errors
+
+def process_files_parallel(dicom_files, output_dir, copy_files, first_dates, header_index,
+                           max_workers=4, chunk_size=CHUNK_SIZE):
+    """Xử lý các file song song bằng ProcessPoolExecutor
+    
+    Đường dẫn đích được xác định trước trong tiến trình chính (file đầu tiên
+    theo thứ tự của dicom_files giữ đích nếu trùng tên), tiến trình con chỉ
+    sao chép/tạo liên kết. Kết quả giống hệt xử lý tuần tự.
+    """
+    planned = {}
+    tasks = []
+    claimed_dests = set()
+    
+    for file_path in dicom_files:
+        info = header_index.get(file_path)
+        if not info:
+            continue
+        if not info['patient_id']:
+            print(f"Bỏ qua file không có ID bệnh nhân: {file_path}")
+            continue
+        
+        result = resolve_destination(info, output_dir, first_dates)
+        planned[file_path] = result
+        if result['dest_path'] not in claimed_dests:
+            claimed_dests.add(result['dest_path'])
+            tasks.append((file_path, result['dest_path']))
+    
+    # Sao chép/tạo liên kết song song theo lô
+    placement_errors = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_place_files_chunk, chunk, copy_files): chunk
+            for _, chunk in _chunked(tasks, chunk_size)
+        }
+        with tqdm(total=len(tasks), desc="Đang xử lý") as pbar:
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    chunk_errors = future.result()
+                except Exception as e:
+                    chunk_errors = [str(e)] * len(chunk)
+                for (file_path, _), error in zip(chunk, chunk_errors):
+                    if error:
+                        placement_errors[file_path] = error
+                pbar.update(len(chunk))
+    
+    # Tổng hợp kết quả theo thứ tự đầu vào
+    processed_count = 0
+    failed_files = []
+    results = []
+    for file_path in dicom_files:
+        if file_path not in planned:
+            failed_files.append(file_path)
+        elif file_path in placement_errors:
+            print(f"Lỗi khi xử lý {file_path}: {placement_errors[file_path]}")
+            failed_files.append(file_path)
+        else:
+            processed_count += 1
+            results.append(planned[file_path])
     
-    # Tìm tất cả file DICOM trong thư mục đầu vào
-    dicom_files = glob.glob(os.path.join(input_dir, "**/*.dcm"), recursive=True)
-    total_files = len(dicom_files)
+    return processed_count, failed_files, results
+
+# Tên file manifest lưu trong thư mục đầu ra (dùng cho chế độ --incremental)
+MANIFEST_FILENAME = 'organize_manifest.sqlite'
+
+def _open_manifest(output_dir):
+    """Mở (hoặc tạo) file manifest trong thư mục đầu ra"""
+    conn = sqlite3.connect(os.path.join(output_dir, MANIFEST_FILENAME))
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS manifest ('
+        ' source TEXT PRIMARY KEY,'
+        ' size INTEGER NOT NULL,'
+        ' mtime_ns INTEGER NOT NULL,'
+        ' patient_id TEXT NOT NULL,'
+        ' dest_path TEXT NOT NULL,'
+        ' info TEXT NOT NULL)'
+    )
+    return conn
+
+def load_manifest(output_dir):
+    """Đọc manifest các file nguồn đã được sắp xếp ở những lần chạy trước
     
-    if total_files == 0:
-        print("Không tìm thấy file DICOM nào!")
-        return
+    Trả về dictionary {đường dẫn tuyệt đối của file nguồn: entry}, mỗi entry gồm
+    size, mtime_ns, patient_id, dest_path (tương đối so với output_dir) và info
+    (thông tin header đã dùng để sắp xếp).
+    """
+    if not os.path.exists(os.path.join(output_dir, MANIFEST_FILENAME)):
+        return {}
     
-    print(f"Tìm thấy {total_files} file DICOM. Đang phân loại...")
+    conn = _open_manifest(output_dir)
+    try:
+        rows = conn.execute('SELECT source, size, mtime_ns, patient_id, dest_path, info FROM manifest').fetchall()
+    finally:
+        conn.close()
     
-    # Tạo thư mục đầu ra nếu chưa tồn tại
-    os.makedirs(output_dir, exist_ok=True)
+    return {
+        source: {
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'patient_id': patient_id,
+            'dest_path': dest_path,
+            'info': json.loads(info)
+        }
+        for source, size, mtime_ns, patient_id, dest_path, info in rows
+    }
+
+def update_manifest(output_dir, results, header_index, replace=False):
+    """Ghi kết quả sắp xếp vào manifest
     
-    # Xử lý tuần tự thay vì song song để tránh lỗi pickle
-    processed_count, failed_files, results = process_files_sequentially(
-        dicom_files, output_dir, copy_files, first_dates
-    )
+    results là danh sách kết quả từ resolve_destination/process_file, header_index
+    cung cấp thông tin header của từng file nguồn. Nếu replace=True, toàn bộ
+    manifest cũ bị thay thế.
+    """
+    rows = []
+    for result in results:
+        file_path = result['source_path']
+        fingerprint = file_fingerprint(file_path)
+        if fingerprint is None:
+            continue
+        rows.append((
+            os.path.abspath(file_path), fingerprint[0], fingerprint[1], result['patient_id'],
+            os.path.relpath(result['dest_path'], output_dir),
+            json.dumps(header_index[file_path], default=str)
+        ))
     
+    conn = _open_manifest(output_dir)
+    try:
+        with conn:
+            if replace:
+                conn.execute('DELETE FROM manifest')
+            conn.executemany('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)', rows)
+    finally:
+        conn.close()
+
+def _remove_empty_dirs(folder, stop_dir):
+    """Xóa các thư mục rỗng từ folder ngược lên đến stop_dir (không xóa stop_dir)"""
+    stop_dir = os.path.abspath(stop_dir)
+    folder = os.path.abspath(folder)
+    while folder != stop_dir and folder.startswith(stop_dir) and os.path.isdir(folder):
+        if os.listdir(folder):
+            break
+        os.rmdir(folder)
+        folder = os.path.dirname(folder)
+
+def relocate_file(file_path, old_dest, new_dest, copy_files, output_dir):
+    """Chuyển file đã sắp xếp (bản sao hoặc symlink) từ old_dest sang new_dest"""
+    if not os.path.lexists(old_dest):
+        # File đích cũ đã mất, đặt lại từ file nguồn
+        place_file(file_path, new_dest, copy_files)
+        return
+    
+    os.makedirs(os.path.dirname(new_dest), exist_ok=True)
+    if os.path.lexists(new_dest):
+        os.remove(old_dest)
+    else:
+        shutil.move(old_dest, new_dest)
+    _remove_empty_dirs(os.path.dirname(old_dest), output_dir)
+
+def _report_results(processed_count, total_files, failed_files, results, output_dir):
+    """In thống kê chuyển đổi loại file và ghi danh sách file thất bại"""
     print(f"\nĐã xử lý thành công {processed_count}/{total_files} file DICOM.")
     
     # Thống kê kết quả phân loại
@@ -329,6 +639,158 @@ def organize_dicom_files(input_dir, output_dir, copy_files=True, max_workers=4):
             for file_path in failed_files:
                 f.write(f"{file_path}\n")
         print(f"Danh sách file thất bại được lưu tại: {log_file}")
+
+def _place_files(dicom_files, output_dir, copy_files, first_dates, header_index, max_workers):
+    """Đặt file vào thư mục đích, song song nếu có nhiều tiến trình, ngược lại tuần tự"""
+    if max_workers > 1:
+        return process_files_parallel(
+            dicom_files, output_dir, copy_files, first_dates, header_index, max_workers
+        )
+    return process_files_sequentially(
+        dicom_files, output_dir, copy_files, first_dates, header_index
+    )
+
+def organize_dicom_files(input_dir, output_dir, copy_files=True, max_workers=4, incremental=False,
+                         trust_filenames=False):
+    """Tổ chức lại các file DICOM theo bệnh nhân, loại và ngày"""
+    if incremental:
+        return organize_dicom_files_incremental(input_dir, output_dir, copy_files, max_workers,
+                                                trust_filenames)
+    
+    print(f"Đang quét thư mục {input_dir} để tìm tất cả file DICOM...")
+    
+    # Tìm tất cả file DICOM trong thư mục đầu vào (chỉ quét một lần)
+    dicom_files = glob.glob(os.path.join(input_dir, "**/*.dcm"), recursive=True)
+    total_files = len(dicom_files)
+    
+    if total_files == 0:
+        print("Không tìm thấy file DICOM nào!")
+        return
+    
+    # Đọc header một lần duy nhất, dùng chung cho cả hai giai đoạn
+    header_index = scan_dicom_headers(dicom_files, max_workers, trust_filenames=trust_filenames)
+    
+    # Xác định ngày điều trị cho mỗi bệnh nhân
+    first_dates = determine_treatment_dates(header_index)
+    
+    print(f"Tìm thấy {total_files} file DICOM. Đang phân loại...")
+    
+    # Tạo thư mục đầu ra nếu chưa tồn tại
+    os.makedirs(output_dir, exist_ok=True)
+    
+    processed_count, failed_files, results = _place_files(
+        dicom_files, output_dir, copy_files, first_dates, header_index, max_workers
+    )
+    
+    # Ghi manifest để các lần chạy --incremental sau chỉ xử lý phần thay đổi
+    update_manifest(output_dir, results, header_index, replace=True)
+    
+    _report_results(processed_count, total_files, failed_files, results, output_dir)
+    
+    # Tạo báo cáo tổng hợp
+    create_summary_report(output_dir)
+    
+    print(f"Các file đã được tổ chức vào thư mục: {output_dir}")
+
+def organize_dicom_files_incremental(input_dir, output_dir, copy_files=True, max_workers=4,
+                                     trust_filenames=False):
+    """Chỉ xử lý các file mới hoặc đã thay đổi so với manifest của lần chạy trước
+    
+    Ngày đầu tiên chỉ được tính lại cho các bệnh nhân có file thay đổi; nếu ngày
+    CT đầu tiên của bệnh nhân thay đổi, các file đã sắp xếp được chuyển sang
+    thư mục đúng.
+    """
+    manifest = load_manifest(output_dir)
+    if not manifest:
+        print("Chưa có manifest trong thư mục đầu ra, chạy tổ chức toàn bộ...")
+        return organize_dicom_files(input_dir, output_dir, copy_files, max_workers,
+                                    trust_filenames=trust_filenames)
+    
+    print(f"Đang quét thư mục {input_dir} để tìm file DICOM mới hoặc đã thay đổi...")
+    dicom_files = glob.glob(os.path.join(input_dir, "**/*.dcm"), recursive=True)
+    
+    # So sánh kích thước và mtime với manifest để tìm phần thay đổi
+    delta_files = []
+    for file_path in dicom_files:
+        entry = manifest.get(os.path.abspath(file_path))
+        if entry is None or file_fingerprint(file_path) != (entry['size'], entry['mtime_ns']):
+            delta_files.append(file_path)
+    
+    current_sources = {os.path.abspath(file_path) for file_path in dicom_files}
+    missing_count = sum(1 for source in manifest if source not in current_sources)
+    
+    print(f"Tìm thấy {len(dicom_files)} file DICOM: {len(delta_files)} file mới/thay đổi, "
+          f"{len(dicom_files) - len(delta_files)} file không đổi")
+    if missing_count:
+        print(f"{missing_count} file nguồn trong manifest không còn tồn tại (giữ nguyên trong thư mục đầu ra)")
+    
+    if not delta_files:
+        print("Không có file nào cần xử lý.")
+        return
+    
+    # Chỉ đọc header của các file thay đổi
+    header_index = scan_dicom_headers(delta_files, max_workers, trust_filenames=trust_filenames)
+    delta_sources = {os.path.abspath(file_path): file_path for file_path in delta_files}
+    
+    # Các bệnh nhân bị ảnh hưởng bởi phần thay đổi
+    touched_patients = set()
+    for source, file_path in delta_sources.items():
+        info = header_index[file_path]
+        if info and info['patient_id']:
+            touched_patients.add(info['patient_id'])
+        if source in manifest:
+            touched_patients.add(manifest[source]['patient_id'])
+    
+    # Tính lại ngày đầu tiên chỉ cho các bệnh nhân bị ảnh hưởng
+    patient_index = {
+        source: entry['info'] for source, entry in manifest.items()
+        if entry['patient_id'] in touched_patients and source not in delta_sources
+    }
+    patient_index.update(header_index)
+    first_dates = determine_treatment_dates(patient_index)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Chuyển các file đã sắp xếp nếu ngày đầu tiên của bệnh nhân thay đổi
+    relocated_results = []
+    relocated_index = {}
+    for source, entry in manifest.items():
+        if entry['patient_id'] not in touched_patients or source in delta_sources:
+            continue
+        
+        result = resolve_destination(entry['info'], output_dir, first_dates)
+        if os.path.relpath(result['dest_path'], output_dir) == entry['dest_path']:
+            continue
+        
+        try:
+            relocate_file(source, os.path.join(output_dir, entry['dest_path']), result['dest_path'],
+                          copy_files, output_dir)
+            result['source_path'] = source
+            relocated_results.append(result)
+            relocated_index[source] = entry['info']
+        except Exception as e:
+            print(f"Lỗi khi chuyển {entry['dest_path']}: {e}")
+    
+    if relocated_results:
+        print(f"Đã chuyển {len(relocated_results)} file đã sắp xếp do ngày CT đầu tiên thay đổi")
+    
+    # Xóa file đích cũ của các file nguồn đã thay đổi để đặt lại bản mới
+    for source in delta_sources:
+        if source in manifest:
+            old_dest = os.path.join(output_dir, manifest[source]['dest_path'])
+            if os.path.lexists(old_dest):
+                os.remove(old_dest)
+                _remove_empty_dirs(os.path.dirname(old_dest), output_dir)
+    
+    processed_count, failed_files, results = _place_files(
+        delta_files, output_dir, copy_files, first_dates, header_index, max_workers
+    )
+    
+    # Cập nhật manifest cho các file vừa đặt và các file đã chuyển
+    update_manifest(output_dir, results, header_index)
+    update_manifest(output_dir, relocated_results, relocated_index)
+    
+    _report_results(processed_count, len(delta_files), failed_files, results, output_dir)
     
     # Tạo báo cáo tổng hợp
     create_summary_report(output_dir)
@@ -413,7 +875,14 @@ def main():
     parser.add_argument('input_dir', help='Thư mục chứa các file DICOM')
     parser.add_argument('--output', '-o', default='organized_dicom', help='Thư mục đầu ra')
     parser.add_argument('--link', '-l', action='store_true', help='Tạo symbolic link thay vì sao chép file')
-    parser.add_argument('--workers', '-w', type=int, default=4, help='Số luồng xử lý song song')
+    parser.add_argument('--workers', '-w', type=int, default=4, help='Số tiến trình xử lý song song (1 = xử lý tuần tự)')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='Chỉ xử lý file mới hoặc đã thay đổi so với lần chạy trước (dựa vào manifest trong thư mục đầu ra)')
+    parser.add_argument('--trust-filenames', action='store_true',
+                        help='Tin cậy quy ước đặt tên: suy ra loại, bệnh nhân và ngày từ tên file và thư mục ngày, '
+                             'chỉ đọc header cho file không rõ ràng. CBCT chỉ được nhận biết qua tên file '
+                             '(CBCT/CONE, hoặc RI.* có MV/KV): file CT.* có SeriesDescription CBCT/CONE '
+                             'sẽ được xếp vào CT lập kế hoạch')
     
     args = parser.parse_args()
     
@@ -423,7 +892,8 @@ def main():
     print(f"{action_type} các file DICOM từ {args.input_dir} đến {args.output}")
     
     start_time = datetime.now()
-    organize_dicom_files(args.input_dir, args.output, copy_files, args.workers)
+    organize_dicom_files(args.input_dir, args.output, copy_files, args.workers, args.incremental,
+                         args.trust_filenames)
     end_time = datetime.now()
     
     elapsed_time = end_time - start_time
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ghi báo cáo dạng luồng (CSV hoặc Parquet) cho các script duplicate_detection
+
+Thay vì gom tất cả các dòng báo cáo vào bộ nhớ rồi ghi một file Excel ở cuối,
+StreamingReportWriter ghi thêm các dòng vào file sau mỗi flush_every dòng. Bộ
+nhớ chỉ giữ một lô nhỏ, và với CSV nếu script dừng giữa chừng thì các dòng đã
+flush vẫn còn trong báo cáo. File Excel chỉ được tạo (nếu cần) bằng convert_to_excel
+ở bước cuối.
+"""
+
+import os
+import csv
+import pandas as pd
+
+# Các định dạng báo cáo được hỗ trợ
+REPORT_FORMATS = ['csv', 'parquet']
+
+# Số dòng giữ trong bộ nhớ trước khi ghi ra file
+DEFAULT_FLUSH_EVERY = 500
+
+# Các cột luôn đọc lại dưới dạng chuỗi từ CSV (ID bệnh nhân dạng số, ngày, hash...)
+TEXT_COLUMNS = ['Patient ID', 'Date', 'Base Name', 'Content Hash', 'SOPInstanceUID', 'Pixel Hash']
+
+class StreamingReportWriter:
+    """Ghi các dòng báo cáo (dictionary) ra file CSV/Parquet theo từng lô"""
+
+    def __init__(self, path, report_format='csv', flush_every=DEFAULT_FLUSH_EVERY):
+        """
+        Parameters:
+        path (str): Đường dẫn file báo cáo (được tạo khi có dòng đầu tiên)
+        report_format (str): 'csv' hoặc 'parquet'
+        flush_every (int): Số dòng tối đa giữ trong bộ nhớ trước khi ghi
+        """
+        if report_format not in REPORT_FORMATS:
+            raise ValueError(f"Định dạng báo cáo không hợp lệ: {report_format}")
+
+        self.path = path
+        self.report_format = report_format
+        self.flush_every = max(1, flush_every)
+        self.rows_written = 0
+        self._pending = []
+        self._columns = None
+        self._file = None
+        self._csv_writer = None
+        self._parquet_writer = None
+        self._schema = None
+
+        if report_format == 'parquet':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError("Cần cài đặt pyarrow để ghi báo cáo Parquet: pip install pyarrow")
+
+    def write(self, row):
+        """Thêm một dòng báo cáo, tự động flush khi đủ flush_every dòng"""
+        self._pending.append(row)
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Ghi các dòng đang chờ ra file"""
+        if not self._pending:
+            return
+
+        if self._columns is None:
+            self._columns = list(self._pending[0].keys())
+
+        if self.report_format == 'csv':
+            self._flush_csv()
+        else:
+            self._flush_parquet()
+
+        self.rows_written += len(self._pending)
+        self._pending = []
+
+    def _flush_csv(self):
+        if self._file is None:
+            self._file = open(self.path, 'w', newline='', encoding='utf-8')
+            self._csv_writer = csv.DictWriter(self._file, fieldnames=self._columns)
+            self._csv_writer.writeheader()
+        self._csv_writer.writerows(self._pending)
+        self._file.flush()
+
+    def _flush_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = {col: [row.get(col) for row in self._pending] for col in self._columns}
+        if self._parquet_writer is None:
+            table = pa.table(columns)
+            self._schema = table.schema
+            self._parquet_writer = pq.ParquetWriter(self.path, self._schema)
+        else:
+            table = pa.table(columns, schema=self._schema)
+        # Mỗi lần flush là một row group (footer của file được ghi khi close)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        """
+        Ghi các dòng còn lại và đóng file
+
+        Trả về đường dẫn báo cáo, hoặc None nếu không có dòng nào được ghi.
+        """
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        return self.path if self.rows_written else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_report(path):
+    """Đọc lại báo cáo CSV/Parquet vào DataFrame"""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, dtype={col: str for col in TEXT_COLUMNS}, keep_default_na=False)
+
+def convert_to_excel(path):
+    """Chuyển báo cáo CSV/Parquet sang file Excel cùng tên, trả về đường dẫn file Excel"""
+    excel_path = os.path.splitext(path)[0] + '.xlsx'
+    read_report(path).to_excel(excel_path, index=False)
+    return excel_path
@@ -1,6 +1,5 @@
 import os
 import sys
-import glob
 import pydicom
 import numpy as np
 import matplotlib.pyplot as plt
@@ -10,7 +9,13 @@ import pandas as pd
 from datetime import datetime
 import warnings
 import traceback
-import gdcm  # Thêm thư viện GDCM để hỗ trợ nhiều định dạng DICOM
+from concurrent.futures import ThreadPoolExecutor
+from dicom_header_cache import get_header_cache, versioned_namespace
+from dicom_header_reader import read_header
+from dicom_pixel_decoder import decode_dicom  # pydicom, dự phòng bằng GDCM
+from dicom_slice_cache import DEFAULT_CACHE_MB, LRUByteCache
+from dicom_tree_index import DirectoryTreeIndex
+from dicom_volume import load_series_volume
 
 # Tắt cảnh báo không cần thiết
 warnings.filterwarnings("ignore", category=UserWarning, module="matplotlib")
@@ -18,108 +23,26 @@ warnings.filterwarnings("ignore", category=UserWarning, module="matplotlib")
 # Đặt biến môi trường để sử dụng GDCM làm backend cho pydicom
 os.environ['PYDICOM_READER'] = 'GDCM'
 
-def fix_cbct_issues():
-    """
-    Áp dụng sửa lỗi cho ảnh CBCT và slider
-    
-    Hướng dẫn:
-    1. Thêm hàm này vào cuối file hiện tại của bạn
-    2. Gọi hàm này từ main() ngay sau khi tạo DicomComparisonTool
-    3. Khi được gọi, nó sẽ ghi đè các phương thức có vấn đề
-    """
-    # Lưu phương thức gốc
-    original_update_cbct = DicomComparisonTool._update_cbct_display
-    original_on_cbct_slice_change = DicomComparisonTool._on_cbct_slice_change
-    
-    def improved_update_cbct_display(self):
-        """Phương thức cải tiến để cập nhật hiển thị ảnh CBCT"""
-        cbct_files = self._get_dicom_files('CBCT')
-        
-        if not cbct_files:
-            # Không có file CBCT
-            self.cbct_img.set_data(np.ones((512, 512)))
-            self.ax_cbct.set_title(f"CBCT (không có dữ liệu)")
-            return
-        
-        # Đảm bảo chỉ số hợp lệ
-        if self.cbct_slice_idx >= len(cbct_files):
-            self.cbct_slice_idx = 0
-        
-        # Tải ảnh CBCT
-        file_path = cbct_files[self.cbct_slice_idx]
-        filename = os.path.basename(file_path)
-        
-        # PHƯƠNG PHÁP 1: Dùng API đơn giản cho hiển thị thử nghiệm
-        try:
-            # Tạo mảng hình ảnh mẫu
-            sample_img = np.ones((512, 512)) * 0.5
-            
-            # Thêm lưới
-            for i in range(0, 512, 64):
-                sample_img[i:i+2, :] = 0.8
-                sample_img[:, i:i+2] = 0.8
-            
-            # Vòng tròn tương trưng beam
-            center_x, center_y = 256, 256
-            radius = 180
-            y, x = np.ogrid[:512, :512]
-            dist = np.sqrt((x - center_x)**2 + (y - center_y)**2)
-            
-            # Tạo pattern tròn
-            mask = dist <= radius
-            sample_img[mask] = 0.7
-            
-            # Tạo pattern nhỏ hơn (tạo hiệu ứng khác nhau giữa các slice)
-            inner_radius = 50 + (self.cbct_slice_idx * 5) % 100
-            inner_mask = dist <= inner_radius
-            sample_img[inner_mask] = 0.3
-            
-            # Hiển thị mảng mẫu
-            self.cbct_img.set_data(sample_img)
-            self.ax_cbct.set_title(f"CBCT - {self.current_date} - Slice {self.cbct_slice_idx+1}/{len(cbct_files)}")
-            
-            # In thông báo xác nhận
-            print(f"Đã hiển thị ảnh CBCT mẫu cho file: {filename}")
-            
-            # Bảo đảm update
-            self.fig.canvas.draw_idle()
-            return
-            
-        except Exception as e:
-            print(f"Lỗi khi tạo ảnh CBCT mẫu: {e}")
-            
-            # Nếu lỗi, hiển thị ảnh trống với thông báo
-            self.cbct_img.set_data(np.ones((512, 512)) * 0.2)
-            self.ax_cbct.set_title(f"CBCT - {filename} - Lỗi hiển thị")
-            
-            # Bảo đảm update
-            self.fig.canvas.draw_idle()
-    
-    def improved_on_cbct_slice_change(self, val):
-        """Xử lý sự kiện khi thanh trượt CBCT thay đổi - phiên bản cải tiến"""
-        try:
-            # Cập nhật chỉ số slice
-            self.cbct_slice_idx = int(val)
-            
-            # Cập nhật hiển thị
-            improved_update_cbct_display(self)
-            self._update_info_display()
-            
-            # Đảm bảo vẽ lại canvas
-            self.fig.canvas.draw_idle()
-            
-            # In thông báo xác nhận
-            print(f"CBCT slice đã thay đổi thành: {self.cbct_slice_idx+1}")
-        except Exception as e:
-            print(f"Lỗi trong improved_on_cbct_slice_change: {e}")
-            traceback.print_exc()
-    
-    # Ghi đè phương thức bị lỗi
-    DicomComparisonTool._update_cbct_display = improved_update_cbct_display
-    DicomComparisonTool._on_cbct_slice_change = improved_on_cbct_slice_change
-    
-    print("Đã áp dụng sửa lỗi cho CBCT display và slider!")
+# Namespace của script này trong bộ đệm header dùng chung
+# (tăng phiên bản khi read_info_header trả về các trường khác)
+HEADER_CACHE_NAMESPACE = versioned_namespace('verifier', 1)
+
+# Số luồng giải mã ảnh nền cho hai khung CT và CBCT
+DECODE_WORKERS = 2
+
+# Chu kỳ (ms) luồng giao diện kiểm tra các ảnh/volume đã giải mã xong
+DECODE_POLL_MS = 50
 
+def read_info_header(file_path):
+    """Đọc các trường header cần cho khung thông tin (chỉ đọc các tag này)"""
+    dcm = read_header(file_path, ['Modality', 'SeriesDescription', 'Rows', 'Columns'])
+    return {
+        'Modality': str(getattr(dcm, 'Modality', 'N/A')),
+        'Rows': getattr(dcm, 'Rows', 'N/A'),
+        'Columns': getattr(dcm, 'Columns', 'N/A'),
+        'SeriesDescription': str(getattr(dcm, 'SeriesDescription', 'N/A')),
+        'HasPixelData': hasattr(dcm, 'PixelData')
+    }
 
 def apply_complete_ui_fix():
     """
@@ -298,15 +221,21 @@ def apply_complete_ui_fix():
 
 
 class DicomComparisonTool:
-    def __init__(self, root_dir):
-        """Khởi tạo công cụ so sánh DICOM"""
+    def __init__(self, root_dir, cache_mb=DEFAULT_CACHE_MB):
+        """Khởi tạo công cụ so sánh DICOM (cache_mb: dung lượng bộ đệm ảnh, MB)"""
         self.root_dir = root_dir
         
-        # Quét cấu trúc thư mục để tạo cây dữ liệu
-        self.data_tree = self._scan_directory_structure()
+        # Chỉ mục thư mục đã lưu (chỉ quét lại thư mục thay đổi)
+        self.tree_index = DirectoryTreeIndex(root_dir)
         
-        # Tìm tất cả bệnh nhân
-        self.patients = list(self.data_tree.keys())
+        # Cây dữ liệu theo bệnh nhân, mỗi bệnh nhân được quét khi được chọn lần đầu
+        # (các bệnh nhân kề bên được quét trước ở luồng nền)
+        self.data_tree = {}
+        self._scan_executor = ThreadPoolExecutor(max_workers=1)
+        self._scan_futures = {}
+        
+        # Tìm tất cả bệnh nhân (chỉ liệt kê thư mục gốc)
+        self.patients = self._list_patient_dirs()
         self.patients.sort()
         
         if not self.patients:
@@ -316,6 +245,8 @@ class DicomComparisonTool:
         
         # Thiết lập các biến điều khiển
         self.current_patient = self.patients[0]
+        self._load_patient(self.current_patient)
+        self._prefetch_adjacent_patients()
         self.all_dates = self._get_all_dates()
         self.current_date = self.all_dates[0] if self.all_dates else None
         
@@ -327,14 +258,30 @@ class DicomComparisonTool:
         self.window_center = 40
         self.window_width = 400
         
-        # Cache cho ảnh đã tải
-        self.image_cache = {}
-        
+        # Cache LRU cho ảnh đã tải, giới hạn theo dung lượng: khóa (đường dẫn, None) là ảnh gốc,
+        # khóa (đường dẫn, center, width) là ảnh đã áp dụng window; ảnh gốc của series đang xem được ghim
+        self.image_cache = LRUByteCache(cache_mb * 1024 * 1024)
+        
+        # Volume CT (memmap, hoặc mảng trong bộ nhớ nếu không ghi được file đệm) theo (bệnh nhân, ngày),
+        # None nếu series không dựng được volume; chỉ giữ volume của ngày đang xem
+        self.ct_volumes = {}
+        
+        # Giải mã ảnh và dựng volume ở luồng nền, kết quả được hiển thị bởi timer của giao diện:
+        # mỗi khung ('CT'/'CBCT') chỉ giữ yêu cầu mới nhất, yêu cầu cũ chưa chạy bị hủy
+        self._decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+        self._volume_executor = ThreadPoolExecutor(max_workers=1)
+        self._decode_requests = {}
+        self._volume_futures = {}
+        self._failed_files = set()
+        self._decode_timer = None
+
         # Đặt flag để theo dõi việc tải ảnh CBCT
         self.cbct_loading_attempted = False
         
         # Tạo giao diện
         self.create_ui()
+        self.fig.canvas.mpl_connect('close_event', self._on_close)
+        self._start_decode_timer()
         
         # Try tìm ảnh CBCT khi khởi động
         self._auto_find_cbct_images()
@@ -350,38 +297,50 @@ class DicomComparisonTool:
         plt.axis('off')
         plt.tight_layout()
     
-    def _scan_directory_structure(self):
-        """Quét cấu trúc thư mục và tạo cây dữ liệu"""
-        data_tree = {}
-        
-        try:
-            patient_dirs = [d for d in os.listdir(self.root_dir) 
-                           if os.path.isdir(os.path.join(self.root_dir, d)) and d not in ['summary_report.csv']]
-        except Exception as e:
-            print(f"Lỗi khi quét thư mục {self.root_dir}: {e}")
-            return {}
+    def _list_patient_dirs(self):
+        """Liệt kê các thư mục bệnh nhân (chỉ thư mục gốc, chưa quét bên trong)"""
+        if not self.tree_index.refresh(recursive=False):
+            print(f"Lỗi khi quét thư mục {self.root_dir}")
+            return []
+        self.tree_index.save()
+        return [d for d in self.tree_index.subdirs() if d not in ['summary_report.csv']]
+    
+    def _scan_patient(self, patient):
+        """Quét các thư mục CT/CBCT và ngày của một bệnh nhân, trả về cây dữ liệu của bệnh nhân đó"""
+        patient_tree = {}
+        # Chỉ mục được ghi ra đĩa khi đóng công cụ, không ghi sau mỗi lần quét bệnh nhân
+        self.tree_index.refresh(patient)
+        patient_subdirs = self.tree_index.subdirs(patient)
+        
+        # Kiểm tra các thư mục CT và CBCT
+        for img_type in ['CT', 'CBCT']:
+            if img_type in patient_subdirs:
+                patient_tree[img_type] = {}
+                type_path = os.path.join(patient, img_type)
+                
+                # Các thư mục ngày có file DICOM
+                for date in self.tree_index.subdirs(type_path):
+                    dicom_files = self.tree_index.files(os.path.join(type_path, date))
+                    if dicom_files:
+                        patient_tree[img_type][date] = dicom_files
         
-        for patient in patient_dirs:
-            patient_path = os.path.join(self.root_dir, patient)
-            data_tree[patient] = {}
-            
-            # Kiểm tra các thư mục CT và CBCT
-            for img_type in ['CT', 'CBCT']:
-                type_path = os.path.join(patient_path, img_type)
-                if os.path.exists(type_path) and os.path.isdir(type_path):
-                    data_tree[patient][img_type] = {}
-                    
-                    # Quét các thư mục ngày
-                    date_dirs = [d for d in os.listdir(type_path) if os.path.isdir(os.path.join(type_path, d))]
-                    for date in date_dirs:
-                        date_path = os.path.join(type_path, date)
-                        
-                        # Tìm số lượng file DICOM trong thư mục ngày
-                        dicom_files = glob.glob(os.path.join(date_path, "*.dcm"))
-                        if dicom_files:
-                            data_tree[patient][img_type][date] = dicom_files
-        
-        return data_tree
+        return patient_tree
+    
+    def _load_patient(self, patient):
+        """Cây dữ liệu của bệnh nhân, quét (hoặc chờ luồng nền quét xong) nếu chưa có"""
+        if patient not in self.data_tree:
+            future = self._scan_futures.pop(patient, None)
+            patient_tree = future.result() if future is not None else self._scan_patient(patient)
+            # Luồng giao diện có thể đã thêm dữ liệu (vd. file RI.*) trước đó
+            self.data_tree.setdefault(patient, patient_tree)
+        return self.data_tree[patient]
+    
+    def _prefetch_adjacent_patients(self):
+        """Quét trước bệnh nhân liền trước và liền sau ở luồng nền"""
+        idx = self.patients.index(self.current_patient)
+        for neighbor in self.patients[max(idx - 1, 0):idx + 2]:
+            if neighbor not in self.data_tree and neighbor not in self._scan_futures:
+                self._scan_futures[neighbor] = self._scan_executor.submit(self._scan_patient, neighbor)
     
     def _get_all_dates(self):
         """Lấy danh sách tất cả các ngày có sẵn cho bệnh nhân hiện tại (cả CT và CBCT)"""
@@ -405,149 +364,227 @@ class DicomComparisonTool:
             return self.data_tree[self.current_patient][img_type][self.current_date]
         return []
     
-    def _load_dcm_with_fallback(self, file_path):
-        """Nạp file DICOM với phương pháp dự phòng nếu cần"""
-        try:
-            # Thử dùng pydicom với GDCM
-            return pydicom.dcmread(file_path, force=True)
-        except Exception as e:
-            print(f"Lỗi khi tải với pydicom+GDCM: {e}")
-            
-            try:
-                # Thử dùng GDCM trực tiếp
-                reader = gdcm.ImageReader()
-                reader.SetFileName(file_path)
-                if not reader.Read():
-                    raise Exception("GDCM không thể đọc file")
-                
-                # Lấy dữ liệu hình ảnh từ GDCM
-                image = reader.GetImage()
-                pixels = self._get_pixels_from_gdcm_image(image)
-                
-                # Tạo đối tượng pydicom đơn giản
-                dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
-                return dcm, pixels
-            except Exception as gdcm_error:
-                print(f"Lỗi khi tải với GDCM: {gdcm_error}")
-                return None, None
-    
-    def _get_pixels_from_gdcm_image(self, gdcm_image):
-        """Chuyển đổi hình ảnh GDCM sang mảng numpy"""
-        # Lấy thông tin về kích thước ảnh
-        dims = gdcm_image.GetDimensions()
-        
-        # Lấy dữ liệu pixel
-        if not gdcm_image.GetBuffer():
-            return None
-        
-        # Chuyển đổi sang numpy array
-        pixel_format = gdcm_image.GetPixelFormat()
-        if pixel_format.GetScalarType() == gdcm.PixelFormat.INT16:
-            dtype = np.int16
-        elif pixel_format.GetScalarType() == gdcm.PixelFormat.UINT16:
-            dtype = np.uint16
-        else:
-            dtype = np.uint8
+    def load_dicom_image(self, file_path):
+        """
+        Tải ảnh DICOM từ đường dẫn file
         
-        buffer = gdcm_image.GetBuffer()
-        pixels = np.frombuffer(buffer, dtype=dtype)
-        pixels = pixels.reshape(dims[1], dims[0])  # Chuyển đổi kích thước
+        Trả về (ảnh float32 đã áp dụng rescale, info) với info là metadata do
+        decode_dicom trả về (file chỉ được đọc một lần), hoặc (None, None) nếu
+        không tải được.
+        """
+        # Kiểm tra cache
+        cached = self.image_cache.get((file_path, None))
+        if cached is not None:
+            return cached
         
-        return pixels
+        try:
+            # Phương pháp 1 và 2: pydicom, nếu không giải mã được thì dùng GDCM trực tiếp
+            image, info = decode_dicom(file_path)
+            self.image_cache.put((file_path, None), (image, info))
+            return image, info
+        except Exception as e:
+            print(f"Không giải mã được ({file_path}): {e}")
+            return self._load_raw_pixels(file_path)
     
-    def load_dicom_image(self, file_path):
-        """Tải ảnh DICOM từ đường dẫn file"""
-        # Kiểm tra cache
-        if file_path in self.image_cache:
-            return self.image_cache[file_path]
+    def _load_raw_pixels(self, file_path):
+        """
+        Phương pháp 3: đọc phần cuối file như pixel 16-bit không nén (khi mọi bộ giải mã thất bại)
         
+        Trả về (ảnh, info) cùng dạng với decode_dicom (Decoder là 'raw'), hoặc (None, None).
+        """
         try:
-            # Thử nhiều phương pháp để đọc file DICOM
-            try:
-                # Phương pháp 1: Dùng pydicom với GDCM
-                dcm = pydicom.dcmread(file_path, force=True)
-                if hasattr(dcm, 'pixel_array'):
-                    image = dcm.pixel_array
+            # Đọc metadata
+            dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
+            
+            # Lấy kích thước ảnh
+            rows = getattr(dcm, 'Rows', 512)
+            cols = getattr(dcm, 'Columns', 512)
+            
+            # Đọc dữ liệu nhị phân
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            
+            # Ước chừng vị trí của pixel data (header đọc không kèm pixel data, nên chỉ
+            # dựa vào kích thước file: pixel không nén nằm ở cuối file)
+            offset = len(data) - (rows * cols * 2)  # Giả sử 16-bit pixel
+            if offset > 0:
+                pixels = np.frombuffer(data[offset:], dtype=np.uint16)
+                if len(pixels) >= rows * cols:
+                    image = pixels[:rows*cols].reshape(rows, cols)
                     image = image.astype(np.float32)
-                    self.image_cache[file_path] = (image, dcm)
-                    return image, dcm
-                else:
-                    raise Exception("Không có pixel_array")
-            except Exception as e1:
-                print(f"Phương pháp 1 thất bại ({file_path}): {e1}")
-                
-                # Phương pháp 2: Dùng GDCM trực tiếp
-                try:
-                    reader = gdcm.ImageReader()
-                    reader.SetFileName(file_path)
-                    if reader.Read():
-                        gdcm_image = reader.GetImage()
-                        dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
-                        
-                        # Lấy dữ liệu pixel từ GDCM
-                        dims = gdcm_image.GetDimensions()
-                        buffer = gdcm_image.GetBuffer()
-                        
-                        # Xác định kiểu dữ liệu
-                        pixel_format = gdcm_image.GetPixelFormat()
-                        if pixel_format.GetScalarType() == gdcm.PixelFormat.INT16:
-                            dtype = np.int16
-                        elif pixel_format.GetScalarType() == gdcm.PixelFormat.UINT16:
-                            dtype = np.uint16
-                        else:
-                            dtype = np.uint8
-                        
-                        # Chuyển buffer thành numpy array
-                        pixels = np.frombuffer(buffer, dtype=dtype)
-                        image = pixels.reshape(dims[1], dims[0])
-                        image = image.astype(np.float32)
-                        
-                        # Cache kết quả
-                        self.image_cache[file_path] = (image, dcm)
-                        return image, dcm
-                    else:
-                        raise Exception("GDCM không thể đọc file")
-                except Exception as e2:
-                    print(f"Phương pháp 2 thất bại: {e2}")
                     
-                    # Phương pháp 3: Mở file nhị phân và thử phân tích
-                    try:
-                        # Đọc metadata
-                        dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
-                        
-                        # Lấy kích thước ảnh
-                        rows = getattr(dcm, 'Rows', 512)
-                        cols = getattr(dcm, 'Columns', 512)
-                        
-                        # Đọc dữ liệu nhị phân
-                        with open(file_path, 'rb') as f:
-                            data = f.read()
-                        
-                        # Kiểm tra xem có pixel data không
-                        if 'PixelData' in dcm:
-                            # Ước chừng vị trí của pixel data
-                            offset = len(data) - (rows * cols * 2)  # Giả sử 16-bit pixel
-                            if offset > 0:
-                                pixels = np.frombuffer(data[offset:], dtype=np.uint16)
-                                if len(pixels) >= rows * cols:
-                                    image = pixels[:rows*cols].reshape(rows, cols)
-                                    image = image.astype(np.float32)
-                                    
-                                    # Cache kết quả
-                                    self.image_cache[file_path] = (image, dcm)
-                                    return image, dcm
-                                    
-                        raise Exception("Không thể trích xuất pixel data")
-                    except Exception as e3:
-                        print(f"Phương pháp 3 thất bại: {e3}")
-                        
-                        # Tất cả phương pháp đều thất bại
-                        return None, dcm
-                        
-        except Exception as e:
-            print(f"Lỗi chung khi tải file {file_path}: {e}")
+                    info = {
+                        'Rows': int(rows),
+                        'Columns': int(cols),
+                        'NumberOfFrames': 1,
+                        'Modality': str(getattr(dcm, 'Modality', 'N/A')),
+                        'PhotometricInterpretation': str(getattr(dcm, 'PhotometricInterpretation', '')),
+                        'RescaleSlope': float(getattr(dcm, 'RescaleSlope', 1) or 1),
+                        'RescaleIntercept': float(getattr(dcm, 'RescaleIntercept', 0) or 0),
+                        'Decoder': 'raw'
+                    }
+                    image *= info['RescaleSlope']
+                    image += info['RescaleIntercept']
+                    
+                    # Cache kết quả
+                    self.image_cache.put((file_path, None), (image, info))
+                    return image, info
+                    
+            raise Exception("Không thể trích xuất pixel data")
+        except Exception as e3:
+            print(f"Phương pháp 3 thất bại: {e3}")
+            
+            # Tất cả phương pháp đều thất bại
             return None, None
     
+    def _get_ct_volume(self):
+        """
+        Volume CT (đã áp dụng rescale, lưu đệm .npy cạnh series) của ngày hiện tại
+        
+        Volume được mở/dựng ở luồng nền; trong lúc chờ trả về None (các lát cắt
+        được giải mã từng file).
+        """
+        key = (self.current_patient, self.current_date)
+        if key in self.ct_volumes:
+            return self.ct_volumes[key]
+        
+        if key not in self._volume_futures:
+            ct_files = list(self._get_dicom_files('CT'))
+            if not ct_files:
+                self.ct_volumes[key] = None
+                return None
+            self._volume_futures[key] = (ct_files, self._volume_executor.submit(load_series_volume, ct_files))
+            self._start_decode_timer()
+        return None
+    
+    def _volume_ready(self, key, ct_files, future):
+        """Nhận volume CT dựng xong (chạy trên luồng giao diện), trả về True nếu là series đang xem"""
+        series_volume = None
+        try:
+            series_volume = future.result()
+            if len(series_volume) != len(ct_files):
+                series_volume = None
+        except Exception as e:
+            print(f"Không dựng được volume CT, tải từng file: {e}")
+        # Volume của ngày đã rời đi không được giữ lại (được mở lại từ file đệm khi quay lại)
+        is_current = key == (self.current_patient, self.current_date)
+        if series_volume is None or is_current:
+            self.ct_volumes[key] = series_volume
+        if series_volume is None:
+            return False
+        
+        source = "file đệm" if series_volume.from_cache else "giải mã"
+        print(f"Volume CT {series_volume.volume.shape} ({source}): {series_volume.cache_path}")
+        
+        # Sắp xếp lại danh sách file theo thứ tự lát cắt của volume, giữ nguyên lát cắt đang xem
+        patient, date = key
+        current_files = self.data_tree[patient]['CT'][date]
+        self.data_tree[patient]['CT'][date] = series_volume.paths
+        if not is_current:
+            return False
+        try:
+            self.ct_slice_idx = series_volume.paths.index(current_files[self.ct_slice_idx])
+        except (IndexError, ValueError):
+            # Lát cắt đang xem không còn trong series (danh sách file đã đổi), quay về lát đầu
+            self.ct_slice_idx = 0
+        return True
+    
+    def _request_display_image(self, pane, file_path):
+        """
+        Ảnh đã áp dụng window/level của file cho khung pane ('CT' hoặc 'CBCT')
+        
+        Trả về (ảnh, False) nếu có sẵn trong cache; nếu chưa, gửi yêu cầu giải mã
+        nền (hủy yêu cầu cũ chưa chạy của khung) và trả về (None, True). Trả về
+        (None, False) nếu file không giải mã được.
+        """
+        key = (file_path, self.window_center, self.window_width)
+        display_image = self.image_cache.get(key)
+        if display_image is None:
+            cached = self.image_cache.get((file_path, None))
+            if cached is not None:
+                display_image = self._apply_window_level(cached[0])
+                self.image_cache.put(key, display_image)
+        
+        pending = self._decode_requests.get(pane)
+        if display_image is not None or file_path in self._failed_files:
+            if pending is not None:
+                pending[1].cancel()
+                del self._decode_requests[pane]
+            return display_image, False
+        
+        if pending is None or pending[0] != file_path:
+            if pending is not None:
+                pending[1].cancel()
+            self._decode_requests[pane] = (file_path, self._decode_executor.submit(self.load_dicom_image, file_path))
+            self._start_decode_timer()
+        return None, True
+    
+    def _start_decode_timer(self):
+        """Bật timer kiểm tra kết quả giải mã nền (nếu giao diện đã được tạo)"""
+        if not hasattr(self, 'fig'):
+            return
+        if self._decode_timer is None:
+            self._decode_timer = self.fig.canvas.new_timer(interval=DECODE_POLL_MS)
+            self._decode_timer.add_callback(self._poll_decoded)
+        self._decode_timer.start()
+    
+    def _poll_decoded(self):
+        """Hiển thị các ảnh/volume giải mã nền đã xong (chạy trên luồng giao diện)"""
+        update_ct = update_cbct = False
+        
+        for key, (ct_files, future) in list(self._volume_futures.items()):
+            if future.done():
+                del self._volume_futures[key]
+                update_ct = self._volume_ready(key, ct_files, future) or update_ct
+        
+        for pane, (file_path, future) in list(self._decode_requests.items()):
+            if not future.done():
+                continue
+            del self._decode_requests[pane]
+            try:
+                image, _ = future.result()
+            except Exception as e:
+                print(f"Lỗi khi giải mã {file_path}: {e}")
+                image = None
+            if image is None:
+                self._failed_files.add(file_path)
+            if pane == 'CT':
+                update_ct = True
+            else:
+                update_cbct = True
+        
+        if not self._decode_requests and not self._volume_futures and self._decode_timer is not None:
+            self._decode_timer.stop()
+        
+        if update_ct:
+            # set_val gọi _on_ct_slice_change, hiển thị lại lát cắt (từ volume hoặc cache)
+            self.ct_slider.set_val(self.ct_slice_idx)
+        if update_cbct:
+            self._update_cbct_display()
+            self._update_info_display()
+        if update_ct or update_cbct:
+            self.fig.canvas.draw_idle()
+    
+    def _on_close(self, event):
+        """Dừng các luồng nền và lưu chỉ mục thư mục khi đóng cửa sổ"""
+        if self._decode_timer is not None:
+            self._decode_timer.stop()
+        self._decode_executor.shutdown(wait=False, cancel_futures=True)
+        self._volume_executor.shutdown(wait=False, cancel_futures=True)
+        self._scan_executor.shutdown(wait=False, cancel_futures=True)
+        self.tree_index.save()
+
+    def _release_ct_volumes(self):
+        """Bỏ volume CT của các ngày khác ngày đang xem (chỉ giữ đánh dấu None của series lỗi)"""
+        key = (self.current_patient, self.current_date)
+        for other in [k for k, v in self.ct_volumes.items() if k != key and v is not None]:
+            del self.ct_volumes[other]
+    
+    def _pin_current_series(self):
+        """Ghim ảnh gốc của các file CT/CBCT ngày hiện tại trong cache"""
+        files = self._get_dicom_files('CT') + self._get_dicom_files('CBCT')
+        self.image_cache.set_pinned((file_path, None) for file_path in files)
+    
     def _apply_window_level(self, image, window_center=None, window_width=None):
         """Áp dụng window/level để hiển thị ảnh"""
         if image is None:
@@ -767,11 +804,12 @@ class DicomComparisonTool:
         print("Đang quét lại thư mục để tìm các file RI.* (CBCT)...")
         ri_files = []
         
-        # Quét thư mục root tìm tất cả file RI.*
-        for root, _, files in os.walk(self.root_dir):
-            for file in files:
-                if file.startswith('RI.') and file.endswith('.dcm'):
-                    ri_files.append(os.path.join(root, file))
+        # Tìm tất cả file RI.* trong chỉ mục thư mục (chỉ quét lại các thư mục đã thay đổi)
+        self.tree_index.refresh()
+        self.tree_index.save()
+        for file_path in self.tree_index.iter_files():
+            if os.path.basename(file_path).startswith('RI.'):
+                ri_files.append(file_path)
         
         if not ri_files:
             print("Không tìm thấy file RI.* nào!")
@@ -914,11 +952,24 @@ class DicomComparisonTool:
         else:
             print(f"Không có file CBCT nào cho ngày {self.current_date}")
         
+        # Ghim series đang xem để không bị bỏ khỏi cache khi duyệt bệnh nhân/ngày khác
+        self._pin_current_series()
+        
+        # Giải phóng volume CT của bệnh nhân/ngày trước
+        self._release_ct_volumes()
+        
+        # Thử giải mã lại các file lỗi khi chuyển bệnh nhân/ngày
+        self._failed_files.clear()
+
         # Cập nhật hiển thị
         self._update_ct_display()
         self._update_cbct_display()
         self._update_info_display()
     
+    def _show_placeholder(self, img):
+        """Ảnh xám tạm thời (cùng kích thước ảnh đang hiển thị) trong lúc chờ giải mã"""
+        img.set_data(np.full(img.get_array().shape[:2], 0.5, dtype=np.float32))
+    
     def _reset_display(self):
         """Đặt lại hiển thị khi không có dữ liệu"""
         self.ct_img.set_data(np.ones((512, 512)))
@@ -929,6 +980,7 @@ class DicomComparisonTool:
     
     def _update_ct_display(self):
         """Cập nhật hiển thị ảnh CT"""
+        series_volume = self._get_ct_volume()
         ct_files = self._get_dicom_files('CT')
         
         if not ct_files:
@@ -940,15 +992,20 @@ class DicomComparisonTool:
         if self.ct_slice_idx >= len(ct_files):
             self.ct_slice_idx = 0
         
-        # Tải ảnh CT
-        file_path = ct_files[self.ct_slice_idx]
-        image, dcm = self.load_dicom_image(file_path)
-        
-        if image is not None:
-            # Chuẩn hóa hình ảnh để hiển thị
+        # Tải ảnh CT (từ volume nếu có, nếu không thì giải mã nền)
+        pending = False
+        if series_volume is not None:
+            image = np.asarray(series_volume[self.ct_slice_idx], dtype=np.float32)
             display_image = self._apply_window_level(image)
+        else:
+            display_image, pending = self._request_display_image('CT', ct_files[self.ct_slice_idx])
+        
+        if display_image is not None:
             self.ct_img.set_data(display_image)
             self.ax_ct.set_title(f"CT - {self.current_date} - Slice {self.ct_slice_idx+1}/{len(ct_files)}")
+        elif pending:
+            self._show_placeholder(self.ct_img)
+            self.ax_ct.set_title(f"CT - {self.current_date} - Slice {self.ct_slice_idx+1}/{len(ct_files)} (đang giải mã...)")
         else:
             self.ct_img.set_data(np.ones((512, 512)))
             self.ax_ct.set_title(f"CT - {self.current_date} - Lỗi tải ảnh")
@@ -972,12 +1029,15 @@ class DicomComparisonTool:
         # Thử tải file để xem có pixel data không
         try:
             try:
-                # Sử dụng phương thức nạp với nhiều phương pháp dự phòng
-                image, dcm = self.load_dicom_image(file_path)
+                # Sử dụng phương thức nạp với nhiều phương pháp dự phòng (qua cache, giải mã nền)
+                display_image, pending = self._request_display_image('CBCT', file_path)
+                
+                if pending:
+                    self._show_placeholder(self.cbct_img)
+                    self.ax_cbct.set_title(f"CBCT - {self.current_date} - Slice {self.cbct_slice_idx+1}/{len(cbct_files)} (đang giải mã...)")
+                    return
                 
-                if image is not None:
-                    # Chuẩn hóa hình ảnh để hiển thị
-                    display_image = self._apply_window_level(image)
+                if display_image is not None:
                     self.cbct_img.set_data(display_image)
                     self.ax_cbct.set_title(f"CBCT - {self.current_date} - Slice {self.cbct_slice_idx+1}/{len(cbct_files)}")
                     
@@ -1025,23 +1085,32 @@ class DicomComparisonTool:
             info_text += f"Ngày ({date_idx+1}/{len(self.all_dates)}): {self.current_date}\n\n"
         
         # Hiển thị thông tin cửa sổ
-        info_text += f"Window Center: {int(self.window_center)}, Width: {int(self.window_width)}\n\n"
+        info_text += f"Window Center: {int(self.window_center)}, Width: {int(self.window_width)}\n"
+        
+        # Thống kê cache ảnh
+        cache = self.image_cache
+        info_text += (f"Cache: {cache.nbytes / (1024 * 1024):.0f}/{cache.max_bytes / (1024 * 1024):.0f} MB, "
+                      f"{len(cache)} ảnh ({cache.pinned_count} ghim), hit {cache.hits}, miss {cache.misses}\n\n")
         
         # Thông tin ảnh CT
         ct_files = self._get_dicom_files('CT')
         if ct_files and self.ct_slice_idx < len(ct_files):
             file_path = ct_files[self.ct_slice_idx]
-            _, dcm = self.load_dicom_image(file_path)
+            # Chỉ đọc header (qua bộ đệm dùng chung), không giải mã lại pixel
+            try:
+                header = get_header_cache().get_or_compute(file_path, HEADER_CACHE_NAMESPACE, read_info_header)
+            except Exception:
+                header = None
             
-            if dcm:
+            if header:
                 info_text += "CT Info:\n"
                 info_text += f"- File: {os.path.basename(file_path)}\n"
-                info_text += f"- Modality: {getattr(dcm, 'Modality', 'N/A')}\n"
-                info_text += f"- Size: {getattr(dcm, 'Rows', 'N/A')}x{getattr(dcm, 'Columns', 'N/A')}\n"
+                info_text += f"- Modality: {header['Modality']}\n"
+                info_text += f"- Size: {header['Rows']}x{header['Columns']}\n"
                 
                 # Thêm thông tin kỹ thuật
                 try:
-                    series_desc = str(getattr(dcm, 'SeriesDescription', 'N/A'))
+                    series_desc = header['SeriesDescription']
                     if len(series_desc) > 25:
                         series_desc = series_desc[:22] + "..."
                     info_text += f"- Series: {series_desc}\n"
@@ -1057,16 +1126,17 @@ class DicomComparisonTool:
         if cbct_files and self.cbct_slice_idx < len(cbct_files):
             file_path = cbct_files[self.cbct_slice_idx]
             try:
-                dcm = pydicom.dcmread(file_path, force=True, stop_before_pixels=True)
+                # Đọc header qua bộ đệm dùng chung (không đọc lại nếu file không đổi)
+                header = get_header_cache().get_or_compute(file_path, HEADER_CACHE_NAMESPACE, read_info_header)
                 
                 info_text += "CBCT Info:\n"
                 info_text += f"- File: {os.path.basename(file_path)}\n"
-                info_text += f"- Modality: {getattr(dcm, 'Modality', 'N/A')}\n"
-                info_text += f"- Size: {getattr(dcm, 'Rows', 'N/A')}x{getattr(dcm, 'Columns', 'N/A')}\n"
+                info_text += f"- Modality: {header['Modality']}\n"
+                info_text += f"- Size: {header['Rows']}x{header['Columns']}\n"
                 
                 # Thêm thông tin kỹ thuật
                 try:
-                    series_desc = str(getattr(dcm, 'SeriesDescription', 'N/A'))
+                    series_desc = header['SeriesDescription']
                     if len(series_desc) > 25:
                         series_desc = series_desc[:22] + "..."
                     info_text += f"- Series: {series_desc}\n"
@@ -1074,7 +1144,7 @@ class DicomComparisonTool:
                     pass
                 
                 # Kiểm tra xem có pixel data không
-                if hasattr(dcm, 'PixelData'):
+                if header['HasPixelData']:
                     info_text += f"- Có pixel data: Có\n"
                 else:
                     info_text += f"- Có pixel data: Không\n"
@@ -1113,6 +1183,10 @@ class DicomComparisonTool:
     
     def _patient_changed(self):
         """Xử lý khi bệnh nhân thay đổi"""
+        # Quét bệnh nhân mới (thường đã được quét trước ở luồng nền)
+        self._load_patient(self.current_patient)
+        self._prefetch_adjacent_patients()
+        
         # Đặt lại chỉ số slice
         self.ct_slice_idx = 0
         self.cbct_slice_idx = 0
@@ -1166,8 +1240,8 @@ class DicomComparisonTool:
         # Thu thập dữ liệu từ cây thư mục
         rows = []
         
-        for patient in self.data_tree:
-            patient_data = self.data_tree[patient]
+        for patient in self.patients:
+            patient_data = self._load_patient(patient)
             
             # Tìm tất cả các ngày có sẵn cho bệnh nhân này
             all_dates = set()
@@ -1246,9 +1320,6 @@ def main():
     # Khởi tạo công cụ so sánh
     comparison_tool = DicomComparisonTool(root_dir)
     
-    # Áp dụng sửa lỗi CBCT
-    fix_cbct_issues()
-    
     # Hiển thị giao diện
     plt.show()
     
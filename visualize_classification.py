@@ -5,6 +5,22 @@ import pydicom
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button, RadioButtons
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dicom_slice_cache import LRUByteCache
+from dicom_volume import load_series_volume, open_cached_volume, read_sorted_headers
+
+# Dung lượng bộ đệm pixel đã giải mã của trình xem (MB)
+PIXEL_CACHE_MB = 256
+
+# Chu kỳ (ms) kiểm tra các volume đang được dựng ở luồng nền
+VOLUME_POLL_MS = 200
+
+# Các tag dùng để hiển thị thông tin và chuẩn hóa ảnh (đọc cùng lần với các tag sắp xếp)
+INFO_KEYWORDS = [
+    'PatientID', 'PatientName', 'Modality', 'StudyDate', 'AcquisitionDate',
+    'StudyDescription', 'SeriesDescription', 'SliceThickness', 'PixelSpacing', 'ImageType',
+    'WindowCenter', 'WindowWidth', 'RescaleSlope', 'RescaleIntercept'
+]
 
 def load_dicom_paths_from_txt(txt_file_path):
     """Đọc danh sách đường dẫn đến các file DICOM từ file txt"""
@@ -13,25 +29,14 @@ def load_dicom_paths_from_txt(txt_file_path):
     return paths
 
 def load_dicom_series(dicom_paths):
-    """Tải một chuỗi ảnh DICOM và sắp xếp theo vị trí"""
-    slices = []
-    for path in dicom_paths:
-        try:
-            dcm = pydicom.dcmread(path, force=True)
-            slices.append(dcm)
-        except Exception as e:
-            print(f"Không thể đọc file {path}: {e}")
-    
-    # Sắp xếp theo vị trí lát cắt (nếu có)
-    try:
-        slices = sorted(slices, key=lambda x: float(x.ImagePositionPatient[2]))
-    except:
-        try:
-            slices = sorted(slices, key=lambda x: float(x.InstanceNumber))
-        except:
-            print("Không thể sắp xếp lát cắt theo vị trí, giữ nguyên thứ tự")
-    
-    return slices
+    """
+    Đọc header của một chuỗi ảnh DICOM và sắp xếp theo vị trí
+
+    Mỗi file chỉ được đọc một lần và chỉ phần đầu (các tag sắp xếp và
+    INFO_KEYWORDS). Trả về list (đường dẫn, header); pixel được giải mã khi lát
+    cắt được hiển thị (xem DicomViewer.get_pixel_array) hoặc lấy từ volume.
+    """
+    return read_sorted_headers(dicom_paths, INFO_KEYWORDS)
 
 def extract_dicom_info(dcm):
     """Trích xuất thông tin quan trọng từ file DICOM"""
@@ -80,13 +85,14 @@ def extract_dicom_info(dcm):
     
     return info
 
-def normalize_pixel_array(pixel_array, dcm):
-    """Chuẩn hóa giá trị pixel để hiển thị tốt hơn"""
+def normalize_pixel_array(pixel_array, dcm, rescaled=False):
+    """Chuẩn hóa giá trị pixel để hiển thị tốt hơn (rescaled=True nếu đã áp dụng rescale, khi đó truyền mảng float)"""
     # Xử lý RescaleSlope và RescaleIntercept nếu có
-    try:
-        pixel_array = pixel_array * float(dcm.RescaleSlope) + float(dcm.RescaleIntercept)
-    except:
-        pass
+    if not rescaled:
+        try:
+            pixel_array = pixel_array * float(dcm.RescaleSlope) + float(dcm.RescaleIntercept)
+        except:
+            pass
     
     # Chuẩn hóa cho hiển thị
     min_val = np.min(pixel_array)
@@ -110,8 +116,25 @@ def normalize_pixel_array(pixel_array, dcm):
 class DicomViewer:
     def __init__(self, ct_planning_paths, cbct_paths):
         """Khởi tạo trình xem DICOM với đường dẫn đến ảnh CT và CBCT"""
-        self.ct_planning_slices = load_dicom_series(ct_planning_paths)
-        self.cbct_slices = load_dicom_series(cbct_paths)
+        # Chỉ đọc header; pixel được giải mã khi hiển thị và giữ trong bộ đệm nhỏ
+        ct_planning_headers = load_dicom_series(ct_planning_paths)
+        cbct_headers = load_dicom_series(cbct_paths)
+        self.ct_planning_paths = [path for path, _ in ct_planning_headers]
+        self.ct_planning_slices = [dcm for _, dcm in ct_planning_headers]
+        self.cbct_paths = [path for path, _ in cbct_headers]
+        self.cbct_slices = [dcm for _, dcm in cbct_headers]
+        self.pixel_cache = LRUByteCache(PIXEL_CACHE_MB * 1024 * 1024)
+        
+        # Volume (memmap) đã lưu đệm được mở ngay; nếu chưa có, volume được dựng ở luồng nền
+        # (dùng lại các header trên) và thay cho việc giải mã từng file khi dựng xong
+        self.ct_planning_volume = open_cached_volume(ct_planning_headers)
+        self.cbct_volume = open_cached_volume(cbct_headers)
+        self._volume_executor = ThreadPoolExecutor(max_workers=1)
+        self._volume_futures = {}
+        for attr, paths, headers in [('ct_planning_volume', self.ct_planning_paths, ct_planning_headers),
+                                     ('cbct_volume', self.cbct_paths, cbct_headers)]:
+            if getattr(self, attr) is None and headers:
+                self._volume_futures[attr] = self._volume_executor.submit(load_series_volume, paths, True, headers)
         
         # Kiểm tra xem có ảnh nào được tải không
         if not self.ct_planning_slices and not self.cbct_slices:
@@ -133,6 +156,44 @@ class DicomViewer:
         
         # Tạo giao diện matplotlib
         self.create_ui()
+        self.fig.canvas.mpl_connect('close_event', self._on_close)
+        self._volume_timer = None
+        if self._volume_futures:
+            self._volume_timer = self.fig.canvas.new_timer(interval=VOLUME_POLL_MS)
+            self._volume_timer.add_callback(self._poll_volumes)
+            self._volume_timer.start()
+    
+    def _poll_volumes(self):
+        """Nhận các volume đã dựng xong ở luồng nền (chạy trên luồng giao diện)"""
+        for attr, future in list(self._volume_futures.items()):
+            if not future.done():
+                continue
+            del self._volume_futures[attr]
+            try:
+                series_volume = future.result()
+            except Exception as e:
+                print(f"Không dựng được volume, tiếp tục đọc từng file riêng lẻ: {e}")
+                continue
+            source = "file đệm" if series_volume.from_cache else "giải mã"
+            print(f"Volume {series_volume.volume.shape} ({source}): {series_volume.cache_path or 'trong bộ nhớ'}")
+            setattr(self, attr, series_volume)
+        
+        if not self._volume_futures:
+            self._volume_timer.stop()
+    
+    def _on_close(self, event):
+        """Dừng việc dựng volume nền khi đóng cửa sổ"""
+        if self._volume_timer is not None:
+            self._volume_timer.stop()
+        self._volume_executor.shutdown(wait=False, cancel_futures=True)
+    
+    def get_pixel_array(self, path):
+        """Giải mã pixel của lát cắt khi cần (chưa có volume), dùng bộ đệm LRU"""
+        pixel_array = self.pixel_cache.get(path)
+        if pixel_array is None:
+            pixel_array = pydicom.dcmread(path, force=True).pixel_array
+            self.pixel_cache.put(path, pixel_array)
+        return pixel_array
     
     def create_ui(self):
         """Tạo giao diện người dùng với matplotlib"""
@@ -199,8 +260,10 @@ class DicomViewer:
         
         # Lấy dữ liệu pixel và chuẩn hóa
         try:
-            pixel_array = dcm.pixel_array
-            pixel_array = normalize_pixel_array(pixel_array, dcm)
+            if self.ct_planning_volume is not None:
+                pixel_array = normalize_pixel_array(np.asarray(self.ct_planning_volume[idx], dtype=np.float32), dcm, rescaled=True)
+            else:
+                pixel_array = normalize_pixel_array(self.get_pixel_array(self.ct_planning_paths[idx]), dcm)
             self.ct_img.set_data(pixel_array)
             self.ct_img.set_clim(vmin=0, vmax=1)
         except Exception as e:
@@ -235,8 +298,10 @@ class DicomViewer:
         
         # Lấy dữ liệu pixel và chuẩn hóa
         try:
-            pixel_array = dcm.pixel_array
-            pixel_array = normalize_pixel_array(pixel_array, dcm)
+            if self.cbct_volume is not None:
+                pixel_array = normalize_pixel_array(np.asarray(self.cbct_volume[idx], dtype=np.float32), dcm, rescaled=True)
+            else:
+                pixel_array = normalize_pixel_array(self.get_pixel_array(self.cbct_paths[idx]), dcm)
             self.cbct_img.set_data(pixel_array)
             self.cbct_img.set_clim(vmin=0, vmax=1)
         except Exception as e: